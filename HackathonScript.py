@@ -10,11 +10,14 @@ import matplotlib.pyplot as plt
 import eyetracker
 modulepath = eyetracker.__path__[0]
 import os
+from eyetrackingEpochs import EpochView
+from eyetrackingTriggers import find_trigger_onsets
+from eyetrackingCalibration import calibration_error, load_targets
+from eyetrackingPreprocess_template import ScreenGeometry
 
 
-#Define Screen Size
-global screensize_pix
-screensize_pix=[1024, 768]
+#Define the screen: size in pixels and cm, viewing distance (vectorized pixel/degree conversions)
+geometry = ScreenGeometry(size_pix=(1024, 768), width_cm=42, distance_cm=75)
 
 #Set channels where eyetracking happened and where triggers happened
 eye_channel = ['UADC009-2104', 'UADC010-2104', 'UADC013-2104']
@@ -30,10 +33,11 @@ triggerData = data.copy().pick_channels(trigger_channel)._data.flatten()
 global et_refreshrate
 meg_refreshrate = et_refreshrate = eyeData.info['sfreq']
 
-#find trial onsets based on ADC016 channel
-onsets = np.where(triggerData < -4)[0]
-index = np.insert(np.where(np.diff(onsets) > 5)[0]+1,0,0)
-newonsets = onsets[index]
+#find trial onsets based on ADC016 channel (hysteresis -4/-2 V, at least 100 ms apart);
+#extra triggers beyond the 121 stimuli of the results file are dropped
+trigger_events = find_trigger_onsets(triggerData, eyeData.info['sfreq'],
+                                     expected=os.path.join(modulepath,'stimulus','results',f'{subjID}_run1.csv'))
+newonsets = trigger_events['onset_sample'].to_numpy()
 
 #What does this show again?
 plt.hist(np.diff(newonsets)/eyeData.info['sfreq'])
@@ -48,10 +52,11 @@ plt.plot(triggerData)
 plt.scatter(newonsets,triggerData[newonsets])
 plt.show()
 
-epochs = mne.Epochs(eyeData, events, tmin=0, tmax=3, baseline = None)
+# trials are views on eyeData's samples; nothing is copied per trial
+epochs = EpochView(eyeData._data, newonsets, eyeData.info['sfreq'], tmin=0, tmax=3, ch_names=eyeData.ch_names)
 
-for i in range(epochs.get_data().shape[0]):
-    plt.plot(epochs.times, epochs.get_data()[i,0,:])
+for trial in epochs:
+    plt.plot(epochs.times, trial[0,:])
 plt.show()
 
 
@@ -90,7 +95,7 @@ def deviation_calculator(tv,dia,is_valid,t_interp,smooth_filt_a,smooth_filt_b):
 
 def raw2df(raw_et, minvoltage=-5, maxvoltage=5, minrange=-0.2, maxrange=1.2,
            screenbottom=767, screenleft=0, screenright=1023, screentop=0, 
-           screensize_pix=screensize_pix):
+           screensize_pix=geometry.size_pix):
     '''
     Convert the MEG data lines (volts) to pixels for x/y and return a pandas
     dataframe.
@@ -135,7 +140,7 @@ def raw2df(raw_et, minvoltage=-5, maxvoltage=5, minrange=-0.2, maxrange=1.2,
 
 
 # Step 1: We are removing all samples where x,y is outside of the screen
-def remove_invalid_samples(eyes,tv,screensize_pix=screensize_pix):
+def remove_invalid_samples(eyes,tv,screensize_pix=geometry.size_pix):
     withinwidth                                     = np.abs(eyes['x'])<(screensize_pix[0]/2)
     withinheight                                    = np.abs(eyes['y'])<(screensize_pix[1]/2)
     is_valid                                        = np.array([x and y for x,y in zip(withinwidth,withinheight)]).astype(bool)
@@ -281,13 +286,6 @@ def remove_invalid_detrend(eyes_in,is_valid,isdetrend):
     return eyes_in
 
 
-def pix_to_deg(full_size_pix,screensize_pix=screensize_pix,screenwidth_cm=42,screendistance_cm=75):
-    pix_per_cm = screensize_pix[0]/screenwidth_cm
-    size_cm = full_size_pix/pix_per_cm
-    dva = math.atan(size_cm/2/screendistance_cm)*2
-    return np.rad2deg(dva)
-
-
 cropped_raw = crop_trailing_zeros(eyeData)
 
 #transform MNE-struct to pandas and change from volts to degrees (x,y) and area (pupil)
@@ -301,14 +299,14 @@ dia = eye_df['pupil'].copy().to_numpy()
 #What unit is diameter in?
 
 #Preprocessing steps
-isvalid1 = remove_invalid_samples(eye_df,tv,screensize_pix=screensize_pix)
+isvalid1 = remove_invalid_samples(eye_df,tv,screensize_pix=geometry.size_pix)
 isvalid2 = madspeedfilter(tv, dia, is_valid=isvalid1)
 isvalid3 = mad_deviation(tv, dia, isvalid2)
 eyes_preproc_meg = eye_df.copy()
 eyes_preproc_meg['x'] = remove_invalid_detrend(eyes_preproc_meg['x'].to_numpy(),isvalid3,True)
-eyes_preproc_meg['x_deg'] = [pix_to_deg(i,screensize_pix=screensize_pix,screenwidth_cm=42,screendistance_cm=75) for i in eyes_preproc_meg['x']]
+eyes_preproc_meg['x_deg'] = geometry.pix_to_deg(eyes_preproc_meg['x'].to_numpy())
 eyes_preproc_meg['y'] = remove_invalid_detrend(eyes_preproc_meg['y'].to_numpy(),isvalid3,True)
-eyes_preproc_meg['y_deg'] = [pix_to_deg(i,screensize_pix=screensize_pix,screenwidth_cm=42,screendistance_cm=75) for i in eyes_preproc_meg['y']]
+eyes_preproc_meg['y_deg'] = geometry.pix_to_deg(eyes_preproc_meg['y'].to_numpy())
 eyes_preproc_meg['pupil'] = remove_invalid_detrend(eyes_preproc_meg['pupil'].to_numpy(),isvalid3,True)
 
 
@@ -330,23 +328,31 @@ plt.show()
 
 #Epoching Data
 
-epochs = mne.Epochs(rawpreproc, events, tmin=0, tmax=3, baseline= None)
+epochs = EpochView(rawpreproc._data, newonsets, rawpreproc.info['sfreq'], tmin=0, tmax=3, ch_names=rawpreproc.ch_names)
 
-for i in range(epochs.get_data().shape[0]):
-    plt.plot(epochs.times, epochs.get_data()[i,0,:])
+for trial in epochs:
+    plt.plot(epochs.times, trial[0,:])
 plt.show()
 
 
 # expand this to all trials
-ind = epochs.times<=1 # durations[1] # select times within trial duration
+cropped = epochs.crop(tmax=1) # durations[1] # select times within trial duration, still a view
 
-cropped_epo = epochs.get_data()[:,:,ind]
+# one (trials x channels x time) array for the per-trial analysis below
+cropped_epo = cropped.get_data(copy=True)
 for i in range(cropped_epo.shape[0]):
-    plt.plot(epochs.times[ind], cropped_epo[i,0,:])
+    plt.plot(cropped.times, cropped_epo[i,0,:])
+plt.show()
+
+# plot error over time per trial, all trials at once; targets of the trials EpochView dropped are removed so the rest stay aligned
+keptPositions = np.delete(truePositions.to_numpy()[:len(newonsets)], epochs.dropped, axis=0)
+err = np.sqrt(np.sum((cropped_epo-keptPositions[:,:,None])**2,axis=1)) # plot euclidian distance as error measure
+plt.plot(cropped.times, err.T, color='k', alpha=.1)
 plt.show()
 
-# plot error over time per trial
-# TODO: iterate over trials
-trial = 0
-err = np.sqrt(np.sum((cropped_epo[trial,:,:].T-truePositions.loc[trial,:].to_numpy())**2,axis=1)) # plot euclidian distance as error measure
-plt.plot(err)
\ No newline at end of file
+# calibration error per trial from the longest fixation (port of calibration_error.m)
+calib = calibration_error(eyes_preproc_meg['x'].to_numpy(), eyes_preproc_meg['y'].to_numpy(), newonsets,
+                          load_targets(os.path.join(modulepath,'stimulus','results',f'{subjID}_run1.csv')), meg_refreshrate)
+plt.scatter(calib['target_x'], calib['target_y'], marker='x', color='k')
+plt.quiver(calib['target_x'], calib['target_y'], calib['err_x'], calib['err_y'], angles='xy', scale_units='xy', scale=1)
+plt.show()
\ No newline at end of file
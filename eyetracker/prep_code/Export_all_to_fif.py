@@ -4,11 +4,28 @@
 Created on Wed May  3 15:39:34 2023
 
 @author: jstout
+
+Convert every *.ds in a directory to a *_raw.fif holding only the misc (UADC)
+channels. The channels are read with read_ctf_channels
+(eyetrackingPreprocess_template.py) from the memory-mapped .meg4 file, chunk
+by chunk, and written with save_raw_chunks, so neither the MEG channels nor
+the whole recording are ever loaded. Datasets are converted in parallel, and
+outputs that are newer than every file of their .ds are skipped.
+
+    python Export_all_to_fif.py -indir /data/hackathon -outdir . -jobs 4
 """
 
 import mne
 import glob
 import os, os.path as op
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# the preprocessing module lives at the top of the repository
+_spec = importlib.util.spec_from_file_location(
+    'eyetrackingPreprocess_template', op.join(op.dirname(op.abspath(__file__)), '..', '..', 'eyetrackingPreprocess_template.py'))
+preproc = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(preproc)
 
 data_dict = {
     '001': 'S01_discretePositions',
@@ -18,19 +35,76 @@ data_dict = {
     '005': 'S04_discretePositions'
    	}
 
-for dset in glob.glob('*.ds'):
-    run=dset.split('_')[-1].split('.')[0]
-    out_name = data_dict[run]
-    
-    #Read in data
-    raw = mne.io.read_raw_ctf(dset, system_clock='ignore', preload=True)
-    
-    #Drop the MEG channels
-    raw.pick_types(meg=False, misc=True)
-
-    with raw.info._unlock():
-        raw.info['comps'] = []
-    
-    #Save data
-    out_fname = f'{out_name}_raw.fif'
-    raw.save(out_fname)
+
+def is_up_to_date(dset, out_fname):
+    '''True if out_fname exists and is newer than every file of the dataset.'''
+    if not op.exists(out_fname):
+        return False
+    newest_input = max(op.getmtime(op.join(root, f)) for root, _, files in os.walk(dset) for f in files)
+    return op.getmtime(out_fname) >= newest_input
+
+
+def iter_channel_chunks(dset, channels, chunk_samples):
+    '''(n_channels, <=chunk_samples) arrays of the channels, in order, until the recording ends.'''
+    start = 0
+    while True:
+        data, _ = preproc.read_ctf_channels(dset, channels, start, start+chunk_samples)
+        if data.shape[1] == 0:
+            return
+        yield data
+        start += chunk_samples
+
+
+def convert_dataset(dset, out_fname, chunk_duration=60):
+    #Read the header only: the misc channels and the sample rate
+    channels = preproc.ctf_misc_channels(dset)
+    sfreq = preproc.read_ctf_header(dset)['sfreq']
+    info = mne.create_info(channels, sfreq, 'misc')
+
+    #Save data, chunk_duration seconds at a time; the rename makes an interrupted
+    #conversion look out of date instead of finished
+    tmp_fname = out_fname[:-len('_raw.fif')] + '_partial_raw.fif'
+    chunks = iter_channel_chunks(dset, channels, int(round(chunk_duration*sfreq)))
+    preproc.save_raw_chunks(tmp_fname, info, chunks, buffer_size_sec=chunk_duration)
+    os.replace(tmp_fname, out_fname)
+
+
+def _convert_one(dset, out_fname, chunk_duration):
+    try:
+        convert_dataset(dset, out_fname, chunk_duration)
+        return dset, 'converted', ''
+    except Exception as err:
+        return dset, 'failed', f'{type(err).__name__}: {err}'
+
+
+def export_all(indir='.', outdir='.', jobs=None, chunk_duration=60, force=False):
+    os.makedirs(outdir, exist_ok=True)
+    todo = []
+    for dset in sorted(glob.glob(op.join(indir, '*.ds'))):
+        run = op.basename(dset).split('_')[-1].split('.')[0]
+        if run not in data_dict:
+            print(f'skipping {dset}: run {run} is not in data_dict')
+            continue
+        out_fname = op.join(outdir, f'{data_dict[run]}_raw.fif')
+        if not force and is_up_to_date(dset, out_fname):
+            print(f'up to date: {out_fname}')
+            continue
+        todo.append((dset, out_fname))
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_convert_one, dset, out_fname, chunk_duration) for dset, out_fname in todo]
+        for future in as_completed(futures):
+            dset, status, error = future.result()
+            print(f'{status}: {dset} {error}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-indir', default='.', help='directory with the *.ds datasets')
+    parser.add_argument('-outdir', default='.', help='directory for the *_raw.fif files')
+    parser.add_argument('-jobs', type=int, default=None, help='number of datasets converted in parallel (default: all cores)')
+    parser.add_argument('-chunk', type=float, default=60, help='seconds of data read and written at a time (default 60)')
+    parser.add_argument('-force', action='store_true', help='convert even if the output is up to date')
+    args = parser.parse_args()
+    export_all(args.indir, args.outdir, jobs=args.jobs, chunk_duration=args.chunk, force=args.force)
@@ -3,6 +3,8 @@ import numpy as np
 from psychopy import visual, event, core,parallel
 from datetime import datetime
 import os
+from stimulusPositions import definePos
+from frameTiming import FrameLog
 
 
 ########## PARAMETERS ##########
@@ -39,11 +41,11 @@ def setup_window(background_color = background_col, color_space = 'rgb255', isfu
     win = visual.Window(color=background_color,colorSpace=color_space,units='pix',checkTiming=True,fullscr=isfullscreen)
     return win 
 
-def draw_stim(win,stim,photorect_white,trigger_code=100, port = []):
+def draw_stim(win,stim,photorect_white,trigger_code=100, port = [], frame = None):
     stim.draw()
     photorect_white.draw()
     if ismeg:
-        win.callOnFlip(trigger,port = port,code=trigger_code)
+        win.callOnFlip(trigger,port = port,code=trigger_code,frame=frame)
     return win.flip()
 
 def setup_triggers():
@@ -51,8 +53,10 @@ def setup_triggers():
     port.setData(0)
     return port
 
-def trigger(port,code):
+def trigger(port,code,frame=None):
     port.setData(int(code))
+    if frame is not None:
+        frame_log.mark_trigger(frame, core.getTime())
 
 if iseyetracking:
     import eyetracker 
@@ -75,38 +79,6 @@ else:
 
 
 
-def definePos(nTrials, wWidth,wHeight, factor):
-
-    ''' use numpy's meshgrid to define a uniform sampling of the stimulus screen '''
-    prcnt = .8
-    dim = int(np.ceil(np.sqrt(nTrials)))
-    nx, ny = (dim, dim)
-    x = np.linspace(prcnt*(-wWidth/factor), prcnt*(wWidth/factor), nx)
-    y = np.linspace(prcnt*(-wHeight/factor), prcnt*(wHeight/factor), ny)
-    xv, yv = np.meshgrid(x, y)
-    posArr =  np.reshape(np.concatenate((xv.flatten(),yv.flatten()),axis=0), (2,len(xv.flatten()))).T
-
-    #if nTrials != (dim**2):
-    #    print(f"original n trials = {nTrials} was changed to {dim**2} to ensure uniform sampling")
-    
-    rng = np.random.default_rng()
-    i = rng.permuted(np.arange(len(posArr)))
-
-    #import random
-    #random.shuffle(posArr)
-
-    '''
-    # plot grid
-    import matplotlib.pyplot as plt
-    fig,ax = plt.subplots()
-    ax.plot(xv, yv, marker='o', color='k', linestyle='none')
-    ax.plot(posArr[:,0], posArr[:,1], marker='o', color='r', alpha=.5, linestyle='none')
-    plt.show(block=False)
-    '''
-
-
-    return posArr[i,:]
-
 # if already defined, use existing stimulus files. Otherwise create a new sampling
 
 stim_path = os.path.join(curr_path,'stim')
@@ -131,6 +103,10 @@ else:
 print(f"\n\n\nrun length is: {np.cumsum(isiArr/refreshrate+2)[-1]}\n\n\n")
 print(posArr)
 
+# every flip of the run is logged (time, position, trigger) and saved next to the results
+trialFrames = int(stim_duration*refreshrate) + isiArr
+frame_log = FrameLog(int(np.sum(trialFrames)), refreshrate)
+
 photorect_white = visual.Rect(win=win,width = 5,height=10,fillColor='white',pos=(-wWidth/factor,wHeight/factor))
 photorect_black = visual.Rect(win=win,width = 5,height=10,fillColor='black',pos=(-wWidth/factor,wHeight/factor))
 
@@ -157,6 +133,7 @@ def instruction_screen(keylist,text):
                 print('user quit experiment')
                 df = pd.DataFrame(posArr, columns = ['xPos','yPos'])
                 df.to_csv(f"{fname_data}_quit.csv",index=False)
+                frame_log.save(f"{fname_data}_quit_frames.npz")
                 if iseyetracking:
                     eyetracker.exit(el_tracker,et_fname,results_folder=f'{curr_path}/results/')
                 win.close()
@@ -183,15 +160,20 @@ import time
 
 init = time.time()
 print(posArr)
+frame = 0
 for pp in range(np.shape(posArr)[0]): 
     fixation.pos = tuple(posArr[pp,:])
     # loop over all flips
     if iseyetracking:
         eyetracker.send_message(el_tracker,pp)
 
-    draw_stim(win,fixation,photorect_white,trigger_code=pp+1, port = port)
-    for t in range(int(stim_duration*refreshrate)-1 + isiArr[pp]):
-        last_flip = draw_stim(win,fixation,photorect_black,trigger_code=0, port = port)
+    last_flip = draw_stim(win,fixation,photorect_white,trigger_code=pp+1, port = port, frame = frame)
+    frame_log.record(frame, last_flip, posArr[pp,:], trigger=pp+1, photodiode=True, condition=pp)
+    frame += 1
+    for t in range(trialFrames[pp]-1):
+        last_flip = draw_stim(win,fixation,photorect_black,trigger_code=0, port = port, frame = frame)
+        frame_log.record(frame, last_flip, posArr[pp,:], condition=pp)
+        frame += 1
         pressed=event.getKeys(keyList=response_keys, modifiers=False, timeStamped=False) 
     
         if pressed:
@@ -199,6 +181,7 @@ for pp in range(np.shape(posArr)[0]):
                 print('user quit experiment')
                 df = pd.DataFrame(posArr, columns = ['xPos','yPos'])
                 df.to_csv(f"{fname_data}_quit.csv",index=False)
+                frame_log.save(f"{fname_data}_quit_frames.npz")
                 if iseyetracking:
                     eyetracker.exit(el_tracker,et_fname,results_folder=f'{curr_path}/results/')
                 win.close()
@@ -206,11 +189,13 @@ for pp in range(np.shape(posArr)[0]):
     
     if ismeg: 
         trigger(port=port,code=0)
+    print(pp, frame_log.summary())
 
 
 # save data
 df = pd.DataFrame(posArr, columns = ['xPos','yPos'])
 df.to_csv(f"{fname_data}.csv",index=False)
+frame_log.save(f"{fname_data}_frames.npz")
 
 
 if iseyetracking:
@@ -0,0 +1,134 @@
+"""
+Flip-by-flip timing log of the stimulus scripts (discretePos.py,
+movingPos.py), without psychopy.
+
+FrameLog keeps the timestamp of every flip in preallocated arrays together
+with the dot position shown, the trigger code, the photodiode state and the
+condition. Dropped frames (a flip interval longer than (1+drop_tolerance)
+frames) and late triggers (the port written more than late_trigger_s after
+the flip) are counted as the flips come in, so that summary() can be
+printed during the run. save() writes everything to a .npz file next to the
+results CSV.
+
+On the analysis side, frame_samples() maps every flip to a MEG sample by
+anchoring the photodiode flips to their onsets in the recording, and
+displayed_positions() gives the dot position on screen at every sample.
+"""
+
+import numpy as np
+
+
+class FrameLog:
+    ''' preallocated log of n_frames flips; frames are indexed from 0 in display order '''
+
+    def __init__(self, n_frames, refreshrate, drop_tolerance=0.5, late_trigger_s=0.001):
+        self.refreshrate = refreshrate
+        self.drop_tolerance = drop_tolerance
+        self.late_trigger_s = late_trigger_s
+        self.flip_time = np.full(n_frames, np.nan)
+        self.trigger_time = np.full(n_frames, np.nan)
+        self.position = np.full((n_frames, 2), np.nan, dtype=np.float32)
+        self.trigger = np.zeros(n_frames, dtype=np.int16)
+        self.photodiode = np.zeros(n_frames, dtype=bool)
+        self.condition = np.full(n_frames, -1, dtype=np.int32)
+        self.n = 0
+        self.n_dropped = 0
+        self.n_late = 0
+        self.max_interval = 0.
+        self.max_latency = 0.
+
+    def record(self, frame, flip_time, position, trigger=0, photodiode=False, condition=-1):
+        '''
+        Store one flip and update the live counters. Returns the number of
+        frames dropped just before this flip.
+        '''
+        self.flip_time[frame] = flip_time
+        self.position[frame] = position
+        self.trigger[frame] = trigger
+        self.photodiode[frame] = photodiode
+        self.condition[frame] = condition
+        self.n = max(self.n, frame+1)
+        self._check_latency(frame)
+        if frame == 0 or np.isnan(self.flip_time[frame-1]):
+            return 0
+        interval = flip_time - self.flip_time[frame-1]
+        self.max_interval = max(self.max_interval, interval)
+        dropped = int(interval*self.refreshrate - self.drop_tolerance) if interval*self.refreshrate > 1+self.drop_tolerance else 0
+        self.n_dropped += dropped
+        return dropped
+
+    def mark_trigger(self, frame, trigger_time):
+        ''' time the trigger of frame was written to the port (called from the callOnFlip callback) '''
+        self.trigger_time[frame] = trigger_time
+        self._check_latency(frame)
+
+    def _check_latency(self, frame):
+        # counted once both times are known, whichever arrives last
+        latency = self.trigger_time[frame] - self.flip_time[frame]
+        if np.isnan(latency):
+            return
+        self.max_latency = max(self.max_latency, latency)
+        if latency > self.late_trigger_s:
+            self.n_late += 1
+
+    def summary(self):
+        ''' one-line report of the flips so far '''
+        return (f'{self.n} frames, {self.n_dropped} dropped, {self.n_late} late triggers, '
+                f'max interval {self.max_interval*1000:.1f} ms, max trigger latency {self.max_latency*1000:.2f} ms')
+
+    def save(self, fname):
+        ''' write the recorded flips (up to the last one) to fname (.npz) '''
+        n = self.n
+        np.savez(fname, flip_time=self.flip_time[:n], trigger_time=self.trigger_time[:n],
+                 position=self.position[:n], trigger=self.trigger[:n], photodiode=self.photodiode[:n],
+                 condition=self.condition[:n], dropped=dropped_frames(self.flip_time[:n], self.refreshrate, self.drop_tolerance),
+                 refreshrate=self.refreshrate, drop_tolerance=self.drop_tolerance, late_trigger_s=self.late_trigger_s)
+        return fname
+
+
+def dropped_frames(flip_time, refreshrate, drop_tolerance=0.5):
+    ''' number of frames dropped before every flip (0 for the first one) '''
+    n_intervals = np.diff(flip_time, prepend=np.nan)*refreshrate
+    late = n_intervals > 1+drop_tolerance
+    dropped = np.zeros(len(flip_time), dtype=np.int32)
+    dropped[late] = (n_intervals[late] - drop_tolerance).astype(np.int32)
+    return dropped
+
+
+def load_frames(fname):
+    ''' the arrays saved by FrameLog.save as a dict '''
+    with np.load(fname) as frames:
+        return {key: frames[key] for key in frames.files}
+
+
+def frame_samples(frames, anchor_samples, sfreq):
+    '''
+    MEG sample of every flip. The photodiode flips are matched in order to
+    anchor_samples (e.g. the photodiode onsets in UADC016); the other flips
+    are placed from the flip times relative to the last anchor before them,
+    so the stimulus and MEG clocks only need to agree within a condition.
+    Flips before the first anchor are placed from the first one.
+    '''
+    flip_time = frames['flip_time']
+    anchors = np.flatnonzero(frames['photodiode'])
+    anchor_samples = np.asarray(anchor_samples)
+    if not len(anchors):
+        raise ValueError('the log has no photodiode flips to anchor the frames to the recording')
+    if len(anchors) != len(anchor_samples):
+        raise ValueError(f'{len(anchors)} photodiode flips in the log but {len(anchor_samples)} anchor samples')
+    last = np.clip(np.searchsorted(anchors, np.arange(len(flip_time)), side='right')-1, 0, None)
+    return np.round(anchor_samples[last] + (flip_time - flip_time[anchors[last]])*sfreq).astype(np.int64)
+
+
+def displayed_positions(frames, anchor_samples, sfreq, n_samples):
+    '''
+    (n_samples, 2) dot position on screen (pix) at every MEG sample: the
+    position of the last flip at or before the sample, NaN before the first
+    flip and after the last frame has been on screen for one refresh.
+    '''
+    samples = frame_samples(frames, anchor_samples, sfreq)
+    last = np.searchsorted(samples, np.arange(n_samples), side='right')-1
+    positions = frames['position'][np.clip(last, 0, None)].astype(float)
+    end = samples[-1] + int(np.ceil(sfreq/float(frames['refreshrate'])))
+    positions[(last < 0) | (np.arange(n_samples) >= end)] = np.nan
+    return positions
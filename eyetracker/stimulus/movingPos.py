@@ -4,6 +4,8 @@ from psychopy import visual, event, core,parallel
 from datetime import datetime
 import os
 import time
+from stimulusPositions import moving_conditions, moving_trajectory
+from frameTiming import FrameLog
 
 ########## PARAMETERS ##########
 
@@ -11,6 +13,7 @@ participant = '01'
 run = 1
 stim_duration = 3 # s
 runDur = 300 # s
+seed = None # trajectory seed; None draws a new one (it is saved with the results)
 
 ismeg = 1
 isfullscreen = 1
@@ -39,11 +42,11 @@ def setup_window(background_color = background_col, color_space = 'rgb255', isfu
     win = visual.Window(color=background_color,colorSpace=color_space,units='pix',checkTiming=True,fullscr=isfullscreen)
     return win 
 
-def draw_stim(win,stim,photorect_white,trigger_code=100, port = []):
+def draw_stim(win,stim,photorect_white,trigger_code=100, port = [], frame = None):
     stim.draw()
     photorect_white.draw()
     if ismeg:
-        win.callOnFlip(trigger,port = port,code=trigger_code)
+        win.callOnFlip(trigger,port = port,code=trigger_code,frame=frame)
     return win.flip()
 
 def setup_triggers():
@@ -51,8 +54,10 @@ def setup_triggers():
     port.setData(0)
     return port
 
-def trigger(port,code):
+def trigger(port,code,frame=None):
     port.setData(int(code))
+    if frame is not None:
+        frame_log.mark_trigger(frame, core.getTime())
 
 if iseyetracking:
     import eyetracker 
@@ -74,6 +79,17 @@ else:
 
 
 
+# the whole trajectory is computed here, before the run starts; the frame loop only indexes posXY
+if seed is None:
+    seed = int(np.random.SeedSequence().entropy % 2**32)
+motDirs, dotSpeeds, condTimes = moving_conditions(runDur, refreshrate)
+trajectory = moving_trajectory(condTimes, motDirs, dotSpeeds, wWidth, wHeight, factor, refreshrate, seed=seed)
+posXY = trajectory['positions']
+frames = 0
+np.savez(f"{fname_data}_trajectory.npz", seed=seed, condTimes=condTimes, **trajectory)
+# every flip of the run is logged (time, position, trigger) and saved next to the results
+frame_log = FrameLog(len(posXY), refreshrate)
+
 photorect_white = visual.Rect(win=win,width = 5,height=10,fillColor='white',pos=(-wWidth/factor,wHeight/factor))
 photorect_black = visual.Rect(win=win,width = 5,height=10,fillColor='black',pos=(-wWidth/factor,wHeight/factor))
 
@@ -100,6 +116,7 @@ def instruction_screen(keylist,text):
                 print('user quit experiment')
                 df = pd.DataFrame(posXY[:frames+1,:], columns = ['xPos','yPos'])
                 df.to_csv(f"{fname_data}_quit.csv",index=False)
+                frame_log.save(f"{fname_data}_quit_frames.npz")
                 if iseyetracking:
                     eyetracker.exit(el_tracker,et_fname,results_folder=f'{curr_path}/results/')
                 win.close()
@@ -122,124 +139,39 @@ for _ in range(100):
 fixation  = visual.Circle(win,size=15,fillColor='black')
 
 win.mouseVisible = False
-# update radius using cartesian coordinates
-dotX, dotY = 0,0
-dotSpeeds = np.array([50,60,80])/refreshrate
-
-motDirs = [30,60,120,150,45,135,0,90] *2
-motDirs = np.array(motDirs)
-motDirs[len(motDirs)//2:] *=-1
-motDirs = motDirs[:len(motDirs)-2]
-
-
-fixation.pos = (dotX,dotY)
-condTimes = np.array([5,3,4,2,3,1,3,2,4,1]*20)
-
-ind = np.where(np.cumsum(condTimes)>runDur)[0][0]
-condTimes = condTimes[:ind+1]
-condTimesCum = np.cumsum(condTimes)
-frames = 0 
-c_ = 0
-i = np.random.randint(0, len(motDirs))
-d = np.random.randint(0, len(dotSpeeds))
-
-posXY = np.zeros([runDur * refreshrate,2])
-posXY[frames,:] = [dotX,dotY]
+fixation.pos = (0,0)
 
 init = time.time()
 refr_rate = win.getActualFrameRate()
 print('refresh rate', refr_rate)
-init_c = init
-
-def updateXY(dotX,dotY,motDirs,dotSpeeds,i,d):
-
-    tmpX = dotX + np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-    tmpY = dotY + np.sin(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-
-    if (tmpX > .8*(-wWidth/factor) and tmpX < .8*(wWidth/factor)):
-        dotX += np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-        
-    else:
-        tmpX = dotX + np.cos(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
-        outside = True
-    
-        maxIter = 10
-        count = 0
-        while outside:
-            #print('i am in')
-            if tmpX > .8*(-wWidth/factor) and tmpX < .8*(wWidth/factor):
-                dotX += np.cos(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
-                outside = False
-            else:
-                i = np.random.randint(0, len(motDirs))
-                tmpX = dotX + np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-                if tmpX > .8*(-wWidth/factor) and tmpX < .8*(wWidth/factor):
-                    outside = False
-                    dotX += np.cos(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
-
-            count +=1
-            if count > maxIter:
-                break
-    
-    if tmpY > .8*(-wHeight/factor) and tmpY < .8*(wHeight/factor):
-        dotY += np.sin(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-    else:
-        tmpY = dotY + np.sin(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
-        outside = True
-        maxIter = 10
-        count = 0
-        while outside:
-            #print('i am in')
-            if tmpY > .8*(-wHeight/factor) and tmpY < .8*(wHeight/factor):
-                dotY += np.sin(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
-                outside = False
-            else:
-                i = np.random.randint(0, len(motDirs))
-                tmpY = dotY + np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-                if tmpY > .8*(-wHeight/factor) and tmpY < .8*(wHeight/factor):
-                    outside = False
-                    dotY +=np.sin(motDirs[i]*(np.pi/180))*dotSpeeds[d]
-            count +=1
-            if count > maxIter:
-                break
-
-    return dotX, dotY
 
 for pp in range(len(condTimes)): 
 
-    i = np.random.randint(0, len(motDirs))
-    d = np.random.randint(0, len(dotSpeeds))
-    
     # loop over all flips
     if iseyetracking:
         eyetracker.send_message(el_tracker,pp)
 
-    draw_stim(win,fixation,photorect_white,trigger_code=0, port = port)
-    once = True
-    while time.time()-init <= condTimesCum[pp]:
-        if once:
-            print(pp, time.time()-init)
-            once = False
-
-        dotX, dotY = updateXY(dotX, dotY,motDirs,dotSpeeds,i,d)
-        fixation.pos = (dotX, dotY)
-
-        last_flip = draw_stim(win,fixation,photorect_black,trigger_code=0, port = port)
+    print(pp, time.time()-init, frame_log.summary())
+    first_frame = trajectory['first_frame'][pp]
+    for frames in range(first_frame, first_frame+trajectory['n_frames'][pp]):
+        fixation.pos = tuple(posXY[frames])
+        # the photodiode is white on the first frame of every condition
+        photorect = photorect_white if frames == first_frame else photorect_black
+        last_flip = draw_stim(win,fixation,photorect,trigger_code=0, port = port, frame = frames)
+        frame_log.record(frames, last_flip, posXY[frames], photodiode=frames == first_frame, condition=pp)
         pressed=event.getKeys(keyList=response_keys, modifiers=False, timeStamped=False) 
-        
+
         if pressed:
             if pressed == ['q']:
                 print('user quit experiment')
                 df = pd.DataFrame(posXY[:frames+1,:], columns = ['xPos','yPos'])
                 df.to_csv(f"{fname_data}_quit.csv",index=False)
+                frame_log.save(f"{fname_data}_quit_frames.npz")
                 if iseyetracking:
                     eyetracker.exit(el_tracker,et_fname,results_folder=f'{curr_path}/results/')
                 win.close()
                 core.quit()
 
-        frames +=1
-        posXY[frames,:] = [dotX,dotY]
-
     if ismeg: 
         trigger(port=port,code=0)
 
@@ -249,6 +181,7 @@ for pp in range(len(condTimes)):
 # save data
 df = pd.DataFrame(posXY, columns = ['xPos','yPos'])
 df.to_csv(f"{fname_data}.csv",index=False)
+frame_log.save(f"{fname_data}_frames.npz")
 
 
 if iseyetracking:
@@ -0,0 +1,137 @@
+"""
+Dot positions of the two eye-tracking paradigms, without psychopy, so that
+the same schedules can be used by the stimulus scripts (discretePos.py,
+movingPos.py) and by the synthetic recordings of eyetrackingSynthetic.py.
+
+Positions are PsychoPy 'pix' units: origin at the screen centre, y up.
+"""
+
+import numpy as np
+
+
+def definePos(nTrials, wWidth,wHeight, factor, rng=None):
+
+    ''' use numpy's meshgrid to define a uniform sampling of the stimulus screen '''
+    prcnt = .8
+    dim = int(np.ceil(np.sqrt(nTrials)))
+    nx, ny = (dim, dim)
+    x = np.linspace(prcnt*(-wWidth/factor), prcnt*(wWidth/factor), nx)
+    y = np.linspace(prcnt*(-wHeight/factor), prcnt*(wHeight/factor), ny)
+    xv, yv = np.meshgrid(x, y)
+    posArr =  np.reshape(np.concatenate((xv.flatten(),yv.flatten()),axis=0), (2,len(xv.flatten()))).T
+
+    #if nTrials != (dim**2):
+    #    print(f"original n trials = {nTrials} was changed to {dim**2} to ensure uniform sampling")
+
+    rng = np.random.default_rng() if rng is None else rng
+    i = rng.permuted(np.arange(len(posArr)))
+
+    return posArr[i,:]
+
+
+def updateXY(dotX,dotY,motDirs,dotSpeeds,i,d,wWidth,wHeight,factor,randint=np.random.randint):
+    ''' move the dot by one frame; at the edges the direction is mirrored or redrawn with randint
+    (the original per-flip model; movingPos.py now uses moving_trajectory) '''
+
+    tmpX = dotX + np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+    tmpY = dotY + np.sin(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+
+    if (tmpX > .8*(-wWidth/factor) and tmpX < .8*(wWidth/factor)):
+        dotX += np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+
+    else:
+        tmpX = dotX + np.cos(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
+        outside = True
+
+        maxIter = 10
+        count = 0
+        while outside:
+            if tmpX > .8*(-wWidth/factor) and tmpX < .8*(wWidth/factor):
+                dotX += np.cos(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
+                outside = False
+            else:
+                i = randint(0, len(motDirs))
+                tmpX = dotX + np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+                if tmpX > .8*(-wWidth/factor) and tmpX < .8*(wWidth/factor):
+                    outside = False
+                    dotX += np.cos(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
+
+            count +=1
+            if count > maxIter:
+                break
+
+    if tmpY > .8*(-wHeight/factor) and tmpY < .8*(wHeight/factor):
+        dotY += np.sin(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+    else:
+        tmpY = dotY + np.sin(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
+        outside = True
+        maxIter = 10
+        count = 0
+        while outside:
+            if tmpY > .8*(-wHeight/factor) and tmpY < .8*(wHeight/factor):
+                dotY += np.sin(-motDirs[i]*(np.pi/180))*dotSpeeds[d]
+                outside = False
+            else:
+                i = randint(0, len(motDirs))
+                tmpY = dotY + np.cos(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+                if tmpY > .8*(-wHeight/factor) and tmpY < .8*(wHeight/factor):
+                    outside = False
+                    dotY +=np.sin(motDirs[i]*(np.pi/180))*dotSpeeds[d]
+            count +=1
+            if count > maxIter:
+                break
+
+    return dotX, dotY
+
+
+def moving_conditions(runDur, refreshrate):
+    ''' motion directions, speeds (pix/frame) and condition durations (s) of movingPos.py '''
+    dotSpeeds = np.array([50,60,80])/refreshrate
+
+    motDirs = [30,60,120,150,45,135,0,90] *2
+    motDirs = np.array(motDirs)
+    motDirs[len(motDirs)//2:] *=-1
+    motDirs = motDirs[:len(motDirs)-2]
+
+    # the 28 s cycle is repeated as often as runDur needs
+    condTimes = np.array([5,3,4,2,3,1,3,2,4,1]*max(20,int(runDur//28)+1))
+    ind = np.where(np.cumsum(condTimes)>runDur)[0][0]
+    condTimes = condTimes[:ind+1]
+    return motDirs, dotSpeeds, condTimes
+
+
+def reflect(u, bound):
+    ''' fold unbounded coordinates into [-bound, bound], bouncing off both edges '''
+    return bound - np.abs(np.mod(u + bound, 4*bound) - 2*bound)
+
+
+def moving_trajectory(condTimes, motDirs, dotSpeeds, wWidth, wHeight, factor, refreshrate, seed=None, start=(0, 0)):
+    '''
+    Whole moving-dot trajectory of a run, one position per flip, computed
+    before the run so that the frame loop only indexes an array. Every
+    condition draws a direction and a speed (seeded) and moves the dot in a
+    straight line that bounces off the edges of the .8*screen/factor box
+    (mirror reflection, no rejection loop).
+    Returns a dict of arrays: positions (n_frames, 2) in pix, and per
+    condition first_frame, n_frames, direction (deg) and speed (pix/frame).
+    '''
+    rng = np.random.default_rng(seed)
+    i = rng.integers(0, len(motDirs), len(condTimes))
+    d = rng.integers(0, len(dotSpeeds), len(condTimes))
+    direction = np.asarray(motDirs)[i].astype(float)
+    speed = np.asarray(dotSpeeds)[d].astype(float)
+    n_frames = np.round(np.asarray(condTimes)*refreshrate).astype(np.int64)
+    first_frame = np.concatenate([[0], np.cumsum(n_frames)[:-1]])
+    bound = .8*np.array([wWidth, wHeight], dtype=float)/factor
+    step = np.column_stack([np.cos(np.deg2rad(direction)), np.sin(np.deg2rad(direction))])*speed[:, None]
+
+    positions = np.empty((int(n_frames.sum()), 2))
+    pos = np.asarray(start, dtype=float)
+    for c in range(len(n_frames)):
+        # a new condition starts from where the dot is, in its own direction
+        k = np.arange(1, n_frames[c]+1)[:, None]
+        positions[first_frame[c]:first_frame[c]+n_frames[c]] = reflect(pos + k*step[c], bound)
+        if n_frames[c]:
+            pos = positions[first_frame[c]+n_frames[c]-1]
+    return {'positions': positions, 'first_frame': first_frame, 'n_frames': n_frames,
+            'direction': direction, 'speed': speed}
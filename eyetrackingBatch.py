@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Batch preprocessing of many runs (all subjects, discrete and moving dot).
+
+Runs are given as glob patterns and/or a manifest file, and are processed in
+parallel, one run per worker process. Every run's cleaned data is written to
+the output directory. A report with the wall time, peak RSS and validity
+statistics of each run is printed and saved as batch_report.csv. A run that
+fails is recorded with its error; it does not abort the rest of the batch.
+With -metrics, the per-stage records of every run (wall time, samples
+invalidated, thresholds, pass counts; see StageTimer) are appended to
+stage_metrics.jsonl in the output directory.
+
+    python eyetrackingBatch.py -inputs 'data/S0*_raw.fif' -outdir preproc -jobs 4
+    python eyetrackingBatch.py -manifest runs.txt -outdir preproc -chunked
+
+The manifest is a text file with one input path per line (blank lines and
+lines starting with # are ignored).
+"""
+
+import os, sys, glob, time, resource, traceback
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import eyetrackingPreprocess_template as preproc
+
+
+def collect_inputs(patterns=(), manifest=None):
+    '''
+    Expand glob patterns and manifest lines into a list of unique input
+    paths (see check_outputs).
+    '''
+    inputs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f'no input matches {pattern}')
+        inputs.extend(matches)
+    if manifest is not None:
+        with open(manifest) as fid:
+            for line in fid:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    inputs.append(line)
+    inputs = list(dict.fromkeys(os.path.normpath(i) for i in inputs))
+    check_outputs(inputs)
+    return inputs
+
+
+def check_outputs(inputs):
+    '''Raise ValueError if two inputs would write the same output file (same run name in different directories).'''
+    by_output = {}
+    for raw_fname in inputs:
+        by_output.setdefault(output_fname(raw_fname, ''), []).append(raw_fname)
+    clashes = {out: fnames for out, fnames in by_output.items() if len(fnames) > 1}
+    if clashes:
+        raise ValueError('inputs with the same run name would overwrite each other\'s output: '
+                         + '; '.join(f"{out} <- {', '.join(fnames)}" for out, fnames in clashes.items()))
+
+
+def output_fname(raw_fname, outdir):
+    stem = os.path.basename(os.path.normpath(raw_fname))
+    for ext in ('.fif', '.ds'):
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+    return os.path.join(outdir, f'{stem}_preproc.npy')
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if os.uname().sysname == 'Darwin' else peak/1024
+
+
+def process_one(raw_fname, outdir, chunked=False, chunk_duration=60, metrics=False):
+    '''
+    Process a single run and write it to outdir. Never raises: errors are
+    returned in the record so that the rest of the batch carries on.
+    '''
+    record = {'input': raw_fname, 'output': output_fname(raw_fname, outdir), 'status': 'ok', 'error': ''}
+    collector = preproc.MetricsCollector() if metrics else None
+    t0 = time.perf_counter()
+    try:
+        if chunked:
+            out = preproc.process_run_chunked(raw_fname, record['output'], chunk_duration=chunk_duration, metrics=collector)
+            is_valid = ~np.isnan(out['x'])
+            record.update(n_samples=len(out), valid_final=float(is_valid.mean()))
+        else:
+            eyes, masks = preproc.process_run(raw_fname, return_masks=True, metrics=collector)
+            table = np.empty(len(eyes), dtype=[(c, 'f8') for c in eyes.columns])
+            for c in eyes.columns:
+                table[c] = eyes[c].to_numpy()
+            np.save(record['output'], table)
+            record['n_samples'] = len(eyes)
+            for name, step in zip(['isvalid1', 'isvalid2', 'isvalid3'], ['screen', 'speed', 'final']):
+                record[f'valid_{step}'] = masks[name].n_valid/max(masks[name].n_samples, 1)
+            record['n_gaps'] = max(len(masks['isvalid3'].starts)-1, 0)
+            record['n_blinks'] = len(masks['blinks'].starts)
+    except Exception as err:
+        record.update(status='failed', error=f'{type(err).__name__}: {err}', traceback=traceback.format_exc())
+    record['wall_time_s'] = time.perf_counter()-t0
+    record['peak_rss_mb'] = _peak_rss_mb()
+    if collector is not None:
+        record['stage_metrics'] = collector.records
+    return record
+
+
+def run_batch(inputs, outdir, jobs=None, chunked=False, chunk_duration=60, metrics=False):
+    '''
+    Process every input in its own worker process (so peak RSS is per run)
+    and return the report as a dataframe. Fresh workers per run need Python
+    3.11 (max_tasks_per_child); on older versions workers are reused and the
+    peak RSS of a run includes the runs its worker processed before.
+    '''
+    check_outputs(inputs)
+    os.makedirs(outdir, exist_ok=True)
+    records = []
+    pool_kw = {'max_tasks_per_child': 1} if sys.version_info >= (3, 11) else {}
+    with ProcessPoolExecutor(max_workers=jobs, **pool_kw) as pool:
+        futures = {pool.submit(process_one, raw_fname, outdir, chunked, chunk_duration, metrics): raw_fname
+                   for raw_fname in inputs}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as err:
+                # the worker itself died (e.g. killed for running out of memory)
+                record = {'input': futures[future], 'status': 'failed', 'error': f'{type(err).__name__}: {err}'}
+            print(f"{record['status']:>6}  {record['input']}  {record.get('wall_time_s', np.nan):.1f} s  "
+                  f"{record.get('peak_rss_mb', np.nan):.0f} MB  {record['error']}")
+            if metrics:
+                sink = preproc.JsonLinesSink(os.path.join(outdir, 'stage_metrics.jsonl'))
+                for stage_record in record.pop('stage_metrics', []):
+                    sink(stage_record)
+            records.append(record)
+    report = pd.DataFrame(records).sort_values('input').reset_index(drop=True)
+    report.drop(columns='traceback', errors='ignore').to_csv(os.path.join(outdir, 'batch_report.csv'), index=False)
+    return report
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-inputs',nargs='*',default=[],help='glob pattern(s) of .ds/.fif runs')
+    parser.add_argument('-manifest',help='text file with one input path per line')
+    parser.add_argument('-outdir',required=True,help='directory for the cleaned runs and batch_report.csv')
+    parser.add_argument('-jobs',type=int,default=None,help='number of worker processes (default: all cores)')
+    parser.add_argument('-chunked',action='store_true',help='use the bounded-memory process_run_chunked')
+    parser.add_argument('-chunk',type=float,default=60,help='chunk length in seconds for -chunked (default 60)')
+    parser.add_argument('-metrics',action='store_true',help='write per-stage metrics to stage_metrics.jsonl')
+    args = parser.parse_args()
+
+    try:
+        inputs = collect_inputs(args.inputs, args.manifest)
+    except ValueError as err:
+        raise SystemExit(str(err))
+    if not inputs:
+        raise SystemExit('no inputs given')
+    report = run_batch(inputs, args.outdir, jobs=args.jobs, chunked=args.chunked, chunk_duration=args.chunk, metrics=args.metrics)
+    print(report.drop(columns=['traceback','output'], errors='ignore').to_string(index=False))
+    n_failed = (report['status'] != 'ok').sum()
+    if n_failed:
+        print(f'{n_failed} of {len(report)} runs failed, see batch_report.csv')
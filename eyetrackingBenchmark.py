@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Runtime and memory benchmarks of the preprocessing stages.
+
+Every stage of process_run is timed on its own, on synthetic recordings
+(eyetrackingSynthetic) of several lengths and blink rates. The end-to-end
+process_run is timed as well. The inputs of a stage are prepared by running
+the chain up to it once, and are excluded from its time. The reported
+wall time is the best of -repeats runs. Peak memory is measured in one
+extra run with tracemalloc, which sees every numpy buffer. It is the
+largest amount of memory the stage allocated beyond its inputs.
+
+Each invocation appends one JSON record per (stage, length, blink rate) to
+a history file. Records carry the git commit, so the scaling of every stage
+can be followed across changes:
+
+    python eyetrackingBenchmark.py -lengths 300 3600 -blinks 5 40 -history bench/history.jsonl
+    python eyetrackingBenchmark.py -history bench/history.jsonl -plot bench/scaling.png -compare
+
+-plot draws wall time and peak memory against recording length, one curve
+per commit. -compare lists the cases that got slower than in the previous
+run of the history.
+"""
+
+import os, os.path as op, io, json, time, platform, subprocess, tracemalloc, contextlib
+import numpy as np
+import pandas as pd
+
+import eyetrackingPreprocess_template as preproc
+import eyetrackingSynthetic
+
+BENCH_LENGTHS_S = [300, 900, 3600, 14400]     # 5 min to 4 h
+BENCH_BLINK_RATES = [5, 20, 40]               # blinks per minute
+STAGES = ['crop_trailing_zeros', 'raw2df', 'remove_invalid_samples', 'madspeedfilter', 'mad_deviation',
+          'mad_deviation_incremental', 'remove_loners', 'expand_gap', 'remove_invalid_detrend', 'process_run']
+
+
+def bench_input(bench_dir, duration_s, blinks_per_min, sfreq=1200, seed=0):
+    '''Synthetic recording for one benchmark case; generated once and reused.'''
+    base = op.join(bench_dir, f'synth_{int(duration_s)}s_{blinks_per_min:g}bpm_{sfreq:g}Hz_seed{seed}')
+    if not op.exists(base+'_raw.fif'):
+        eyetrackingSynthetic.generate(base, duration_s=duration_s, sfreq=sfreq, blinks_per_min=blinks_per_min, seed=seed)
+        os.remove(base+'_uadc.npy')
+    return base+'_raw.fif'
+
+
+def stage_cases(raw_fname):
+    '''
+    {stage: (function, setup)} for one recording. setup() returns fresh
+    arguments for a call, so stages that modify their input can be repeated.
+    The pupil trace is copied for every use, since mad_deviation NaNs the
+    samples it is told are invalid; raw2df and the other stages leave their
+    arguments alone and share them.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        raw = preproc.load_raw_data(raw_fname)
+        ctx = preproc.PreprocessingContext(raw.info['sfreq'])
+        cropped = raw.copy()
+        preproc.crop_trailing_zeros(cropped, **ctx.params['crop_trailing_zeros'])
+        eyes = preproc.raw2df(cropped, geometry=ctx.geometry)
+        tv = eyes.index.to_numpy()/ctx.sfreq*1000
+        dia = np.array(eyes['pupil'], dtype=float)
+        on_screen = preproc.ValidityMask.from_mask(ctx.geometry.on_screen(eyes['x'], eyes['y']))
+        isvalid1 = preproc.remove_invalid_samples(eyes, tv, ctx)
+        isvalid2 = preproc.madspeedfilter(tv, dia.copy(), isvalid1, ctx)
+        isvalid3 = preproc.mad_deviation(tv, dia.copy(), isvalid2, ctx).to_mask()
+    channels = [eyes[c].to_numpy() for c in ('x', 'y', 'pupil')]
+
+    def detrend_all(*values):
+        return [preproc.remove_invalid_detrend(v, isvalid3, True) for v in values]
+
+    return {
+        'crop_trailing_zeros': (lambda r: preproc.crop_trailing_zeros(r, **ctx.params['crop_trailing_zeros']), lambda: (raw.copy(),)),
+        'raw2df': (lambda r: preproc.raw2df(r, geometry=ctx.geometry), lambda: (cropped,)),
+        'remove_invalid_samples': (preproc.remove_invalid_samples, lambda: (eyes, tv, ctx)),
+        'madspeedfilter': (preproc.madspeedfilter, lambda: (tv, dia.copy(), isvalid1, ctx)),
+        'mad_deviation': (preproc.mad_deviation, lambda: (tv, dia.copy(), isvalid2, ctx)),
+        'mad_deviation_incremental': (lambda *args: preproc.mad_deviation(*args, incremental=True),
+                                      lambda: (tv, dia.copy(), isvalid2, ctx)),
+        'remove_loners': (preproc.remove_loners, lambda: (on_screen, ctx)),
+        'expand_gap': (preproc.expand_gap, lambda: (tv, on_screen, ctx)),
+        'remove_invalid_detrend': (detrend_all, lambda: channels),
+        'process_run': (preproc.process_run, lambda: (raw_fname,)),
+    }
+
+
+def measure(func, setup, repeats=3):
+    '''Best wall time (s) of repeats calls, and the peak memory (MB) allocated by one more call.'''
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            args = setup()
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter()-start)
+        args = setup()
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(times), times, peak/1024**2
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=op.dirname(op.abspath(__file__)),
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_benchmarks(lengths=BENCH_LENGTHS_S, blink_rates=BENCH_BLINK_RATES, stages=STAGES, repeats=3,
+                   sfreq=1200, bench_dir='bench', history='bench/history.jsonl'):
+    '''
+    Benchmark the stages on every (length, blink rate) and append the
+    records to the history file (JSON lines). Returns the records.
+    '''
+    os.makedirs(bench_dir, exist_ok=True)
+    if op.dirname(history):
+        os.makedirs(op.dirname(history), exist_ok=True)
+    run = {'run_id': time.strftime('%Y%m%dT%H%M%S'), 'commit': _git_commit(), 'host': platform.node(),
+           'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+    records = []
+    for duration_s in lengths:
+        for blinks_per_min in blink_rates:
+            raw_fname = bench_input(bench_dir, duration_s, blinks_per_min, sfreq)
+            cases = stage_cases(raw_fname)
+            for stage in stages:
+                wall_s, all_s, peak_mb = measure(*cases[stage], repeats=repeats)
+                record = {**run, 'stage': stage, 'duration_s': duration_s, 'sfreq': sfreq,
+                          'n_samples': int(duration_s*sfreq), 'blinks_per_min': blinks_per_min,
+                          'wall_s': wall_s, 'wall_s_all': all_s, 'peak_mb': peak_mb, 'repeats': repeats}
+                records.append(record)
+                with open(history, 'a') as fid:
+                    fid.write(json.dumps(record)+'\n')
+                print(f'{stage:>24} {duration_s:>6}s {blinks_per_min:>4g} bpm: {wall_s*1000:9.1f} ms {peak_mb:8.1f} MB')
+    return records
+
+
+def load_history(history):
+    '''History file as a DataFrame, one row per record.'''
+    with open(history) as fid:
+        return pd.DataFrame([json.loads(line) for line in fid if line.strip()])
+
+
+def scaling_exponents(table):
+    '''
+    Slope of log(wall time) against log(length) per stage, blink rate and
+    run: 1 is linear, 2 quadratic.
+    '''
+    def slope(group):
+        group = group[group['wall_s'] > 0]
+        if group['n_samples'].nunique() < 2:
+            return np.nan
+        return np.polyfit(np.log(group['n_samples']), np.log(group['wall_s']), 1)[0]
+    return table.groupby(['run_id', 'stage', 'blinks_per_min']).apply(slope, include_groups=False).rename('exponent').reset_index()
+
+
+def compare_runs(table, tolerance=1.2):
+    '''
+    Cases of the latest run that are more than `tolerance` times slower than
+    in the run before it, with both times.
+    '''
+    runs = sorted(table['run_id'].unique())
+    if len(runs) < 2:
+        return pd.DataFrame()
+    keys = ['stage', 'duration_s', 'blinks_per_min', 'sfreq']
+    latest = table[table['run_id'] == runs[-1]].set_index(keys)
+    previous = table[table['run_id'] == runs[-2]].set_index(keys)
+    both = latest[['wall_s', 'commit']].join(previous[['wall_s', 'commit']], rsuffix='_previous', how='inner')
+    both['ratio'] = both['wall_s']/both['wall_s_previous']
+    return both[both['ratio'] > tolerance].reset_index()
+
+
+def plot_history(table, out_fname, blinks_per_min=None, last_runs=5):
+    '''Wall time and peak memory against recording length per stage, one curve per run (log-log).'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    blinks_per_min = table['blinks_per_min'].max() if blinks_per_min is None else blinks_per_min
+    table = table[(table['blinks_per_min'] == blinks_per_min) & table['run_id'].isin(sorted(table['run_id'].unique())[-last_runs:])]
+    stages = [s for s in STAGES if s in set(table['stage'])]
+    fig, axes = plt.subplots(2, len(stages), figsize=(3*len(stages), 6), squeeze=False, sharex=True)
+    for col, stage in enumerate(stages):
+        for run_id, group in table[table['stage'] == stage].groupby('run_id'):
+            group = group.sort_values('duration_s')
+            label = f"{group['commit'].iloc[0] or run_id}"
+            axes[0, col].loglog(group['duration_s']/60, group['wall_s'], 'o-', label=label)
+            axes[1, col].loglog(group['duration_s']/60, group['peak_mb'], 'o-', label=label)
+        axes[0, col].set_title(stage, fontsize=8)
+        axes[1, col].set_xlabel('recording (min)')
+    axes[0, 0].set_ylabel('wall time (s)')
+    axes[1, 0].set_ylabel('peak allocation (MB)')
+    axes[0, -1].legend(fontsize=6)
+    fig.suptitle(f'{blinks_per_min:g} blinks/min')
+    fig.tight_layout()
+    fig.savefig(out_fname, dpi=100)
+    plt.close(fig)
+    return out_fname
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-lengths',type=float,nargs='*',default=BENCH_LENGTHS_S,help='recording lengths in s (default 300 900 3600 14400)')
+    parser.add_argument('-blinks',type=float,nargs='*',default=BENCH_BLINK_RATES,help='blinks per minute (default 5 20 40)')
+    parser.add_argument('-stages',nargs='*',default=STAGES,choices=STAGES,help='stages to benchmark (default all)')
+    parser.add_argument('-repeats',type=int,default=3,help='timed calls per case; the best is kept (default 3)')
+    parser.add_argument('-sfreq',type=float,default=1200,help='sample rate of the synthetic recordings (default 1200)')
+    parser.add_argument('-benchdir',default='bench',help='directory for the synthetic recordings')
+    parser.add_argument('-history',default='bench/history.jsonl',help='JSON-lines history the records are appended to')
+    parser.add_argument('-plot',help='only plot the history to this image file')
+    parser.add_argument('-compare',action='store_true',help='only list the cases that got slower than in the previous run')
+    args = parser.parse_args()
+
+    if args.plot or args.compare:
+        table = load_history(args.history)
+        if args.plot:
+            print(plot_history(table, args.plot))
+        if args.compare:
+            slower = compare_runs(table)
+            print('no regressions' if slower.empty else slower.to_string(index=False))
+    else:
+        records = run_benchmarks([int(v) for v in args.lengths], args.blinks, args.stages, args.repeats,
+                                 args.sfreq, args.benchdir, args.history)
+        exponents = scaling_exponents(pd.DataFrame(records))
+        print(exponents.pivot_table(index='stage', columns='blinks_per_min', values='exponent').round(2).to_string())
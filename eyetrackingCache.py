@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+On-disk cache for preprocessed eye-tracking runs.
+
+Entries are content addressed: the key is a hash of the input data (every
+file of a .ds directory, or the .fif file) together with the full parameter
+set of the cleaning chain (PREPROCESSING_PARAMS: screen geometry, MAD
+multipliers, gap widths, number of passes, ...). Changing either the data or
+a parameter therefore gives a new entry instead of a stale result.
+
+Each entry is one uncompressed .npz holding the cleaned columns of the
+process_run dataframe and the ValidityMask intervals after each cleaning
+step. The cache is size bounded: when it grows past max_bytes the least
+recently used entries are deleted.
+
+    from eyetrackingCache import cached_process_run
+    eyes, masks = cached_process_run('S01_discretePositions_raw.fif')
+"""
+
+import os, json, hashlib, tempfile
+import numpy as np
+import pandas as pd
+
+import eyetrackingPreprocess_template as preproc
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'meg_eyetracking')
+# bump when a change to the cleaning code alters its output without changing PREPROCESSING_PARAMS
+CACHE_VERSION = 1
+
+
+class PreprocCache:
+    '''
+    Size-bounded LRU cache of preprocessing results.
+
+    Parameters
+    ----------
+    cache_dir : path str
+        Directory holding the entries; created if missing.
+    max_bytes : int
+        Total size above which least recently used entries are evicted.
+    '''
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=2*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_fname = os.path.join(cache_dir, 'file_digests.json')
+
+    # ------------------------------------------------------------------ keys
+    def _load_index(self):
+        try:
+            with open(self._index_fname) as fid:
+                return json.load(fid)
+        except (OSError, ValueError):
+            return {}
+
+    def file_digest(self, raw_fname):
+        '''
+        Content hash of a .fif file or of every file of a .ds directory. The
+        digest is remembered per path together with the files' sizes and
+        modification times, so unchanged inputs are not re-read.
+        '''
+        raw_fname = os.path.abspath(raw_fname)
+        if os.path.isdir(raw_fname):
+            fnames = sorted(os.path.join(root, f) for root, _, files in os.walk(raw_fname) for f in files)
+        else:
+            fnames = [raw_fname]
+        stamp = [[os.path.relpath(f, raw_fname) if f != raw_fname else '', os.stat(f).st_size, os.stat(f).st_mtime_ns]
+                 for f in fnames]
+        index = self._load_index()
+        if raw_fname in index and index[raw_fname]['stamp'] == stamp:
+            return index[raw_fname]['digest']
+
+        digest = hashlib.blake2b(digest_size=20)
+        for f, (name, _, _) in zip(fnames, stamp):
+            digest.update(name.encode())
+            with open(f, 'rb') as fid:
+                for block in iter(lambda: fid.read(8*1024**2), b''):
+                    digest.update(block)
+        index[raw_fname] = {'stamp': stamp, 'digest': digest.hexdigest()}
+        self._atomic_write(self._index_fname, lambda fid: fid.write(json.dumps(index).encode()))
+        return index[raw_fname]['digest']
+
+    def key(self, raw_fname, params=None):
+        '''Cache key for an input file and a parameter set (default: PREPROCESSING_PARAMS).'''
+        params = preproc.PREPROCESSING_PARAMS if params is None else params
+        payload = json.dumps({'input': self.file_digest(raw_fname), 'params': params,
+                              'version': CACHE_VERSION}, sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+    # --------------------------------------------------------------- entries
+    def _entry_fname(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def _atomic_write(self, fname, write):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                write(fid)
+            os.replace(tmp, fname)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get(self, key):
+        '''Return (eyes dataframe, dict of ValidityMask) or None on a miss.'''
+        fname = self._entry_fname(key)
+        try:
+            with np.load(fname) as entry:
+                columns = [str(c) for c in entry['columns']]
+                eyes = pd.DataFrame({c: entry[f'col_{c}'] for c in columns})
+                masks = {str(name): preproc.ValidityMask(entry[f'mask_{name}_starts'], entry[f'mask_{name}_ends'],
+                                                          int(entry[f'mask_{name}_n']))
+                         for name in entry['masks']}
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(fname)  # mark as recently used
+        return eyes, masks
+
+    def put(self, key, eyes, masks):
+        arrays = {'columns': np.array(eyes.columns, dtype=str), 'masks': np.array(list(masks), dtype=str)}
+        for c in eyes.columns:
+            arrays[f'col_{c}'] = eyes[c].to_numpy()
+        for name, mask in masks.items():
+            mask = preproc.ValidityMask.coerce(mask)
+            arrays[f'mask_{name}_starts'] = mask.starts
+            arrays[f'mask_{name}_ends'] = mask.ends
+            arrays[f'mask_{name}_n'] = np.array(mask.n_samples)
+        self._atomic_write(self._entry_fname(key), lambda fid: np.savez(fid, **arrays))
+        self.evict()
+
+    def evict(self):
+        '''Delete least recently used entries until the cache fits in max_bytes.'''
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npz'):
+                st = os.stat(os.path.join(self.cache_dir, f))
+                entries.append((st.st_mtime_ns, st.st_size, f))
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(os.path.join(self.cache_dir, f))
+            total -= size
+
+    def clear(self):
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npz'):
+                os.unlink(os.path.join(self.cache_dir, f))
+
+
+def cached_process_run(raw_fname, cache=None, transform=None):
+    '''
+    process_run with an on-disk cache. A fitted GazeTransform is part of the
+    key, so calibrated and uncalibrated results are cached side by side.
+
+    Returns
+    -------
+    eyes_preproc_meg : pandas.DataFrame
+        As returned by process_run.
+    masks : dict
+        ValidityMask after each cleaning step ('isvalid1', 'isvalid2', 'isvalid3')
+        and the padded blink intervals ('blinks').
+    '''
+    cache = PreprocCache() if cache is None else cache
+    params = None if transform is None else {**preproc.PREPROCESSING_PARAMS, 'transform': transform.to_dict()}
+    key = cache.key(raw_fname, params)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+    eyes, masks = preproc.process_run(raw_fname, return_masks=True, transform=transform)
+    cache.put(key, eyes, masks)
+    return eyes, masks
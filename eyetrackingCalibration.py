@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Calibration error per trial, ported from calibration_error.m.
+
+For every trial of the discrete-positions task, the cleaned gaze between the
+trial's trigger and 100 ms after the next trigger is split into fixations.
+Saccade samples are removed first: a sample is dropped if the gaze speed to
+the next sample exceeds 1.5 px/sample or its acceleration 1.1 px/sample^2
+(at 1200 Hz). A new fixation then starts wherever consecutive remaining
+samples jump more than 20 px in x or y. Fixations whose mean lies within
+10 px of the last fixation of the previous trial are dropped, since the subject is still looking at the
+old target. Fixations shorter than 100 ms are dropped as well. The error of
+a trial is the offset of its longest remaining fixation from the target.
+
+All trials are handled at once with array operations (no loop over trials or
+fixations), so a whole session takes milliseconds.
+
+    table = subject_calibration_error('S04_discretePositions_raw.fif',
+                                      'eyetracker/stimulus/results/S04_run1.csv')
+
+fit_transform/subject_transform use the same fixations to fit a
+least-squares volts-to-pixels GazeTransform per subject, which process_run
+and raw2df then use instead of the fixed volts_to_pixels constants. A fit
+whose gains stray more than 25% from those constants is refused.
+
+Differences from the MATLAB script: gaze comes from process_run (blinks and
+other invalid samples are NaN; coordinates are median-centred pixels with y
+pointing down), the targets are converted to the same frame by
+load_targets, and trials without any fixation get NaN instead of 0. The
+saccade thresholds are kept in px/s and px/s^2 so that other sample rates
+scale, and speed and acceleration are taken from the gaze low-passed at
+100 Hz: at the raw sample rate the white noise of the cleaned gaze alone
+exceeds 1.5 px/sample and would mask most fixation samples. The manual
+outlier deletion of the script (y < 70 px) is specific to one recording and
+is left out.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.signal import butter, filtfilt
+
+CALIBRATION_PARAMS = {
+    'saccade_speed_pix_s': 1.5*1200,  # calibration_error.m: v > 1.5 px/sample at 1200 Hz ...
+    'saccade_acceleration_pix_s2': 1.1*1200**2,  # ... or a > 1.1 px/sample^2 marks a saccade
+    'saccade_lowpass_hz': 100,   # speed and acceleration are taken from the gaze low-passed here (None: raw)
+    'jump_pix': 20,              # gaze step that starts a new fixation
+    'carry_over_pix': 10,        # fixations this close to the previous trial's last fixation are dropped
+    'min_fixation_ms': 100,      # shorter fixations are dropped
+    'window_extension_ms': 100,  # each trial extends this far past the next trigger
+    'last_trial_ms': (2-33/60)*1000,  # duration of the last trial (hard coded in calibration_error.m)
+    'max_gain_deviation': 0.25,  # fitted px/V gains further than this (relative) from the screen geometry are refused
+}
+
+
+def load_targets(results_csv):
+    '''
+    Target positions of a results CSV (PsychoPy pixels, y up, origin at the
+    screen centre) in the frame of process_run (y down).
+    '''
+    pos = pd.read_csv(results_csv)
+    return np.column_stack([pos['xPos'].to_numpy(dtype=float), -pos['yPos'].to_numpy(dtype=float)])
+
+
+def saccade_mask(x, y, sfreq, params=None):
+    '''
+    Samples that belong to saccades, as in calibration_error.m: sample i is
+    flagged when the step to sample i+1 is faster than saccade_speed_pix_s
+    or the second difference at i (samples i..i+2) exceeds
+    saccade_acceleration_pix_s2. Samples next to NaNs compare as False and
+    the last two samples are never flagged. With saccade_lowpass_hz, both
+    are computed on the gaze low-passed (zero phase, NaN gaps bridged
+    linearly) at that frequency.
+    '''
+    params = {**CALIBRATION_PARAMS, **(params or {})}
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    is_saccade = np.zeros(len(x), dtype=bool)
+    if len(x) < 3:
+        return is_saccade
+    if params['saccade_lowpass_hz'] is not None:
+        x, y = _lowpass(x, sfreq, params['saccade_lowpass_hz']), _lowpass(y, sfreq, params['saccade_lowpass_hz'])
+    vx, vy = np.diff(x), np.diff(y)
+    speed = np.hypot(vx, vy)*sfreq
+    acceleration = np.hypot(np.diff(vx), np.diff(vy))*sfreq**2
+    is_saccade[:-2] = (speed[:-1] > params['saccade_speed_pix_s']) | (acceleration > params['saccade_acceleration_pix_s2'])
+    return is_saccade
+
+
+def _lowpass(z, sfreq, cutoff):
+    # NaNs stay NaN; they are bridged linearly only so that the filter can run through them
+    is_nan = np.isnan(z)
+    if is_nan.all() or len(z) <= 15:
+        return z
+    samples = np.arange(len(z))
+    filled = np.interp(samples, samples[~is_nan], z[~is_nan])
+    b, a = butter(2, min(cutoff/(sfreq/2), 0.99))
+    smooth = filtfilt(b, a, filled)
+    smooth[is_nan] = np.nan
+    return smooth
+
+
+def remove_saccades(x, y, sfreq, params=None):
+    '''Copies of x, y with the saccade samples (saccade_mask) set to NaN.'''
+    is_saccade = saccade_mask(x, y, sfreq, params)
+    x, y = np.array(x, dtype=float), np.array(y, dtype=float)
+    x[is_saccade] = np.nan
+    y[is_saccade] = np.nan
+    return x, y
+
+
+def segment_fixations(x, y, onsets, sfreq, params=None, return_samples=False):
+    '''
+    Fixation segments of every trial.
+
+    Parameters
+    ----------
+    x, y : array
+        Gaze in pixels, NaN where invalid. Saccade samples are removed
+        here (remove_saccades).
+    onsets : array of int
+        Trigger sample of every trial.
+    sfreq : float
+        Sample rate in Hz.
+    params : dict
+        Overrides of CALIBRATION_PARAMS.
+    return_samples : bool
+        Also return the sample indices: the fixation in row f covers
+        samples[offset[f]:offset[f]+n_samples[f]] (valid, saccade-free
+        samples only).
+    Returns
+    -------
+    pandas.DataFrame
+        One row per fixation: trial, n_samples, duration_ms, x, y (mean
+        position), carry_over and too_short flags, kept, and offset.
+    '''
+    params = {**CALIBRATION_PARAMS, **(params or {})}
+    onsets = np.asarray(onsets, dtype=np.int64)
+    x, y = remove_saccades(x, y, sfreq, params)
+    n_trials = len(onsets)
+    # trial k covers [onset_k, onset_k+1 + extension], both ends included
+    ends = np.append(onsets[1:], onsets[-1]+int(params['last_trial_ms']*sfreq/1000))+int(params['window_extension_ms']*sfreq/1000)
+    ends = np.minimum(ends, len(x)-1)
+    lengths = np.maximum(ends-onsets+1, 0)
+
+    # sample indices of all trial windows, concatenated (windows overlap by the extension)
+    trial = np.repeat(np.arange(n_trials), lengths)
+    idx = np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths, lengths)+np.repeat(onsets, lengths)
+    keep = ~(np.isnan(x[idx]) | np.isnan(y[idx]))
+    trial, samples = trial[keep], idx[keep]
+    xs, ys = x[samples], y[samples]
+
+    # a fixation starts at each trial's first valid sample and after each jump
+    is_start = np.ones(len(trial), dtype=bool)
+    is_start[1:] = (trial[1:] != trial[:-1]) | (np.abs(np.diff(xs)) > params['jump_pix']) | (np.abs(np.diff(ys)) > params['jump_pix'])
+    starts = np.flatnonzero(is_start)
+    n_samples = np.diff(np.append(starts, len(trial)))
+    fixations = pd.DataFrame({'trial': trial[starts], 'n_samples': n_samples,
+                              'duration_ms': n_samples*1000/sfreq,
+                              'x': np.add.reduceat(xs, starts)/n_samples if len(starts) else np.empty(0),
+                              'y': np.add.reduceat(ys, starts)/n_samples if len(starts) else np.empty(0),
+                              'offset': starts})
+
+    # last fixation of each trial before any rejection, compared with the fixations of the next trial;
+    # a trial without valid samples leaves nothing to compare with (as with MATLAB's empty mean)
+    is_last = np.append(fixations['trial'].to_numpy()[1:] != fixations['trial'].to_numpy()[:-1], True)
+    last_xy = np.full((n_trials, 2), np.nan)
+    last_xy[fixations['trial'].to_numpy()[is_last]] = fixations[['x', 'y']].to_numpy()[is_last]
+    previous = np.vstack([np.full((1, 2), np.nan), last_xy[:-1]])[fixations['trial'].to_numpy()]
+    fixations['carry_over'] = np.hypot(*(fixations[['x', 'y']].to_numpy()-previous).T) < params['carry_over_pix']
+    fixations['too_short'] = fixations['n_samples'] < sfreq*params['min_fixation_ms']/1000
+    fixations['kept'] = ~(fixations['carry_over'] | fixations['too_short'])
+    return (fixations, samples) if return_samples else fixations
+
+
+def longest_fixations(fixations):
+    '''The longest kept fixation of every trial; the first one wins ties, as with MATLAB's max.'''
+    kept = fixations[fixations['kept']]
+    order = np.lexsort((np.arange(len(kept)), -kept['n_samples'].to_numpy(), kept['trial'].to_numpy()))
+    return kept.iloc[order].drop_duplicates('trial')
+
+
+def calibration_error(x, y, onsets, targets, sfreq, params=None):
+    '''
+    Per-trial calibration error.
+
+    Parameters
+    ----------
+    x, y : array
+        Gaze in pixels, NaN where invalid (e.g. process_run columns x, y).
+    onsets : array of int
+        Trigger sample of every trial (e.g. read_events(...)['onset_sample']).
+    targets : array, shape (n_trials, 2)
+        Target positions in the frame of x, y (see load_targets).
+    sfreq : float
+        Sample rate in Hz.
+    params : dict
+        Overrides of CALIBRATION_PARAMS.
+    Returns
+    -------
+    pandas.DataFrame
+        One row per trial: target_x/y, n_fixations (kept), fixation_ms,
+        fix_x/y (longest kept fixation), err_x/y and err_pix (Euclidean).
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    n_trials = len(onsets)
+    if len(targets) != n_trials:
+        raise ValueError(f'{n_trials} trials but {len(targets)} targets')
+    fixations = segment_fixations(x, y, onsets, sfreq, params)
+    kept = fixations[fixations['kept']]
+    longest = longest_fixations(fixations)
+    table = pd.DataFrame({'trial': np.arange(n_trials), 'target_x': targets[:, 0], 'target_y': targets[:, 1]})
+    table['n_fixations'] = np.bincount(kept['trial'], minlength=n_trials)
+    table = table.merge(longest[['trial', 'duration_ms', 'x', 'y']].rename(
+        columns={'duration_ms': 'fixation_ms', 'x': 'fix_x', 'y': 'fix_y'}), on='trial', how='left')
+    table['err_x'] = table['fix_x']-table['target_x']
+    table['err_y'] = table['fix_y']-table['target_y']
+    table['err_pix'] = np.hypot(table['err_x'], table['err_y'])
+    return table
+
+
+def transform_gains(transform, geometry):
+    '''
+    Local px/V gains (d x_pix/d x_volts, d y_pix/d y_volts) of a
+    GazeTransform at the voltages of the screen centre, to compare with
+    geometry._gain.
+    '''
+    centre = np.array(geometry.pix_to_volts(0., 0.))
+    step = 1e-3
+    x_pix = transform.apply(centre[[0, 0]]+[-step, step], centre[[1, 1]])[0]
+    y_pix = transform.apply(centre[[0, 0]], centre[[1, 1]]+[-step, step])[1]
+    return np.array([x_pix[1]-x_pix[0], y_pix[1]-y_pix[0]])/(2*step)
+
+
+def check_transform(transform, geometry, params=None):
+    '''
+    Raise ValueError if the gains of a fitted GazeTransform differ from the
+    screen geometry's volts_to_pixels gains by more than max_gain_deviation
+    (e.g. a fit pulled towards the centre by saccade samples).
+    '''
+    params = {**CALIBRATION_PARAMS, **(params or {})}
+    gains, expected = transform_gains(transform, geometry), np.asarray(geometry._gain)
+    deviation = np.abs(gains/expected-1)
+    if not (deviation <= params['max_gain_deviation']).all():
+        raise ValueError(f'fitted gains {gains[0]:.1f}/{gains[1]:.1f} px/V are more than '
+                         f"{params['max_gain_deviation']:.0%} off the screen geometry's "
+                         f'{expected[0]:.1f}/{expected[1]:.1f} px/V')
+    return gains
+
+
+def fit_transform(x_volts, y_volts, x, y, onsets, targets, sfreq, degree=1, outlier_factor=3., params=None,
+                  geometry=None):
+    '''
+    Fit a GazeTransform from the voltages to the target positions.
+
+    The samples used are those of the longest kept fixation of every trial
+    (found on the cleaned gaze x, y, as in calibration_error), each paired
+    with its trial's target, and both pixel coordinates are solved in one
+    least-squares problem. Trials whose fixation lies more than
+    outlier_factor times the median trial residual from the first fit
+    (subject looking elsewhere) are dropped and the fit is repeated.
+    Saccade samples never enter the fit (segment_fixations removes them),
+    which would otherwise pull the gains towards the centre. The result is
+    checked against geometry (default: that of PREPROCESSING_PARAMS) with
+    check_transform before it is returned.
+    '''
+    from eyetrackingPreprocess_template import GazeTransform, PREPROCESSING_PARAMS, ScreenGeometry
+
+    x_volts, y_volts = np.asarray(x_volts, dtype=float), np.asarray(y_volts, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    fixations, samples = segment_fixations(np.asarray(x, dtype=float), np.asarray(y, dtype=float), onsets, sfreq,
+                                           params, return_samples=True)
+    longest = longest_fixations(fixations)
+    n = longest['n_samples'].to_numpy()
+    if not len(n):
+        raise ValueError('no fixations to fit the calibration on')
+    # sample indices of the selected fixations, concatenated
+    pos = np.arange(n.sum())-np.repeat(np.cumsum(n)-n, n)+np.repeat(longest['offset'].to_numpy(), n)
+    idx, trial = samples[pos], np.repeat(longest['trial'].to_numpy(), n)
+
+    transform = GazeTransform.fit(x_volts[idx], y_volts[idx], targets[trial, 0], targets[trial, 1], degree)
+    if outlier_factor:
+        fx, fy = transform.apply(x_volts[idx], y_volts[idx])
+        sample_residual = np.hypot(fx-targets[trial, 0], fy-targets[trial, 1])
+        trial_residual = np.bincount(trial, sample_residual)/np.maximum(np.bincount(trial), 1)
+        is_inlier = (trial_residual <= outlier_factor*np.median(trial_residual[np.unique(trial)]))[trial]
+        transform = GazeTransform.fit(x_volts[idx[is_inlier]], y_volts[idx[is_inlier]],
+                                      targets[trial[is_inlier], 0], targets[trial[is_inlier], 1], degree)
+    check_transform(transform, ScreenGeometry.from_params(PREPROCESSING_PARAMS) if geometry is None else geometry,
+                    params)
+    return transform
+
+
+def subject_transform(raw_fname, results_csv, degree=1, cache=None):
+    '''
+    Fitted GazeTransform of one discrete-positions run, stored in the
+    preprocessing cache next to the cleaned runs and keyed on the data, the
+    target file, the degree, CALIBRATION_PARAMS and PREPROCESSING_PARAMS
+    (the fit uses the cleaned gaze).
+    '''
+    import json
+    from eyetrackingCache import PreprocCache, cached_process_run
+    from eyetrackingPreprocess_template import GazeTransform, PREPROCESSING_PARAMS, read_sfreq
+    from eyetrackingTriggers import read_events
+
+    cache = PreprocCache() if cache is None else cache
+    key = cache.key(raw_fname, {'calibration': CALIBRATION_PARAMS, 'degree': degree,
+                                'preprocessing': PREPROCESSING_PARAMS, 'targets': cache.file_digest(results_csv)})
+    fname = os.path.join(cache.cache_dir, f'transform_{key}.json')
+    if os.path.exists(fname):
+        with open(fname) as fid:
+            return GazeTransform.from_dict(json.load(fid))
+
+    targets = load_targets(results_csv)
+    eyes, _ = cached_process_run(raw_fname, cache)
+    onsets = read_events(raw_fname, expected=len(targets))['onset_sample'].to_numpy()
+    sfreq = read_sfreq(raw_fname)
+    transform = fit_transform(eyes['x_volts'], eyes['y_volts'], eyes['x'], eyes['y'], onsets, targets, sfreq, degree)
+    with open(fname, 'w') as fid:
+        json.dump(transform.to_dict(), fid)
+    return transform
+
+
+def subject_calibration_error(raw_fname, results_csv, params=None, transform=None):
+    '''
+    Calibration error of one discrete-positions run: cleaned gaze from
+    cached_process_run (optionally through a fitted GazeTransform), triggers
+    from read_events (checked against the number of targets).
+    '''
+    from eyetrackingCache import cached_process_run
+    from eyetrackingPreprocess_template import read_sfreq
+    from eyetrackingTriggers import read_events
+
+    targets = load_targets(results_csv)
+    eyes, _ = cached_process_run(raw_fname, transform=transform)
+    onsets = read_events(raw_fname, expected=len(targets))['onset_sample'].to_numpy()
+    sfreq = read_sfreq(raw_fname)
+    return calibration_error(eyes['x'].to_numpy(), eyes['y'].to_numpy(), onsets, targets, sfreq, params)
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-fname',nargs='+',required=True,help='discrete-positions run(s) (.ds or *_raw.fif)')
+    parser.add_argument('-csv',nargs='+',required=True,help='results CSV with the target positions, one per run')
+    parser.add_argument('-out',help='write the per-trial table of all runs to this CSV')
+    parser.add_argument('-fit',type=int,default=None,metavar='DEGREE',
+                        help='fit a volts-to-pixels calibration of this degree per run and report the error with it')
+    args = parser.parse_args()
+    if len(args.fname) != len(args.csv):
+        raise SystemExit('give one results CSV per run')
+
+    tables = []
+    for raw_fname, results_csv in zip(args.fname, args.csv):
+        transform = None if args.fit is None else subject_transform(raw_fname, results_csv, degree=args.fit)
+        table = subject_calibration_error(raw_fname, results_csv, transform=transform)
+        print(f'{os.path.basename(raw_fname)}: median error {table["err_pix"].median():.1f} px '
+              f'({table["err_pix"].isna().sum()} trials without fixation)')
+        tables.append(table.assign(fname=raw_fname))
+    tables = pd.concat(tables, ignore_index=True)
+    if args.out:
+        tables.to_csv(args.out, index=False)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Lightweight epoching of cleaned gaze arrays.
+
+EpochView cuts trials out of a (channels x time) array, e.g. the x/y columns
+of process_run, at the trigger onsets without copying any samples. Each
+trial, a time crop and a channel selection is a numpy view on the same
+buffer. A (trials x channels x time) array is a single strided view when the
+onsets are equally spaced. Otherwise it is gathered once with
+get_data(copy=True). Unlike mne.Epochs.get_data(), looping over trials does
+not copy the whole epoch array on every access.
+
+    epochs = EpochView(eyes[['x','y']].to_numpy().T, onsets, sfreq=1200, tmin=0, tmax=3, ch_names=['x','y'])
+    for trial in epochs.crop(tmax=1):
+        plt.plot(epochs.crop(tmax=1).times, trial[0])
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class EpochView:
+    '''
+    Trials of a continuous array as zero-copy views.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        Continuous data; it is referenced, never copied.
+    onsets : array of int
+        Sample index of time 0 of every trial (events[:,0] for a run whose
+        first sample is 0).
+    sfreq : float
+        Sample rate in Hz.
+    tmin, tmax : float
+        Trial window in seconds relative to the onset, both ends included
+        (as in mne.Epochs). Trials that do not fit in the data are dropped
+        and their indices kept in `dropped`.
+    ch_names : list of str
+        Channel names, for pick().
+    '''
+    def __init__(self, data, onsets, sfreq, tmin=0., tmax=3., ch_names=None):
+        self._data = np.asarray(data)
+        if self._data.ndim != 2:
+            raise ValueError(f'data must be (n_channels, n_times), got shape {self._data.shape}')
+        self.sfreq = float(sfreq)
+        self.ch_names = list(ch_names) if ch_names is not None else [str(i) for i in range(self._data.shape[0])]
+        self._picks = slice(0, self._data.shape[0])
+        self._first = int(round(tmin*self.sfreq))
+        self._n_times = int(round(tmax*self.sfreq))-self._first+1
+        onsets = np.asarray(onsets, dtype=np.int64)
+        fits = (onsets+self._first >= 0) & (onsets+self._first+self._n_times <= self._data.shape[1])
+        self.onsets = onsets[fits]
+        self.dropped = np.flatnonzero(~fits)
+
+    def _derive(self, picks=None, first=None, n_times=None, ch_names=None):
+        out = object.__new__(EpochView)
+        out.__dict__.update(self.__dict__)
+        out._picks = self._picks if picks is None else picks
+        out._first = self._first if first is None else first
+        out._n_times = self._n_times if n_times is None else n_times
+        out.ch_names = self.ch_names if ch_names is None else ch_names
+        return out
+
+    @property
+    def times(self):
+        return (self._first+np.arange(self._n_times))/self.sfreq
+
+    @property
+    def shape(self):
+        return (len(self.onsets), len(self.ch_names), self._n_times)
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def __getitem__(self, trial):
+        '''(channels x time) view of one trial.'''
+        start = self.onsets[trial]+self._first
+        return self._data[self._picks, start:start+self._n_times]
+
+    def __iter__(self):
+        for trial in range(len(self)):
+            yield self[trial]
+
+    def crop(self, tmin=None, tmax=None):
+        '''New EpochView restricted to [tmin, tmax] seconds (both included); no data is copied.'''
+        times = self.times
+        tmin = times[0] if tmin is None else tmin
+        tmax = times[-1] if tmax is None else tmax
+        keep = np.flatnonzero((times >= tmin-0.5/self.sfreq) & (times <= tmax+0.5/self.sfreq))
+        if not len(keep):
+            raise ValueError(f'no samples between {tmin} and {tmax} s')
+        return self._derive(first=self._first+int(keep[0]), n_times=len(keep))
+
+    def pick(self, ch_names):
+        '''
+        New EpochView with the given channels, in the given order. Selections
+        that are an evenly spaced run of channels (e.g. ['x','y']) stay views;
+        others are gathered per trial on access.
+        '''
+        rows = np.arange(self._data.shape[0])[self._picks]
+        idx = rows[[self.ch_names.index(ch) for ch in ch_names]]
+        step = idx[1]-idx[0] if len(idx) > 1 else 1
+        if step > 0 and np.all(np.diff(idx) == step):
+            picks = slice(int(idx[0]), int(idx[-1])+1, int(step))
+        else:
+            picks = idx
+        return self._derive(picks=picks, ch_names=list(ch_names))
+
+    def get_data(self, copy=False):
+        '''
+        (trials x channels x time) array. With copy=False this is a read-only
+        strided view on the continuous data, which requires equally spaced
+        onsets and a view channel selection; otherwise a ValueError asks for
+        copy=True, which gathers the trials into a new array once.
+        '''
+        if copy:
+            out = np.empty(self.shape, dtype=self._data.dtype)
+            for trial, view in enumerate(self):
+                out[trial] = view
+            return out
+        steps = np.diff(self.onsets)
+        if isinstance(self._picks, np.ndarray) or (len(steps) and np.any(steps != steps[0])):
+            raise ValueError('trials are not equally spaced (or channels are not a slice), '
+                             'so they cannot be a single view; use get_data(copy=True) or iterate over trials')
+        if not len(self):
+            return np.empty(self.shape, dtype=self._data.dtype)
+        first = self[0]
+        trial_stride = int(steps[0])*self._data.strides[1] if len(steps) else 0
+        return as_strided(first, shape=self.shape, strides=(trial_stride,)+first.strides, writeable=False)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+Fixation, saccade and blink detection on cleaned gaze, in degrees.
+
+This stage runs after the cleaning chain (mad_deviation and
+remove_invalid_detrend). Its input is the x_deg/y_deg columns of process_run,
+where invalid samples are NaN. Two algorithms are offered (Salvucci &
+Goldberg, 2000):
+
+ - I-VT (VelocityDetector): samples moving faster than velocity_threshold
+   deg/s are saccades, and the runs of slower samples between them are
+   fixations. Velocity is a central difference over velocity_window_ms,
+   which smooths the sample-to-sample noise of the 1200 Hz signal.
+ - I-DT (DispersionDetector): a fixation is a window of at least
+   min_fixation_ms whose dispersion (x range + y range) stays below
+   dispersion_threshold deg. It grows until the dispersion is exceeded. The
+   samples between fixations are saccades.
+
+In both, NaN samples form blinks. Fixations shorter than min_fixation_ms are
+dropped.
+
+The detectors can be fed the whole session at once or chunk by chunk. They
+carry what the next chunk needs: a few samples of context, the running
+extremes of an open fixation, and the open interval. The result is the same
+for any chunk size. Events are returned as (n, 2) arrays of half-open
+[start, stop) sample intervals per kind.
+
+    events = detect_events(eyes['x_deg'], eyes['y_deg'], sfreq=1200, method='ivt')
+    events['saccade']  # array([[start, stop], ...])
+"""
+
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+BLINK, FIXATION, SACCADE, UNCLASSIFIED = 0, 1, 2, 3
+EVENT_KINDS = {BLINK: 'blink', FIXATION: 'fixation', SACCADE: 'saccade'}
+
+
+class IntervalEncoder:
+    '''
+    Turns a stream of per-sample labels into closed [start, stop) intervals
+    per kind, keeping the open run across calls. Fixation runs shorter than
+    min_fixation samples are dropped.
+    '''
+    def __init__(self, min_fixation=0):
+        self.min_fixation = min_fixation
+        self.n_seen = 0
+        self._open = None  # (label, start)
+
+    def encode(self, labels, final=False):
+        labels = np.asarray(labels, dtype=np.int8)
+        start = self.n_seen
+        self.n_seen += len(labels)
+        if len(labels):
+            change = np.flatnonzero(labels[1:] != labels[:-1])+1
+            run_starts = np.concatenate([[0], change])+start
+            run_labels = labels[np.concatenate([[0], change])]
+            if self._open is not None and self._open[0] == run_labels[0]:
+                run_starts[0] = self._open[1]
+            elif self._open is not None:
+                run_starts = np.concatenate([[self._open[1]], run_starts])
+                run_labels = np.concatenate([[self._open[0]], run_labels])
+        elif self._open is not None:
+            run_starts, run_labels = np.array([self._open[1]]), np.array([self._open[0]])
+        else:
+            run_starts, run_labels = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8)
+        run_stops = np.concatenate([run_starts[1:], [self.n_seen]])
+        if not final and len(run_starts):
+            self._open = (run_labels[-1], run_starts[-1])
+            run_starts, run_stops, run_labels = run_starts[:-1], run_stops[:-1], run_labels[:-1]
+        else:
+            self._open = None
+
+        out = {}
+        for label, kind in EVENT_KINDS.items():
+            is_kind = run_labels == label
+            if label == FIXATION:
+                is_kind &= (run_stops-run_starts) >= self.min_fixation
+            out[kind] = np.column_stack([run_starts[is_kind], run_stops[is_kind]]).astype(np.int64)
+        return out
+
+
+class VelocityDetector:
+    '''
+    I-VT event detection.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sample rate in Hz.
+    velocity_threshold : float
+        Saccade threshold in deg/s.
+    velocity_window_ms : float
+        Span of the central difference used for the velocity.
+    min_fixation_ms : float
+        Shorter fixations are dropped.
+    '''
+    def __init__(self, sfreq, velocity_threshold=30., velocity_window_ms=20., min_fixation_ms=100.):
+        self.sfreq = float(sfreq)
+        self.velocity_threshold = velocity_threshold
+        self.half_window = max(1, int(round(velocity_window_ms*self.sfreq/2000)))
+        self.encoder = IntervalEncoder(int(round(min_fixation_ms*self.sfreq/1000)))
+        # NaN context before the first sample: no velocity there
+        self._tail = np.full((self.half_window, 2), np.nan)
+
+    def _labels(self, xy):
+        k = self.half_window
+        n = len(xy)-2*k
+        if n <= 0:
+            return np.empty(0, dtype=np.int8)
+        step = xy[2*k:]-xy[:-2*k]
+        velocity = np.hypot(step[:, 0], step[:, 1])*self.sfreq/(2*k)
+        centre = xy[k:k+n]
+        labels = np.full(n, FIXATION, dtype=np.int8)
+        labels[velocity > self.velocity_threshold] = SACCADE
+        labels[np.isnan(centre).any(axis=1)] = BLINK
+        return labels
+
+    def process(self, x, y):
+        '''Feed the next chunk (deg); return the intervals closed so far, per kind.'''
+        xy = np.concatenate([self._tail, np.column_stack([x, y]).astype(float)])
+        labels = self._labels(xy)
+        self._tail = xy[len(labels):]
+        return self.encoder.encode(labels)
+
+    def flush(self):
+        '''Decide the last samples (no velocity beyond the end) and close every interval.'''
+        xy = np.concatenate([self._tail, np.full((self.half_window, 2), np.nan)])
+        return self.encoder.encode(self._labels(xy), final=True)
+
+
+class DispersionDetector:
+    '''
+    I-DT event detection.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sample rate in Hz.
+    dispersion_threshold : float
+        Maximum x range + y range of a fixation in deg.
+    min_fixation_ms : float
+        Minimum fixation duration; also the initial window length.
+    '''
+    def __init__(self, sfreq, dispersion_threshold=1., min_fixation_ms=100.):
+        self.sfreq = float(sfreq)
+        self.dispersion_threshold = dispersion_threshold
+        self.window = max(1, int(round(min_fixation_ms*self.sfreq/1000)))
+        self.encoder = IntervalEncoder()
+        self._pending = np.empty((0, 2))
+        self._extremes = None  # (xmin, xmax, ymin, ymax) of the open fixation
+
+    def _window_dispersion(self, xy):
+        w = self.window
+        if len(xy) < w:
+            return np.empty(0)
+        # extremes of xy[s:s+w] for every start s; NaN inside a window makes it unusable
+        origin = -(w//2)
+        ranges = [maximum_filter1d(v, w, origin=origin)-minimum_filter1d(v, w, origin=origin) for v in np.nan_to_num(xy.T)]
+        n_nan = np.concatenate([[0], np.cumsum(np.isnan(xy).any(axis=1))])
+        dispersion = (ranges[0]+ranges[1])[:len(xy)-w+1]
+        dispersion[(n_nan[w:]-n_nan[:-w]) > 0] = np.inf
+        return dispersion
+
+    def _extend(self, xy, i):
+        '''Grow the open fixation from xy[i]; return the index where it ends (len(xy) if still open).'''
+        # scan in blocks of doubling length, so the cost is proportional to the fixation, not the chunk
+        block = self.window
+        while i < len(xy):
+            seg = xy[i:i+block]
+            xmin, xmax, ymin, ymax = self._extremes
+            run_xmin = np.minimum.accumulate(np.concatenate([[xmin], seg[:, 0]]))[1:]
+            run_xmax = np.maximum.accumulate(np.concatenate([[xmax], seg[:, 0]]))[1:]
+            run_ymin = np.minimum.accumulate(np.concatenate([[ymin], seg[:, 1]]))[1:]
+            run_ymax = np.maximum.accumulate(np.concatenate([[ymax], seg[:, 1]]))[1:]
+            too_wide = (run_xmax-run_xmin)+(run_ymax-run_ymin) > self.dispersion_threshold
+            stop = np.flatnonzero(too_wide | np.isnan(seg).any(axis=1))
+            if len(stop):
+                self._extremes = None
+                return i+stop[0]
+            self._extremes = (run_xmin[-1], run_xmax[-1], run_ymin[-1], run_ymax[-1])
+            i += len(seg)
+            block *= 2
+        return len(xy)
+
+    def _step(self, xy, final):
+        labels = np.empty(len(xy), dtype=np.int8)
+        candidates = np.flatnonzero(self._window_dispersion(xy) <= self.dispersion_threshold)
+        i = 0
+        while i < len(xy):
+            if self._extremes is not None:
+                j = self._extend(xy, i)
+                labels[i:j] = FIXATION
+                i = j
+                continue
+            # first window at or after i that is compact enough to start a fixation
+            next_candidate = np.searchsorted(candidates, i)
+            if next_candidate == len(candidates):
+                # the last window-1 samples may still start one in the next chunk
+                j = len(xy) if final else max(i, len(xy)-self.window+1)
+                labels[i:j] = np.where(np.isnan(xy[i:j]).any(axis=1), BLINK, SACCADE)
+                return labels[:j], j
+            s = candidates[next_candidate]
+            labels[i:s] = np.where(np.isnan(xy[i:s]).any(axis=1), BLINK, SACCADE)
+            window = xy[s:s+self.window]
+            self._extremes = (window[:, 0].min(), window[:, 0].max(), window[:, 1].min(), window[:, 1].max())
+            labels[s:s+self.window] = FIXATION
+            i = s+self.window
+        return labels, len(xy)
+
+    def process(self, x, y):
+        '''Feed the next chunk (deg); return the intervals closed so far, per kind.'''
+        xy = np.concatenate([self._pending, np.column_stack([x, y]).astype(float)])
+        labels, n_done = self._step(xy, final=False)
+        self._pending = xy[n_done:]
+        return self.encoder.encode(labels)
+
+    def flush(self):
+        labels, _ = self._step(self._pending, final=True)
+        self._pending = np.empty((0, 2))
+        return self.encoder.encode(labels, final=True)
+
+
+def detect_events(x_deg, y_deg, sfreq, method='ivt', chunk_samples=None, **detector_kw):
+    '''
+    Fixations, saccades and blinks of a whole session.
+
+    Parameters
+    ----------
+    x_deg, y_deg : array
+        Gaze in degrees, NaN where invalid (process_run columns x_deg, y_deg).
+    sfreq : float
+        Sample rate in Hz.
+    method : 'ivt' or 'idt'
+        VelocityDetector or DispersionDetector.
+    chunk_samples : int, optional
+        Feed the detector in chunks of this many samples (same result).
+    detector_kw
+        Thresholds of the detector.
+    Returns
+    -------
+    dict
+        'fixation', 'saccade', 'blink': (n, 2) int arrays of [start, stop)
+        sample intervals.
+    '''
+    detectors = {'ivt': VelocityDetector, 'idt': DispersionDetector}
+    if method not in detectors:
+        raise ValueError(f'method must be one of {list(detectors)}, got {method!r}')
+    detector = detectors[method](sfreq, **detector_kw)
+    x_deg, y_deg = np.asarray(x_deg, dtype=float), np.asarray(y_deg, dtype=float)
+    chunk_samples = max(len(x_deg), 1) if chunk_samples is None else chunk_samples
+    parts = [detector.process(x_deg[s:s+chunk_samples], y_deg[s:s+chunk_samples]) for s in range(0, len(x_deg), chunk_samples)]
+    parts.append(detector.flush())
+    return {kind: np.concatenate([p[kind] for p in parts]) for kind in EVENT_KINDS.values()}
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    import pandas as pd
+    from eyetrackingCache import cached_process_run
+    from eyetrackingPreprocess_template import read_sfreq
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-fname',required=True,help='path to MEG file with eyetracking')
+    parser.add_argument('-method',default='ivt',choices=['ivt','idt'])
+    parser.add_argument('-out',help='write the events (kind, start, stop, onset_ms, duration_ms) to this CSV')
+    args = parser.parse_args()
+
+    eyes, _ = cached_process_run(args.fname)
+    sfreq = read_sfreq(args.fname)
+    events = detect_events(eyes['x_deg'], eyes['y_deg'], sfreq, method=args.method)
+    table = pd.concat([pd.DataFrame({'kind': kind, 'start': iv[:, 0], 'stop': iv[:, 1]}) for kind, iv in events.items()])
+    table = table.sort_values('start', ignore_index=True)
+    table['onset_ms'] = table['start']*1000/sfreq
+    table['duration_ms'] = (table['stop']-table['start'])*1000/sfreq
+    for kind, iv in events.items():
+        print(f'{kind}: {len(iv)} events, median {np.median(np.diff(iv, axis=1))*1000/sfreq if len(iv) else np.nan:.0f} ms')
+    if args.out:
+        table.to_csv(args.out, index=False)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+Online (real-time) cleaning of the eye-tracking UADC channels.
+
+The offline pipeline in eyetrackingPreprocess_template.py needs the whole
+session (filtfilt, session medians, whole-run detrend). The functions here
+consume UADC009/010/013 samples block by block, as they would arrive from
+the MEG, and only use information from the past plus a short, bounded
+lookahead:
+ - centering and the MAD thresholds come from running medians over a
+   decimated history window instead of session medians
+ - the pupil baseline is a causal first-order Butterworth low-pass
+   (lfilter with carried state) instead of filtfilt
+ - gaps longer than min_gap_width_ms are padded pad_back_ms before and
+   pad_forward_ms after, as in expand_gap. Backward padding is what needs the
+   lookahead: samples are held back min_gap_width_ms+pad_back_ms before they are
+   emitted. Unlike expand_gap, gaps are padded without waiting to know
+   whether they end up longer than 2 s, and pads are not doubled for
+   artifact-length gaps.
+ - there is no detrend
+The thresholds themselves are PREPROCESSING_PARAMS (or the params of a
+PreprocessingContext), shared with the offline stages.
+
+ReplaySource plays an exported *_discretePositions_raw.fif back at its
+sampling rate (1200 Hz), so the pipeline can be run without a live MEG:
+
+    python eyetrackingOnline.py -fname S01_discretePositions_raw.fif -unit deg
+"""
+
+import time
+import numpy as np
+from scipy.signal import butter, lfilter, lfilter_zi
+
+from eyetrackingPreprocess_template import load_raw_data, PreprocessingContext
+
+
+class ReplaySource:
+    '''
+    Replay the eye channels of a recorded run block by block.
+
+    Parameters
+    ----------
+    raw_fname : path str
+        CTF .ds or exported *_raw.fif file.
+    block_ms : float
+        Block length in ms.
+    realtime : bool
+        Pace the blocks at the recording's sampling rate. With False blocks
+        are produced as fast as they can be consumed.
+    eye_channel : list
+        The x, y and pupil channels.
+    '''
+    def __init__(self, raw_fname, block_ms=10, realtime=True,
+                 eye_channel=['UADC009','UADC010','UADC013']):
+        raw_eyes = load_raw_data(raw_fname, eye_channel=eye_channel)
+        self.sfreq = raw_eyes.info['sfreq']
+        self.data = raw_eyes.get_data()
+        self.block_size = max(1, int(round(block_ms*self.sfreq/1000)))
+        self.realtime = realtime
+
+    def __iter__(self):
+        '''Yield (block, t_acquired): a (3, n) block in volts and the perf_counter time it became available.'''
+        t0 = time.perf_counter()
+        for start in range(0, self.data.shape[1], self.block_size):
+            stop = min(start+self.block_size, self.data.shape[1])
+            if self.realtime:
+                # the last sample of the block is "acquired" at stop/sfreq
+                t_due = t0 + stop/self.sfreq
+                while time.perf_counter() < t_due:
+                    time.sleep(max(0., min(t_due-time.perf_counter(), 1e-3)))
+            yield self.data[:, start:stop], time.perf_counter()
+
+
+class RunningMedian:
+    '''
+    Median and MAD over a sliding window of the most recent values, decimated
+    so that the window stays small (window_s*decimated_hz values).
+    '''
+    def __init__(self, sfreq, window_s=30, decimated_hz=20):
+        self.step = max(1, int(round(sfreq/decimated_hz)))
+        self.history = np.full(int(window_s*decimated_hz), np.nan)
+        self.n_seen = 0
+        self.n_stored = 0
+
+    def update(self, values):
+        values = values[~np.isnan(values)]
+        # keep every step-th value, counting across blocks
+        keep = values[(self.n_seen + np.arange(len(values))) % self.step == 0]
+        self.n_seen += len(values)
+        if not len(keep):
+            return
+        keep = keep[-len(self.history):]
+        self.history = np.roll(self.history, -len(keep))
+        self.history[-len(keep):] = keep
+        self.n_stored = min(self.n_stored+len(keep), len(self.history))
+
+    @property
+    def median(self):
+        return np.nanmedian(self.history) if self.n_stored else np.nan
+
+    @property
+    def mad(self):
+        return np.nanmedian(np.abs(self.history-self.median)) if self.n_stored else np.nan
+
+
+class OnlineGazeCleaner:
+    '''
+    Causal, block-wise version of the Kret et al. (2019) cleaning chain.
+
+    The thresholds are those of the offline stages, read from the context's
+    params: the mad_multiplier of madspeedfilter and of mad_deviation,
+    lowpass_cf of mad_deviation, and min_gap_width_ms, pad_back_ms and
+    pad_forward_ms of expand_gap.
+
+    Parameters
+    ----------
+    ctx : PreprocessingContext or float
+        Context of the run, or just the sampling rate of the incoming
+        samples (default PREPROCESSING_PARAMS).
+    unit : str
+        'pix' or 'deg' for the emitted x and y.
+    geometry : ScreenGeometry, optional
+        Screen and voltage range (default: ctx.geometry).
+    warmup_s : float
+        Seconds of history needed before the MAD criteria are applied.
+    '''
+    def __init__(self, ctx, unit='pix', geometry=None, warmup_s=1):
+        if unit not in ('pix', 'deg'):
+            raise ValueError(f'unit must be pix or deg, not {unit}')
+        ctx = PreprocessingContext.coerce(ctx)
+        sfreq = ctx.sfreq
+        gap_params = ctx.params['expand_gap']
+        self.sfreq = sfreq
+        self.unit = unit
+        self.geometry = ctx.geometry if geometry is None else geometry
+        self.speed_multiplier = ctx.params['madspeedfilter']['mad_multiplier']
+        self.deviation_multiplier = ctx.params['mad_deviation']['mad_multiplier']
+        self.min_gap = int(np.ceil(gap_params['min_gap_width_ms']*sfreq/1000))
+        self.pad_back = int(np.ceil(gap_params['pad_back_ms']*sfreq/1000))
+        self.pad_forward = int(np.ceil(gap_params['pad_forward_ms']*sfreq/1000))
+        self.delay = self.min_gap + self.pad_back
+        self.warmup = int(warmup_s*sfreq)
+        self.filt_b, self.filt_a = butter(1, ctx.params['mad_deviation']['lowpass_cf']/(sfreq/2))
+        self.filt_zi = None
+
+        self.centre = [RunningMedian(sfreq, window_s=60) for _ in range(3)]
+        self.speed_stats = RunningMedian(sfreq)
+        self.deviation_stats = RunningMedian(sfreq)
+
+        self.n_in = 0
+        self.n_out = 0
+        self.pending = np.empty((3, 0))
+        self.pending_valid = np.empty(0, dtype=bool)
+        self.last_pupil = np.nan
+        self.held_pupil = np.nan
+        self.gap_run = 0
+        self.forward_left = 0
+        self.latencies = []
+
+    @property
+    def lookahead_s(self):
+        '''Algorithmic delay between a sample arriving and it being emitted.'''
+        return self.delay/self.sfreq
+
+    def _threshold(self, stats, mad_multiplier):
+        if stats.n_seen < self.warmup:
+            return np.inf
+        return stats.median + mad_multiplier*stats.mad
+
+    def _raw_validity(self, x, y, pupil):
+        is_valid = self.geometry.on_screen(x, y)
+
+        # dilation speed in units per ms, as in madspeedfilter
+        speed = np.abs(np.diff(np.concatenate([[self.last_pupil], pupil])))*self.sfreq/1000
+        self.last_pupil = pupil[-1]
+        speed_ok = ~(speed >= self._threshold(self.speed_stats, self.speed_multiplier))
+        self.speed_stats.update(np.where(is_valid, speed, np.nan))
+        is_valid &= speed_ok
+
+        # deviation from a causal low-pass baseline; invalid samples hold the last valid value
+        held = np.where(is_valid, pupil, np.nan)
+        if np.isnan(held[0]):
+            held[0] = self.held_pupil
+        idx = np.where(~np.isnan(held), np.arange(len(held)), 0)
+        held = held[np.maximum.accumulate(idx)]
+        if not np.isnan(held[-1]):
+            self.held_pupil = held[-1]
+        held = np.where(np.isnan(held), pupil, held)
+        if self.filt_zi is None:
+            self.filt_zi = lfilter_zi(self.filt_b, self.filt_a)*held[0]
+        baseline, self.filt_zi = lfilter(self.filt_b, self.filt_a, held, zi=self.filt_zi)
+        deviation = np.abs(pupil-baseline)
+        deviation_ok = ~(deviation >= self._threshold(self.deviation_stats, self.deviation_multiplier))
+        self.deviation_stats.update(np.where(is_valid, deviation, np.nan))
+        return is_valid & deviation_ok
+
+    def _pad_gaps(self, is_valid):
+        '''Pad gaps of at least min_gap samples; returns the validity of pending+new samples.'''
+        n_pending = len(self.pending_valid)
+        invalid_runs = np.flatnonzero(np.diff(np.concatenate([[0], (~is_valid).view(np.int8), [0]])))
+        starts, ends = invalid_runs[::2], invalid_runs[1::2]
+        buffer_valid = np.concatenate([self.pending_valid, is_valid])
+
+        # a gap that reached the end of the previous block and stopped right at the block boundary
+        if self.gap_run and not (len(starts) and starts[0] == 0):
+            if self.gap_run >= self.min_gap:
+                self.forward_left = max(self.forward_left, self.pad_forward)
+            self.gap_run = 0
+
+        # forward padding still owed from a gap that ended in an earlier block
+        buffer_valid[n_pending:n_pending+self.forward_left] = False
+        self.forward_left = max(0, self.forward_left-len(is_valid))
+
+        for start, end in zip(starts, ends):
+            run_before = self.gap_run if start == 0 else 0
+            if run_before + end - start < self.min_gap:
+                continue
+            # the lookahead buffer is long enough to still hold these samples
+            buffer_valid[max(0, n_pending+start-run_before-self.pad_back):n_pending+start] = False
+            if end < len(is_valid):
+                buffer_valid[n_pending+end:n_pending+end+self.pad_forward] = False
+                self.forward_left = max(self.forward_left, self.pad_forward-(len(is_valid)-end))
+
+        if len(ends) and ends[-1] == len(is_valid):
+            self.gap_run = len(is_valid) - starts[-1] + (self.gap_run if starts[-1] == 0 else 0)
+        else:
+            self.gap_run = 0
+        return buffer_valid
+
+    def process(self, block, t_acquired=None):
+        '''
+        Clean one block of (3, n) UADC voltages (x, y, pupil).
+
+        Returns
+        -------
+        first_sample : int
+            Index (since the start of the stream) of the first emitted sample.
+        cleaned : array, shape (3, m)
+            x, y (in `unit`) and pupil of the samples that left the lookahead
+            buffer, NaN where invalid. m can be 0 while the buffer fills.
+        '''
+        t_acquired = time.perf_counter() if t_acquired is None else t_acquired
+        x, y = self.geometry.volts_to_pix(block[0], block[1])
+        gaze = np.vstack([x, y, block[2]])
+        for stats, values in zip(self.centre, gaze):
+            stats.update(values)
+        gaze -= np.array([[0 if np.isnan(s.median) else s.median] for s in self.centre])
+
+        is_valid = self._raw_validity(gaze[0], gaze[1], gaze[2])
+        buffer_valid = self._pad_gaps(is_valid)
+        buffer = np.hstack([self.pending, gaze])
+        self.n_in += block.shape[1]
+
+        out = self._emit(buffer, buffer_valid, max(0, buffer.shape[1]-self.delay))
+        self.latencies.append(time.perf_counter()-t_acquired)
+        return out
+
+    def flush(self):
+        '''
+        Emit the samples still held in the lookahead buffer once the stream
+        has ended, as (first_sample, cleaned) like process(). Their gap
+        padding has already been applied; padding owed to samples after the
+        end is dropped, and a gap running into the end is not padded, as in
+        expand_gap.
+        '''
+        out = self._emit(self.pending, self.pending_valid, self.pending.shape[1])
+        self.gap_run = 0
+        self.forward_left = 0
+        return out
+
+    def _emit(self, buffer, buffer_valid, n_emit):
+        # the first n_emit samples of the buffer leave it; the rest stays pending
+        cleaned = np.where(buffer_valid[:n_emit], buffer[:, :n_emit], np.nan)
+        self.pending, self.pending_valid = buffer[:, n_emit:], buffer_valid[n_emit:]
+        first_sample = self.n_out
+        self.n_out += n_emit
+        if self.unit == 'deg':
+            cleaned[:2] = self.geometry.pix_to_deg(cleaned[:2])
+        return first_sample, cleaned
+
+    def latency_summary(self):
+        '''Per-block processing latency in ms (median, 95th percentile, max) and the lookahead in ms.'''
+        latencies = np.asarray(self.latencies)*1000
+        return {'blocks': len(latencies),
+                'median_ms': float(np.median(latencies)) if len(latencies) else np.nan,
+                'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else np.nan,
+                'max_ms': float(latencies.max()) if len(latencies) else np.nan,
+                'lookahead_ms': self.lookahead_s*1000}
+
+
+def run_online(source, cleaner):
+    '''
+    Feed every block of source through cleaner and yield (first_sample,
+    cleaned); the lookahead buffer is flushed once the source is exhausted.
+    '''
+    for block, t_acquired in source:
+        yield cleaner.process(block, t_acquired)
+    yield cleaner.flush()
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-fname',help='exported *_raw.fif (or .ds) file to replay')
+    parser.add_argument('-unit',default='pix',choices=['pix','deg'],help='unit of the emitted gaze')
+    parser.add_argument('-block_ms',type=float,default=10,help='block length in ms')
+    parser.add_argument('-fast',action='store_true',help='replay as fast as possible instead of at the sampling rate')
+    args = parser.parse_args()
+
+    source = ReplaySource(args.fname, block_ms=args.block_ms, realtime=not args.fast)
+    cleaner = OnlineGazeCleaner(source.sfreq, unit=args.unit)
+    n_valid = 0
+    for first_sample, cleaned in run_online(source, cleaner):
+        n_valid += np.sum(~np.isnan(cleaned[0]))
+    print(f'{cleaner.n_out} samples emitted, {n_valid} valid')
+    print(cleaner.latency_summary())
@@ -11,40 +11,285 @@ Preprocessing functions (based on Kret et al., 2019)
  - removing invalid samples
  - removing based on dilation speeds
  - removing based on deviation from a fitted line
- - detrending
+ - detrending (detrend_channels: all channels in one masked least-squares solve, optionally robust or piecewise)
+ - process_run_chunked: the same pipeline walking the recording in chunks with bounded memory
  
 Helper functions 
+ - GazeTransform: least-squares fitted polynomial volts-to-pixels map, used by raw2df/process_run instead of volts_to_pixels when given
+ - read_ctf_channels: a few channels (or a sample range of them) straight from the memory-mapped .meg4 file(s)
+ - save_raw_chunks: writes a FIF file chunk by chunk with bounded memory
+ - ScreenGeometry: vectorized pixel/degree/volt conversions for one screen setup, shared by every stage
  - volts_to_pixels: converts voltages recorded by the MEG to pixels - (0,0) is the middle of the screen
  - deviation_calculator: fits a smooth line over the samples and checks how much each sample deviates from it 
  - expand_gap: this pads significanly large gaps (>75ms). Before the gap we padded 100ms, after the gap for 150ms (based on Matthias Nau pipeline in NSD paper)
+ - detect_blinks: blink intervals from the raw voltages (x or y below -4 V), padded 100ms before and 150ms after
  - remove_loners: see whether there are any chunks of data that are temporally isolated and relatively short. If yes, exclude them.
+ - ValidityMask: run-length encoded valid samples (start/end index intervals) that every cleaning stage consumes and returns
+ - PreprocessingContext: sample rate, screen geometry and thresholds of one run, passed explicitly to every stage
+ - StageTimer/timed_stage: per-stage wall time, validity counts and peak allocation sent to a metrics sink (MetricsCollector, JsonLinesSink); off by default
+ - IncrementalDeviation: deviation_calculator that only re-estimates the smooth line around samples whose validity changed (mad_deviation(..., incremental=True))
     
 """
 
 
 import pandas as pd 
 import numpy as np
-import math, mne
+import math, mne, os, copy, warnings, time, json, inspect, functools, tracemalloc
 from scipy import stats
 from scipy.signal import butter,filtfilt
 from scipy.interpolate import interp1d
-global screensize_pix
-screensize_pix=[1024, 768]
+# default parameters of the cleaning chain; every stage reads them through a
+# PreprocessingContext, and results cached by eyetrackingCache are keyed on them
+PREPROCESSING_PARAMS = {
+    'screensize_pix': [1024, 768], 'screenwidth_cm': 42, 'screendistance_cm': 75,
+    'volts_to_pixels': {'minvoltage': -5, 'maxvoltage': 5, 'minrange': -0.2, 'maxrange': 1.2},
+    'madspeedfilter': {'mad_multiplier': 16, 'max_gap_ms': 200},
+    'mad_deviation': {'mad_multiplier': 16, 'n_passes': 4, 'interp_fs': 100, 'lowpass_cf': 16},
+    'expand_gap': {'min_gap_width_ms': 75, 'max_gap_width_ms': 2000, 'pad_back_ms': 100,
+                   'pad_forward_ms': 150, 'artifact_gap_width_ms': 500},
+    'remove_loners': {'lonely_sample_max_length_ms': 100, 'time_separation_ms': 40},
+    'crop_trailing_zeros': {'n_zeros': 20},
+    'detect_blinks': {'threshold_volts': -4, 'pad_before_ms': 100, 'pad_after_ms': 150},
+    'detrend': True,
+    # robust: Huber IRLS line; segment_samples: one line per piece (see detrend_channels)
+    'detrend_options': {'robust': False, 'segment_samples': None},
+    # window_s None: one global median per channel (raw2df); otherwise a sliding median of that width
+    'drift': {'window_s': None, 'block_s': 0.5},
+}
+
+class PreprocessingContext:
+    '''
+    Everything the cleaning stages need to know about one run: its sample
+    rate, the screen geometry (a ScreenGeometry built once from the params)
+    and the stage thresholds. It is passed
+    explicitly to every stage instead of being read from module globals, so
+    runs with different sample rates can be cleaned concurrently (threads,
+    asyncio) and the stages can be called on their own.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sample rate of the eye-tracking channels in Hz.
+    params : dict
+        Parameters in the layout of PREPROCESSING_PARAMS (default). The
+        context keeps its own deep copy.
+    metrics : callable, optional
+        Sink for one dict per stage call (see StageTimer), e.g. a
+        MetricsCollector, a JsonLinesSink or print. None (default) disables
+        all instrumentation.
+    track_memory : bool
+        Also report the peak allocation of every stage (tracemalloc; slows
+        the stages down, and is process-wide, so one instrumented run at a time).
+    run : str, optional
+        Label copied into every record (process_run uses the file name).
+    '''
+    def __init__(self,sfreq,params=None,metrics=None,track_memory=False,run=None):
+        self.sfreq                                  = float(sfreq)
+        self.params                                 = copy.deepcopy(PREPROCESSING_PARAMS if params is None else params)
+        self.geometry                               = ScreenGeometry.from_params(self.params)
+        self.metrics                                = metrics
+        self.track_memory                           = track_memory
+        self.run                                    = run
+        self._stages                                = []
+
+    @classmethod
+    def coerce(cls,ctx):
+        '''Accept a PreprocessingContext or a bare sample rate (default parameters).'''
+        return ctx if isinstance(ctx,cls) else cls(ctx)
+
+    @property
+    def screensize_pix(self):
+        return self.params['screensize_pix']
+
+    @property
+    def screenwidth_cm(self):
+        return self.params['screenwidth_cm']
+
+    @property
+    def screendistance_cm(self):
+        return self.params['screendistance_cm']
+
+    def stage(self,name,is_valid=None):
+        '''Context manager timing one stage call (a no-op without a metrics sink).'''
+        return _NO_STAGE if self.metrics is None else StageTimer(self,name,is_valid)
+
+    def note(self,**fields):
+        '''Add fields (thresholds, pass counts, ...) to the record of the running stage.'''
+        if self._stages:
+            self._stages[-1].record.update(fields)
+
+    def report(self,name,**fields):
+        '''Send a record that was not timed with stage().'''
+        if self.metrics is not None:
+            self.metrics({'stage':name,'run':self.run,**fields})
+
+    def __repr__(self):
+        return f'PreprocessingContext(sfreq={self.sfreq:g})'
+
+# =============================================================================
+# Instrumentation
+# =============================================================================
+def _n_valid(is_valid):
+    return int(is_valid.n_valid) if isinstance(is_valid,ValidityMask) else int(np.count_nonzero(is_valid))
+
+class StageTimer:
+    '''
+    Times one stage call and sends its record to ctx.metrics on exit:
+    stage, run, parent (enclosing stage), wall_s, n_samples, n_valid_in,
+    n_valid_out, n_invalidated, peak_mb (with ctx.track_memory: the largest
+    allocation above what was in use when the stage started) and whatever
+    the stage added with ctx.note(). Failed calls are reported with their
+    error and re-raised.
+    '''
+    def __init__(self,ctx,name,is_valid=None):
+        self.ctx                                    = ctx
+        self.record                                 = {'stage':name,'run':ctx.run}
+        if ctx._stages:
+            self.record['parent']                   = ctx._stages[-1].record['stage']
+        if is_valid is not None:
+            self.record['n_samples']                = int(is_valid.n_samples) if isinstance(is_valid,ValidityMask) else len(is_valid)
+            self.record['n_valid_in']               = _n_valid(is_valid)
+
+    def set(self,**fields):
+        self.record.update(fields)
+
+    def valid_out(self,is_valid):
+        '''Record the validity a stage returned.'''
+        self.record['n_valid_out']                  = _n_valid(is_valid)
+        self.record.setdefault('n_samples',int(is_valid.n_samples) if isinstance(is_valid,ValidityMask) else len(is_valid))
+        self.record['n_invalidated']                = self.record.get('n_valid_in',self.record['n_samples'])-self.record['n_valid_out']
+
+    def __enter__(self):
+        stack                                       = self.ctx._stages
+        if self.ctx.track_memory:
+            self._owns_tracing                      = not tracemalloc.is_tracing()
+            if self._owns_tracing:
+                tracemalloc.start()
+            if stack:
+                # close the parent's peak so far before it is reset for this stage
+                stack[-1]._peak                     = max(stack[-1]._peak,tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._base                              = tracemalloc.get_traced_memory()[0]
+            self._peak                              = self._base
+        stack.append(self)
+        self._t0                                    = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.record['wall_s']                       = time.perf_counter()-self._t0
+        stack                                       = self.ctx._stages
+        stack.pop()
+        if self.ctx.track_memory:
+            peak                                    = max(self._peak,tracemalloc.get_traced_memory()[1])
+            self.record['peak_mb']                  = (peak-self._base)/1024**2
+            if stack:
+                stack[-1]._peak                     = max(stack[-1]._peak,peak)
+            tracemalloc.reset_peak()
+            if self._owns_tracing:
+                tracemalloc.stop()
+        if exc_type is not None:
+            self.record['error']                    = f'{exc_type.__name__}: {exc}'
+        self.ctx.metrics(self.record)
+        return False
+
+class _NoStage:
+    # what PreprocessingContext.stage returns when instrumentation is off
+    def __enter__(self):
+        return self
+    def __exit__(self,exc_type,exc,tb):
+        return False
+    def set(self,**fields):
+        pass
+    def valid_out(self,is_valid):
+        pass
+
+_NO_STAGE                                           = _NoStage()
+
+def timed_stage(name,returns_validity=True):
+    '''
+    Decorator for a cleaning stage that takes ctx (and optionally is_valid):
+    calls are timed with StageTimer when ctx has a metrics sink, and go
+    straight to the stage otherwise. With returns_validity the returned mask
+    gives n_valid_out and n_invalidated.
+    '''
+    def decorate(func):
+        names                                       = list(inspect.signature(func).parameters)
+        ctx_pos                                     = names.index('ctx')
+        valid_pos                                   = names.index('is_valid') if 'is_valid' in names else None
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            ctx                                     = args[ctx_pos] if len(args)>ctx_pos else kwargs.get('ctx')
+            if getattr(ctx,'metrics',None) is None:
+                return func(*args,**kwargs)
+            is_valid                                = None
+            if valid_pos is not None:
+                is_valid                            = args[valid_pos] if len(args)>valid_pos else kwargs.get('is_valid')
+            with ctx.stage(name,is_valid) as stage:
+                out                                 = func(*args,**kwargs)
+                if returns_validity:
+                    stage.valid_out(out)
+            return out
+        return wrapper
+    return decorate
+
+class MetricsCollector:
+    '''In-memory metrics sink: keeps every record, to_frame() gives a table.'''
+    def __init__(self):
+        self.records                                = []
+
+    def __call__(self,record):
+        self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records)
+
+def _json_value(value):
+    '''json.dumps default for numpy values: integers stay integers, arrays become lists.'''
+    if isinstance(value,np.integer):
+        return int(value)
+    if isinstance(value,np.floating):
+        return float(value)
+    if isinstance(value,np.bool_):
+        return bool(value)
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+class JsonLinesSink:
+    '''Metrics sink appending every record as one JSON line to fname.'''
+    def __init__(self,fname):
+        self.fname                                  = fname
+
+    def __call__(self,record):
+        with open(self.fname,'a') as fid:
+            fid.write(json.dumps(record,default=_json_value)+'\n')
 
 # =============================================================================
 # 
 # =============================================================================
-def load_raw_data(raw_fname=None, eye_channel=['UADC009','UADC010','UADC013']):
+def load_raw_data(raw_fname=None, eye_channel=['UADC009','UADC010','UADC013'],
+                  preload=True, memmap=True):
     '''
     Load data and return the eye tracking channels (iseyes=True) or 
     the trigger channel
     Parameters
     ----------
     raw_fname : path str, required
-        Path of CTF meg file ending in .ds
+        Path of CTF meg file ending in .ds, or of a converted *_raw.fif file
+        (see eyetracker/prep_code/Export_all_to_fif.py)
     eye_channel : list, optional
         Channel list of eye chans. 
         The default is ['UADC009','UADC010','UADC013'].
+    preload : bool, optional
+        Load the samples into memory. With False the data stay on disk and
+        can be read piecewise with raw.get_data(start=..., stop=...).
+        The default is True.
+    memmap : bool, optional
+        For preloaded .ds files, read only the requested channels straight
+        from the memory-mapped .meg4 file (see read_ctf_channels) instead of
+        letting mne parse and copy every MEG channel. The returned Raw then
+        carries a minimal info with just these channels.
+        The default is True.
     Returns
     -------
     mne.io.ctf.ctf.RawCTF
@@ -54,23 +299,173 @@ def load_raw_data(raw_fname=None, eye_channel=['UADC009','UADC010','UADC013']):
         raise ValueError('Must include a meg filename for raw_fname')
     print(f'loading file {raw_fname}')
 
-    raw = mne.io.read_raw_ctf(raw_fname,preload=False, system_clock='ignore',
-                              clean_names=True)   
-    raw_eyes= raw.copy().pick_channels(eye_channel)
-    raw_eyes.load_data()
+    if preload and memmap and str(raw_fname).rstrip('/').endswith('.ds'):
+        data, sfreq                                 = read_ctf_channels(raw_fname, eye_channel)
+        info                                        = mne.create_info(list(eye_channel), sfreq, 'misc')
+        return mne.io.RawArray(data, info, verbose=False)
+
+    if str(raw_fname).endswith('.fif'):
+        # exported channels keep their CTF suffix, e.g. UADC009-2104
+        raw = mne.io.read_raw_fif(raw_fname,preload=False)
+        eye_channel = [ch for want in eye_channel for ch in raw.ch_names if ch.split('-')[0]==want]
+    else:
+        raw = mne.io.read_raw_ctf(raw_fname,preload=False, system_clock='ignore',
+                                  clean_names=True)   
+    raw_eyes= raw.copy().pick_channels(eye_channel,ordered=True)
+    if preload:
+        raw_eyes.load_data()
 
     return raw_eyes
     
 
 
+def read_meg4_channels(meg4_fnames, n_chan, trial_samples, ch_idx, cals, start=0, stop=None):
+    '''
+    Read selected channels from CTF .meg4 files through a memory map.
+
+    A .meg4 file is an 8 byte header followed by trials of
+    (n_chan, trial_samples) big-endian int32 samples, so within a trial every
+    channel is one contiguous run. Indexing the memory map by channel only
+    touches the pages of those runs, and only the trials overlapping
+    [start, stop) are read.
+
+    Returns
+    -------
+    numpy.ndarray
+        Contiguous (len(ch_idx), n_samples) float64 array in physical units.
+    '''
+    header_size                                     = 8
+    meg4s                                           = []
+    for fname in meg4_fnames:
+        n_trials                                    = (os.path.getsize(fname)-header_size)//(4*n_chan*trial_samples)
+        if n_trials==0:
+            break
+        meg4s.append(np.memmap(fname, dtype='>i4', mode='r', offset=header_size,
+                               shape=(n_trials, n_chan, trial_samples)))
+    n_samples                                       = sum(len(meg4) for meg4 in meg4s)*trial_samples
+    stop                                            = n_samples if stop is None else min(stop, n_samples)
+    start                                           = min(start, stop)
+    first, last                                     = start//trial_samples, -(-stop//trial_samples)
+    data                                            = np.empty((len(ch_idx), last-first, trial_samples))
+    trial                                           = 0
+    for meg4 in meg4s:
+        # trials of this file that fall into [first, last)
+        lo, hi                                      = max(first-trial, 0), min(last-trial, len(meg4))
+        if lo<hi:
+            for i, (idx, cal) in enumerate(zip(ch_idx, cals)):
+                # strided view of one channel across trials, converted and scaled in one pass
+                np.multiply(meg4[lo:hi, idx, :], cal, out=data[i, trial+lo-first:trial+hi-first])
+        trial                                       += len(meg4)
+    offset                                          = first*trial_samples
+    return np.ascontiguousarray(data.reshape(len(ch_idx), -1)[:, start-offset:stop-offset])
+
+def read_ctf_channels(ds_dir, channels, start=0, stop=None):
+    '''
+    Fast path for loading a few channels (e.g. the UADC eye-tracking channels)
+    of a CTF dataset. Only the .res4 header is parsed; samples are taken from
+    the memory-mapped .meg4 file(s), so I/O scales with the number of
+    requested channels rather than with the ~300 MEG channels.
+
+    Parameters
+    ----------
+    ds_dir : path str
+        CTF dataset directory ending in .ds.
+    channels : list
+        Channel names, with or without the CTF suffix (UADC009 or UADC009-2104).
+    start, stop : int, optional
+        Sample range to read; the default is the whole recording. A range
+        past the end returns fewer (or no) samples.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        (len(channels), n_samples) samples, scaled like mne.io.read_raw_ctf.
+    sfreq : float
+        Sampling rate.
+    '''
+    res4                                            = read_ctf_header(ds_dir)
+    names                                           = [ch['ch_name'] for ch in res4['chs']]
+    clean                                           = [name.split('-')[0] for name in names]
+    ch_idx                                          = []
+    for want in channels:
+        if want in names:
+            ch_idx.append(names.index(want))
+        elif want in clean:
+            ch_idx.append(clean.index(want))
+        else:
+            raise ValueError(f'channel {want} not found in {ds_dir}')
+    cals                                            = [1.0/(res4['chs'][i]['proper_gain']*res4['chs'][i]['qgain']) for i in ch_idx]
+
+    # data larger than 2 GB continues in .1_meg4, .2_meg4, ...
+    base                                            = os.path.join(ds_dir, os.path.basename(os.path.normpath(ds_dir))[:-3])
+    meg4_fnames                                     = [base+'.meg4']
+    while os.path.exists(f'{base}.{len(meg4_fnames)}_meg4'):
+        meg4_fnames.append(f'{base}.{len(meg4_fnames)}_meg4')
+    data                                            = read_meg4_channels(meg4_fnames, res4['nchan'], res4['nsamp'], ch_idx, cals, start, stop)
+    return data, res4['sfreq']
+
+def read_ctf_header(ds_dir):
+    '''
+    Parsed .res4 header of a CTF dataset: channel list ('chs', with
+    'ch_name' and 'sensor_type_index'), 'nchan', 'nsamp' (samples per
+    trial) and 'sfreq'. This is the one place that relies on mne's CTF
+    header reader.
+    '''
+    from mne.io.ctf.res4 import _read_res4
+    return _read_res4(ds_dir)
+
+def read_sfreq(raw_fname):
+    '''Sample rate of a run (.ds or *_raw.fif) from its header, without reading any samples.'''
+    if str(raw_fname).rstrip('/').endswith('.ds'):
+        return float(read_ctf_header(raw_fname)['sfreq'])
+    return float(mne.io.read_info(raw_fname,verbose=False)['sfreq'])
+
+def ctf_misc_channels(ds_dir):
+    '''
+    Names of the channels mne.io.read_raw_ctf types as misc (the UADC
+    channels among them): everything that is not MEG, reference, EEG or stim.
+    '''
+    not_misc                                        = (0, 1, 5, 9, 11)   # CTF ref mag/grad, MEG, EEG, stim
+    return [ch['ch_name'] for ch in read_ctf_header(ds_dir)['chs'] if ch['sensor_type_index'] not in not_misc]
+
+def save_raw_chunks(out_fname, info, chunks, buffer_size_sec=60):
+    '''
+    Write (n_channels, n_samples) arrays from the iterable chunks, in order,
+    as one FIF file without holding more than one chunk in memory: each
+    chunk is saved as its own part and the parts are then concatenated
+    without preloading, which mne streams buffer_size_sec at a time.
+    Needs about twice the size of the output in temporary disk space.
+    '''
+    import shutil, tempfile
+    part_dir                                        = tempfile.mkdtemp(prefix='.parts_', dir=os.path.dirname(os.path.abspath(out_fname)))
+    try:
+        part_fnames                                 = []
+        for chunk in chunks:
+            if chunk.shape[1]==0:
+                continue
+            part_fnames.append(os.path.join(part_dir, f'part{len(part_fnames):05d}_raw.fif'))
+            mne.io.RawArray(chunk, info, verbose=False).save(part_fnames[-1], verbose=False)
+        if not part_fnames:
+            raise ValueError(f'no samples to write to {out_fname}')
+        parts                                       = [mne.io.read_raw_fif(fname, preload=False, verbose=False) for fname in part_fnames]
+        raw                                         = mne.concatenate_raws(parts, verbose=False)
+        # the parts are contiguous, so the boundary annotations of the concatenation do not apply
+        raw.set_annotations(None)
+        raw.save(out_fname, buffer_size_sec=buffer_size_sec, overwrite=True, verbose=False)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return out_fname
+
 def raw2df(raw_et, minvoltage=-5, maxvoltage=5, minrange=-0.2, maxrange=1.2,
            screenbottom=767, screenleft=0, screenright=1023, screentop=0, 
-           screensize_pix=screensize_pix):
+           screensize_pix=(1024, 768), transform=None, geometry=None):
     '''
     Convert the MEG data lines (volts) to pixels for x/y and return a pandas
     dataframe.
     
-    Median centering is performed on the data to reduce drift over the session
+    Median centering is performed on the data to reduce drift over the session,
+    unless a fitted GazeTransform is given: x/y then come from the transform
+    and keep their absolute position on the screen
     Parameters
     ----------
     raw_et : mne raw
@@ -93,36 +488,111 @@ def raw2df(raw_et, minvoltage=-5, maxvoltage=5, minrange=-0.2, maxrange=1.2,
         DESCRIPTION.
     screensize_pix : TYPE
         DESCRIPTION.
+    transform : GazeTransform, optional
+        Fitted volts-to-pixels map (see eyetrackingCalibration.subject_transform);
+        replaces volts_to_pixels and the median centering of x/y.
+    geometry : ScreenGeometry, optional
+        Replaces the voltage range and screen arguments above.
     Returns
     -------
     raw_et_df : TYPE
         DESCRIPTION.
     '''
     raw_et_df                                       = pd.DataFrame(raw_et._data.T,columns=['x_volts','y_volts','pupil'])
-    raw_et_df['x'],raw_et_df['y']                   = volts_to_pixels(raw_et_df['x_volts'],raw_et_df['y_volts'],raw_et_df['pupil'],minvoltage,maxvoltage,minrange,maxrange,screenbottom,screenleft,screenright,screentop,scaling_factor=978.982673828819)
-    raw_et_df['x']                                  = raw_et_df['x']-screensize_pix[0]/2
-    raw_et_df['x']                                  = raw_et_df['x']-np.median(raw_et_df['x'])
-    raw_et_df['y']                                  = raw_et_df['y']-screensize_pix[1]/2
-    raw_et_df['y']                                  = raw_et_df['y']-np.median(raw_et_df['y'])
+    if transform is not None:
+        raw_et_df['x'],raw_et_df['y']               = transform.apply(raw_et_df['x_volts'].to_numpy(),raw_et_df['y_volts'].to_numpy())
+        raw_et_df['pupil']                          = raw_et_df['pupil']-np.median(raw_et_df['pupil'])
+        raw_et_df['time']                           = raw_et.times
+        return raw_et_df
+    if geometry is None:
+        geometry                                    = ScreenGeometry((screenright-screenleft+1,screenbottom-screentop+1),
+                                                                     minvoltage=minvoltage,maxvoltage=maxvoltage,minrange=minrange,maxrange=maxrange)
+    x,y                                             = geometry.volts_to_pix(raw_et_df['x_volts'].to_numpy(),raw_et_df['y_volts'].to_numpy())
+    raw_et_df['x']                                  = x-np.median(x)
+    raw_et_df['y']                                  = y-np.median(y)
     raw_et_df['pupil']                              = raw_et_df['pupil']-np.median(raw_et_df['pupil'])
     raw_et_df['time']                               = raw_et.times
     return raw_et_df
 
 
+# Drift: a sliding-window median instead of the single global median of raw2df
+def rolling_median_drift(values,sfreq,window_s=60,block_s=0.5,is_excluded=None):
+    '''
+    Slow drift of a channel as a centred sliding median of width window_s.
+    The median is decimated: the signal is reduced to medians of block_s
+    blocks, a sliding median over those block medians (pandas' skiplist
+    rolling median, O(log w) per step) gives the drift at the block centres,
+    and it is interpolated linearly back to every sample. An hour at 1200 Hz
+    takes well under a second with the default 0.5 s blocks;
+    block_s=1/sfreq gives the exact sliding median at a much higher cost.
+
+    Parameters
+    ----------
+    values : array
+        One channel; NaN samples are ignored.
+    sfreq : float
+        Sample rate in Hz.
+    window_s, block_s : float
+        Width of the sliding median and of the decimation blocks in seconds.
+    is_excluded : ValidityMask or bool array, optional
+        Samples left out of the estimate (e.g. detect_blinks intervals).
+    Returns
+    -------
+    drift : array
+        Estimated drift at every sample (subtract it to correct).
+    '''
+    values                                          = np.array(values,dtype=float)
+    n                                               = len(values)
+    if is_excluded is not None:
+        values[ValidityMask.coerce(is_excluded).to_mask()] = np.nan
+    block                                           = max(1,int(round(block_s*sfreq)))
+    n_blocks                                        = -(-n//block)
+    padded                                          = np.full(n_blocks*block,np.nan)
+    padded[:n]                                      = values
+    with warnings.catch_warnings():
+        # blocks that are entirely NaN give NaN
+        warnings.simplefilter('ignore',RuntimeWarning)
+        block_median                                = np.nanmedian(padded.reshape(n_blocks,block),axis=1)
+    window                                          = max(1,int(round(window_s/block_s)))
+    drift_blocks                                    = pd.Series(block_median).rolling(window,center=True,min_periods=1).median().to_numpy()
+    is_known                                        = ~np.isnan(drift_blocks)
+    if not is_known.any():
+        return np.full(n,np.nan)
+    centres                                         = np.arange(n_blocks)*block+(block-1)/2
+    return np.interp(np.arange(n),centres[is_known],drift_blocks[is_known])
+
 # Step 1: We are removing all samples where x,y is outside of the screen
-def remove_invalid_samples(eyes,tv,screensize_pix=screensize_pix):
-    withinwidth                                     = np.abs(eyes['x'])<(screensize_pix[0]/2)
-    withinheight                                    = np.abs(eyes['y'])<(screensize_pix[1]/2)
-    is_valid                                        = np.array([x and y for x,y in zip(withinwidth,withinheight)]).astype(bool)
-    if not any(is_valid):
-        is_valid                                    = remove_loners(is_valid,et_refreshrate)
-        is_valid                                    = expand_gap(tv,is_valid)
+@timed_stage('remove_invalid_samples')
+def remove_invalid_samples(eyes,tv,ctx):
+    ctx                                             = PreprocessingContext.coerce(ctx)
+    is_valid                                        = ValidityMask.from_mask(ctx.geometry.on_screen(eyes['x'],eyes['y']))
+    if not is_valid.n_valid:
+        is_valid                                    = remove_loners(is_valid,ctx)
+        is_valid                                    = expand_gap(tv,is_valid,ctx)
 
-    return is_valid.astype(bool)
+    return is_valid
+
+# Blinks straight from the eye-tracker voltages (as in calibration_error.m): the EyeLink analog
+# output drops below -4 V on x or y while the eye is closed; blinks are padded 100ms before and 150ms after
+@timed_stage('detect_blinks',returns_validity=False)
+def detect_blinks(x_volts,y_volts,ctx):
+    ctx                                             = PreprocessingContext.coerce(ctx)
+    params                                          = ctx.params['detect_blinks']
+    x_volts,y_volts                                 = np.asarray(x_volts),np.asarray(y_volts)
+    is_blink                                        = ValidityMask.from_mask((x_volts<params['threshold_volts']) | (y_volts<params['threshold_volts']))
+    # padding is interval arithmetic on the blink bounds, O(number of blinks)
+    pad_before                                      = int(round(params['pad_before_ms']*ctx.sfreq/1000))
+    pad_after                                       = int(round(params['pad_after_ms']*ctx.sfreq/1000))
+    is_blink                                        = is_blink.dilate(pad_before,pad_after)
+    ctx.note(n_blinks=len(is_blink.starts),n_blink_samples=int(is_blink.n_valid))
+    return is_blink
 
 # Step 2: Checking how much the pupil dliation changes from timepoint to timepoint and exclude timepoints where the dilation change is large
-def madspeedfilter(tv,dia,is_valid):
-    max_gap                                     = 200
+@timed_stage('madspeedfilter')
+def madspeedfilter(tv,dia,is_valid,ctx):
+    ctx                                         = PreprocessingContext.coerce(ctx)
+    max_gap                                     = ctx.params['madspeedfilter']['max_gap_ms']
+    is_valid                                    = ValidityMask.coerce(is_valid).to_mask()
     dilation                                    = dia[is_valid]
     cur_tv                                      = tv[is_valid]
     cur_dia_speed                               = np.diff(dilation)/np.diff(cur_tv)
@@ -132,71 +602,167 @@ def madspeedfilter(tv,dia,is_valid):
     fwd_dilation                                = np.pad(cur_dia_speed,(0,1),constant_values=np.nan)
     back_fwd_dilation                           = np.vstack([back_dilation,fwd_dilation])
 
-    max_dilation_speed                          = np.empty_like(dia)
+    # samples that were already invalid carry no speed and must not enter the medians below
+    max_dilation_speed                          = np.full_like(dia,np.nan,dtype=float)
     max_dilation_speed[is_valid]                = np.nanmax(np.abs(back_fwd_dilation),axis=0)
-    max_dilation_speed
 
     mad                                         = np.nanmedian(np.abs(max_dilation_speed-np.nanmedian(max_dilation_speed)))
-    mad_multiplier                              = 16 # as defined in Kret et al., 2019
+    mad_multiplier                              = ctx.params['madspeedfilter']['mad_multiplier'] # 16 as defined in Kret et al., 2019
     if mad == 0: 
-        print('mad is 0, using dilation speed plus constant as threshold')
+        # mad is 0, using dilation speed plus constant as threshold
         threshold                               = np.nanmedian(max_dilation_speed)+mad_multiplier
     else:
         threshold                               = np.nanmedian(max_dilation_speed)+mad_multiplier*mad
-    print('threshold: ' + str(threshold))
-    
+    ctx.note(threshold=float(threshold),mad=float(mad))
 
-    valid_out                                   = np.array(is_valid.copy())
 
-    valid_out[max_dilation_speed>=threshold]    = False
-    valid_out                                   = remove_loners(valid_out.astype(bool),et_refreshrate)
-    valid_out                                   = expand_gap(tv,valid_out)
-    valid_out                                   = remove_loners(valid_out.astype(bool),et_refreshrate)
+    valid_out                                   = ValidityMask.from_mask(is_valid & ~(max_dilation_speed>=threshold))
+    valid_out                                   = remove_loners(valid_out,ctx)
+    valid_out                                   = expand_gap(tv,valid_out,ctx)
+    valid_out                                   = remove_loners(valid_out,ctx)
 
-    return valid_out.astype(bool)
+    return valid_out
 
 # Step 3: Fitting a smooth line and exclude samples that deviate from that fitted line
-def mad_deviation(tv,dia,is_valid):
-    n_passes                                    = 4
-    mad_multiplier                              = 16
-    interp_fs                                   = 100
-    lowpass_cf                                  = 16
+@timed_stage('mad_deviation')
+def mad_deviation(tv,dia,is_valid,ctx,incremental=False):
+    '''
+    With incremental=True, passes after the first only re-estimate the smooth
+    baseline around samples whose validity flipped (see IncrementalDeviation);
+    the residuals then match the full recomputation to within round-off. The
+    median and MAD of the residuals come from IncrementalDeviation's
+    histogram instead of a selection over the whole session, so the
+    thresholds match to about 1e-4 relative and only samples within that
+    distance of a threshold can be judged differently.
+    '''
+    ctx                                         = PreprocessingContext.coerce(ctx)
+    params                                      = ctx.params['mad_deviation']
+    n_passes                                    = params['n_passes']
+    mad_multiplier                              = params['mad_multiplier']
+    interp_fs                                   = params['interp_fs']
+    lowpass_cf                                  = params['lowpass_cf']
     [smooth_filt_b,smooth_filt_a]               = butter(1,lowpass_cf/(interp_fs/2))
     t_interp                                    = np.arange(tv[0],tv[-1],1000/lowpass_cf)
-    dia[~is_valid]                              = np.nan
-    is_valid_running                            = is_valid.copy()
-    residuals_per_pass                          = np.empty([len(is_valid),n_passes])
-    smooth_baseline_per_pass                    = np.empty([len(is_valid),n_passes])
+    is_valid                                    = ValidityMask.coerce(is_valid)
+    is_valid_dense                              = is_valid.to_mask()
+    dia[~is_valid_dense]                        = np.nan
+    is_valid_running                            = is_valid
+    deviation                                   = IncrementalDeviation(tv,dia,t_interp,smooth_filt_a,smooth_filt_b) if incremental else None
 
     is_done                                     = False
+    pass_s                                      = []
     for pass_id in range(n_passes):
         if is_done: 
             break
-        is_valid_start                          = is_valid_running.copy()
+        is_valid_start                          = is_valid_running
+        pass_start                              = time.perf_counter()
 
-        residuals_per_pass[:,pass_id], smooth_baseline_per_pass[:,pass_id] = deviation_calculator(tv,dia,[x and y for x, y in zip(is_valid_running, is_valid)],t_interp,smooth_filt_a,smooth_filt_b)
+        if deviation is not None:
+            residuals,_                             = deviation.update(is_valid_running & is_valid)
+        else:
+            residuals,_                             = deviation_calculator(tv,dia,(is_valid_running & is_valid).to_mask(),t_interp,smooth_filt_a,smooth_filt_b)
 
-        mad                                     = np.nanmedian(np.abs(residuals_per_pass[:,pass_id]-np.nanmedian(residuals_per_pass[:,pass_id])))
-        threshold                               = np.nanmedian(residuals_per_pass[:,pass_id])+mad_multiplier*mad
+        if deviation is not None:
+            median                              = deviation.histogram.median()
+            mad                                 = deviation.histogram.mad(median)
+        else:
+            median                              = np.nanmedian(residuals)
+            mad                                 = np.nanmedian(np.abs(residuals-median))
+        threshold                               = median+mad_multiplier*mad
 
-        is_valid_running                        = [x and y for x,y in zip((residuals_per_pass[:,pass_id] <= threshold), is_valid)]
-        is_valid_running                        = remove_loners(np.array(is_valid_running).astype(bool),et_refreshrate)
-        is_valid_running                        = expand_gap(tv,np.array(is_valid_running).astype(bool))
+        is_valid_running                        = ValidityMask.from_mask((residuals <= threshold) & is_valid_dense)
+        is_valid_running                        = remove_loners(is_valid_running,ctx)
+        is_valid_running                        = expand_gap(tv,is_valid_running,ctx)
         
-        if (pass_id>0 and np.all(is_valid_start==is_valid_running)):
+        if (pass_id>0 and is_valid_start==is_valid_running):
             is_done                             = True
+        pass_s.append(time.perf_counter()-pass_start)
+        ctx.note(n_passes=pass_id+1,converged=is_done,pass_s=pass_s)
     valid_out                                   = is_valid_running
-    return valid_out.astype(bool)
+    return valid_out
 
 
 # This is the last step of the preocessing, all invalid samples are removed and the data is detrended
-def remove_invalid_detrend(eyes_in,is_valid,isdetrend):
-    all_tp                                          = np.arange(len(eyes_in))
-    eyes_in[~is_valid]                              = np.nan
-    if isdetrend:
-        m, b, _, _, _                               = stats.linregress(all_tp[is_valid],eyes_in[is_valid])
-        eyes_in                                     = eyes_in - (m*all_tp + b)
-    return eyes_in
+def detrend_channels(data,is_valid,isdetrend=True,keep_mean=False,robust=False,segment_samples=None,out=None,huber_k=1.345,n_iter=10):
+    '''
+    Remove invalid samples and a linear trend from several channels at once.
+    The lines of all channels are found by one masked least-squares solve:
+    the moments of the valid samples are a single matrix product of the
+    (channels x samples) array with the [1, t] design, so the valid samples
+    are never gathered into a copy. The input is not modified.
+
+    Parameters
+    ----------
+    data : array, shape (n_channels, n_samples) or (n_samples,)
+        Channels to clean, e.g. x, y and pupil.
+    is_valid : ValidityMask or bool array
+        Samples used for the fit; all others are set to NaN in the output.
+    isdetrend : bool
+        Subtract the fitted trend (otherwise only invalid samples are removed).
+    keep_mean : bool or array of bool (one per channel)
+        Remove the slope only and keep the level of the channel (calibrated
+        positions).
+    robust : bool
+        Huber M-estimate of the line (IRLS, n_iter passes, tuning constant
+        huber_k in units of the MAD of the residuals) instead of ordinary
+        least squares, so that residual artifacts do not tilt the trend.
+    segment_samples : int or array of int, optional
+        Fit an independent line per piece: either a piece length or the
+        sample indices where new pieces start (e.g. the onsets of runs in a
+        concatenated recording).
+    out : array, optional
+        Output array of the shape of data; data itself may be passed to
+        detrend in place.
+    Returns
+    -------
+    out : array
+        Cleaned channels, float64, same shape as data.
+    '''
+    data                                            = np.asarray(data)
+    out                                             = np.array(data,dtype=float) if out is None else out
+    if out is not data:
+        out[...]                                    = data
+    channels                                        = out.reshape(-1,out.shape[-1])
+    n                                               = channels.shape[1]
+    is_valid                                        = is_valid.to_mask() if isinstance(is_valid,ValidityMask) else np.asarray(is_valid,dtype=bool)
+    keep_mean                                       = np.broadcast_to(keep_mean,len(channels))
+    if np.isscalar(segment_samples):
+        segment_samples                             = np.arange(0,n,int(segment_samples))
+    bounds                                          = np.unique(np.concatenate([[0],np.asarray(segment_samples if segment_samples is not None else [],dtype=np.int64),[n]]))
+
+    # zero the invalid samples so that they drop out of the products below
+    channels[:,~is_valid]                           = 0
+    trend                                           = np.empty(n)
+    tiny                                            = np.finfo(float).tiny
+    for start,stop in zip(bounds[:-1],bounds[1:]):
+        piece,valid                                 = channels[:,start:stop],is_valid[start:stop]
+        if not isdetrend or valid.sum()<2:
+            continue
+        # time centred on the valid samples keeps the normal equations well conditioned
+        t                                           = np.arange(start,stop,dtype=float)
+        t                                          -= t[valid].mean()
+        powers                                      = np.column_stack([np.ones_like(t),t,t*t])
+        weights                                     = valid[None].astype(float)
+        for _ in range(n_iter if robust else 1):
+            # weighted normal equations of every channel, solved in one call; the
+            # invalid samples are zero in piece and weights, so no copies are gathered
+            gram                                    = np.broadcast_to((weights@powers)[:,[[0,1],[1,2]]],(len(piece),2,2))
+            rhs                                     = (piece*weights if robust else piece)@powers[:,:2]
+            coef                                    = np.linalg.solve(gram,rhs[...,None])[...,0]
+            if robust:
+                residual                            = np.abs(piece-coef[:,:1]-coef[:,1:]*t)
+                scale                               = np.maximum(1.4826*np.median(residual[:,valid],axis=1,keepdims=True),tiny)
+                weights                             = np.where(valid,np.minimum(1,huber_k*scale/np.maximum(residual,tiny)),0)
+        for row,slope in zip(piece,coef[:,1]):
+            np.multiply(t,slope,out=trend[:stop-start])
+            row                                    -= trend[:stop-start]
+        piece[~keep_mean]                          -= coef[~keep_mean,:1]
+    channels[:,~is_valid]                           = np.nan
+    return out
+
+# single-channel form used by HackathonScript.py/test.py
+def remove_invalid_detrend(eyes_in,is_valid,isdetrend,keep_mean=False):
+    return detrend_channels(eyes_in,is_valid,isdetrend,keep_mean)
 
 
 ## Helper functions
@@ -207,14 +773,138 @@ def volts_to_pixels(x,y,pupil,minvoltage,maxvoltage,minrange,maxrange,screenbott
     Ygaze                                           = S_y*(screenbottom-screentop+1)+screentop
     return(Xgaze,Ygaze)
 
+class ScreenGeometry:
+    '''
+    Screen and eye-tracker geometry shared by every stage: screen size in
+    pixels and centimetres, viewing distance and the fixed UADC voltage
+    range of volts_to_pixels. The conversions work on whole arrays, keep
+    NaNs and return float32 for float32 input (float64 otherwise); their
+    constants are computed once in the constructor.
+
+    Pixels are in the frame of raw2df: origin at the screen centre, before
+    median centring. Degrees follow pix_to_deg, i.e. p pixels subtend
+    2*atan(p/2/distance) (a size centred on the line of sight).
+
+    Parameters
+    ----------
+    size_pix : (width, height)
+        Screen resolution.
+    width_cm, distance_cm : float
+        Physical screen width and viewing distance.
+    minvoltage, maxvoltage, minrange, maxrange : float
+        Voltage range and the screen fractions it maps to (volts_to_pixels).
+    '''
+    def __init__(self,size_pix=(1024,768),width_cm=42,distance_cm=75,minvoltage=-5,maxvoltage=5,minrange=-0.2,maxrange=1.2):
+        self.size_pix                               = tuple(int(v) for v in size_pix)
+        self.width_cm,self.distance_cm              = float(width_cm),float(distance_cm)
+        self.voltage_range                          = (float(minvoltage),float(maxvoltage),float(minrange),float(maxrange))
+        size                                        = np.array(self.size_pix,dtype=float)
+        # pix = volts*gain+offset, per axis
+        self._gain                                  = (maxrange-minrange)/(maxvoltage-minvoltage)*size
+        self._offset                                = (minrange-minvoltage*(maxrange-minrange)/(maxvoltage-minvoltage))*size-size/2
+        self._half_size                             = size/2
+        # deg = 2*atan(pix*_atan_scale) in degrees
+        self._atan_scale                            = width_cm/size[0]/2/distance_cm
+
+    @classmethod
+    def from_params(cls,params):
+        '''Geometry described by a PREPROCESSING_PARAMS-style dict.'''
+        return cls(params['screensize_pix'],params['screenwidth_cm'],params['screendistance_cm'],**params['volts_to_pixels'])
+
+    @staticmethod
+    def _float(values):
+        values                                      = np.asarray(values)
+        return values if values.dtype in (np.float32,np.float64) else values.astype(np.float64)
+
+    @property
+    def pix_per_cm(self):
+        return self.size_pix[0]/self.width_cm
+
+    def pix_to_deg(self,pix):
+        pix                                         = self._float(pix)
+        return np.rad2deg(2*np.arctan(pix*pix.dtype.type(self._atan_scale)))
+
+    def deg_to_pix(self,deg):
+        deg                                         = self._float(deg)
+        return np.tan(np.deg2rad(deg)/2)/deg.dtype.type(self._atan_scale)
+
+    def volts_to_pix(self,x_volts,y_volts):
+        '''Centred pixels (x, y) of the UADC voltages.'''
+        x_volts,y_volts                             = self._float(x_volts),self._float(y_volts)
+        return (x_volts*x_volts.dtype.type(self._gain[0])+x_volts.dtype.type(self._offset[0]),
+                y_volts*y_volts.dtype.type(self._gain[1])+y_volts.dtype.type(self._offset[1]))
+
+    def pix_to_volts(self,x,y):
+        x,y                                         = self._float(x),self._float(y)
+        return ((x-x.dtype.type(self._offset[0]))/x.dtype.type(self._gain[0]),
+                (y-y.dtype.type(self._offset[1]))/y.dtype.type(self._gain[1]))
+
+    def volts_to_deg(self,x_volts,y_volts):
+        return tuple(self.pix_to_deg(v) for v in self.volts_to_pix(x_volts,y_volts))
+
+    def deg_to_volts(self,x_deg,y_deg):
+        return self.pix_to_volts(self.deg_to_pix(x_deg),self.deg_to_pix(y_deg))
+
+    def on_screen(self,x,y):
+        '''True where centred pixels (x, y) fall inside the screen (NaN is off screen).'''
+        return (np.abs(np.asarray(x))<self._half_size[0]) & (np.abs(np.asarray(y))<self._half_size[1])
+
+    def __repr__(self):
+        return f'ScreenGeometry(size_pix={self.size_pix}, width_cm={self.width_cm:g}, distance_cm={self.distance_cm:g})'
+
+class GazeTransform:
+    '''
+    Polynomial map from the eye-tracker voltages (x_volts, y_volts) to screen
+    pixels in the frame of raw2df: origin at the screen centre, y pointing
+    down. It is fitted by least squares on fixations of known targets
+    (eyetrackingCalibration.fit_transform) and replaces the fixed
+    volts_to_pixels constants.
+
+    Parameters
+    ----------
+    coef : array, shape (n_terms, 2)
+        Coefficients of the terms x^i*y^j (i+j <= degree, see terms()) for
+        the x and y pixel coordinates.
+    degree : int
+        Polynomial degree (1 = affine).
+    '''
+    def __init__(self,coef,degree=1):
+        self.degree                                 = int(degree)
+        self.coef                                   = np.asarray(coef,dtype=float).reshape(len(self.terms(self.degree)),2)
+
+    @staticmethod
+    def terms(degree):
+        '''Exponents (i, j) of the monomials x^i*y^j up to total degree `degree`.'''
+        return [(i,total-i) for total in range(degree+1) for i in range(total,-1,-1)]
+
+    @classmethod
+    def design(cls,x_volts,y_volts,degree):
+        x_volts,y_volts                             = np.asarray(x_volts,dtype=float),np.asarray(y_volts,dtype=float)
+        return np.column_stack([x_volts**i*y_volts**j for i,j in cls.terms(degree)])
+
+    @classmethod
+    def fit(cls,x_volts,y_volts,x_pix,y_pix,degree=1):
+        '''Least-squares fit of both pixel coordinates at once (one lstsq with two right-hand sides).'''
+        coef,_,_,_                                  = np.linalg.lstsq(cls.design(x_volts,y_volts,degree),np.column_stack([x_pix,y_pix]),rcond=None)
+        return cls(coef,degree)
+
+    def apply(self,x_volts,y_volts):
+        pix                                         = self.design(x_volts,y_volts,self.degree)@self.coef
+        return pix[:,0],pix[:,1]
+
+    def to_dict(self):
+        return {'degree':self.degree,'coef':self.coef.tolist()}
+
+    @classmethod
+    def from_dict(cls,d):
+        return cls(d['coef'],d['degree'])
+
+    def __repr__(self):
+        return f'GazeTransform(degree={self.degree})'
+
 def deviation_calculator(tv,dia,is_valid,t_interp,smooth_filt_a,smooth_filt_b):
-    dia_valid                                       = dia[[x and y for x,y in zip(is_valid,~np.isnan(dia))]]
-    t_valid                                         = tv[[x and y for x,y in zip(is_valid,~np.isnan(dia))]]
-    interp_f_lin                                    = interp1d(t_valid,dia_valid,kind='linear',bounds_error=False)
-    interp_f_near                                   = interp1d(t_valid,dia_valid,kind='nearest',fill_value='extrapolate')
-    extrapolated                                    = interp_f_near(t_interp)
-    uniform_baseline                                = interp_f_lin(t_interp)
-    uniform_baseline[np.isnan(uniform_baseline)]    = extrapolated[np.isnan(uniform_baseline)]
+    is_usable                                       = np.asarray(is_valid,dtype=bool) & ~np.isnan(dia)
+    uniform_baseline                                = interpolate_baseline(tv[is_usable],dia[is_usable],t_interp)
     smooth_uniform_baseline                         = filtfilt(smooth_filt_b,smooth_filt_a,uniform_baseline)
     interp_f_baseline                               = interp1d(t_interp,smooth_uniform_baseline,kind='linear',bounds_error=False)
     smooth_baseline                                 = interp_f_baseline(tv)
@@ -222,115 +912,756 @@ def deviation_calculator(tv,dia,is_valid,t_interp,smooth_filt_a,smooth_filt_b):
 
     return(dev,smooth_baseline)
 
-def expand_gap(tv,is_valid):
-    min_gap_width                                   = 75
-    max_gap_width                                   = 2000
-    pad_back                                        = 100
-    pad_forward                                     = 150
-    valid_t                                         = tv[is_valid]
-    valid_idx                                       = np.where(is_valid)[0]
-    gaps                                            = np.diff(valid_t)
-
-    # Convert to samples 
-    for i in min_gap_width, max_gap_width, pad_back, pad_forward:
-        i/=et_refreshrate
-
-    needs_padding                                   = [x and y for x,y in zip(gaps>min_gap_width,gaps<max_gap_width)]
-    gap_start_t                                     = valid_t[np.pad(needs_padding,(0,1),constant_values=False)]
-    gap_end_t                                       = valid_t[np.pad(needs_padding,(1,0),constant_values=False)]
-
-    remove_idx = []
-    for i_start,i_end in zip(gap_start_t,gap_end_t):
-        # when the gap is super large, it's most likely a recording artifact (and not an eyeblink), so we should clean around it more
-        if i_end -i_start > 500:
-            pb                                      = pad_back * 2
-            pf                                      = pad_forward * 2
-        else:
-            pb                                      = pad_back
-            pf                                      = pad_forward
-        remove_idx.extend(np.where([x and y for x,y in zip(valid_t>(i_start-pb),valid_t<(i_end+pf))])[0])
-    remove_idx                                      = np.unique(remove_idx)
+def interpolate_baseline(t_valid,dia_valid,t_interp):
+    '''
+    Linearly interpolate the valid samples onto the uniform grid t_interp,
+    extrapolating with the nearest valid sample outside their time range.
+    '''
+    interp_f_lin                                    = interp1d(t_valid,dia_valid,kind='linear',bounds_error=False)
+    interp_f_near                                   = interp1d(t_valid,dia_valid,kind='nearest',fill_value='extrapolate')
+    extrapolated                                    = interp_f_near(t_interp)
+    uniform_baseline                                = interp_f_lin(t_interp)
+    uniform_baseline[np.isnan(uniform_baseline)]    = extrapolated[np.isnan(uniform_baseline)]
+    return uniform_baseline
 
-    if remove_idx.any():
-        is_valid[valid_idx[remove_idx]]             = False
-    return is_valid
+class IncrementalDeviation:
+    '''
+    deviation_calculator that keeps its intermediate results, so that later
+    mad_deviation passes only redo the work around samples whose validity
+    flipped since the previous pass.
 
-def remove_loners(is_valid,et_refreshrate):
-    lonely_sample_max_length                        = 100 #in ms
-    time_separation                                 = 40 #in ms
-    valid_idx                                       = np.where(is_valid)[0]
-    gap_start                                       = valid_idx[np.where(np.pad(np.diff(valid_idx),(0,1),constant_values=1)>1)]
-    gap_end                                         = valid_idx[np.where(np.pad(np.diff(valid_idx),(1,0),constant_values=1)>1)]
-    start_valid_idx                                 = [valid_idx[0]]
-    end_valid_idx                                   = [valid_idx[-1]]
-    valid_data_chunks                               = np.reshape(np.sort(np.concatenate([start_valid_idx,gap_start,gap_end,end_valid_idx])),[-1,2])
-    size_valid_data_chunks                          = np.diff(valid_data_chunks,axis=1)
-    size_idx                                        = np.where((size_valid_data_chunks/et_refreshrate*1000)<lonely_sample_max_length)[0]
-    separation                                      = np.squeeze(np.diff(np.reshape(np.sort(np.concatenate([gap_start,gap_end])),[-1,2]),axis=1))
-    if separation.shape == (): separation = [separation]
-    sep_idx                                         = np.where(np.pad([i>(time_separation*1/et_refreshrate) for i in separation],(1,0)))[0]
-    data_chunks_to_delete                           = valid_data_chunks[np.intersect1d(sep_idx,size_idx)]
-
-    valid_out                                       = is_valid.copy()
-    for i in data_chunks_to_delete:
-        valid_out[np.arange(i[0],i[1]+1)]           = 0
-
-    print('removed ' + str(is_valid.sum()-valid_out.sum()) + ' samples')
-    
-    return valid_out.astype(bool)
+    For every flipped interval the uniform baseline is re-interpolated between
+    the valid samples that bracket it. The smoothing filter is re-run on a
+    window padded by twice its support (the number of grid points after which
+    the filter's impulse response has decayed below `tol`), and only the inner
+    part of that window, where the window-edge transients have died out, is
+    written back. Smoothed baseline and residuals are then refreshed for the
+    samples covered by the rewritten grid points. Results match a full
+    deviation_calculator call to within `tol` relative to the signal range.
 
-def pix_to_deg(full_size_pix,screensize_pix=screensize_pix,screenwidth_cm=42,screendistance_cm=75):
-    pix_per_cm = screensize_pix[0]/screenwidth_cm
-    size_cm = full_size_pix/pix_per_cm
-    dva = math.atan(size_cm/2/screendistance_cm)*2
-    return np.rad2deg(dva)
+    The residuals are also kept in a log-binned StreamingHistogram
+    (`histogram`), of which only the bins of the refreshed samples are
+    updated, so that the median and MAD of the next mad_deviation pass do not
+    need a selection over the whole session. They are accurate to about one
+    bin width (1e-4 relative with the default n_bins).
 
-def crop_trailing_zeros(raw_eyes):
+    Parameters
+    ----------
+    tv : array
+        Sample times in ms.
+    dia : array
+        Pupil trace, NaN where the sample is unusable.
+    t_interp : array
+        Uniform grid the baseline is smoothed on.
+    smooth_filt_a, smooth_filt_b : array
+        Smoothing filter coefficients, as for deviation_calculator.
+    tol : float
+        Relative residual of the filter impulse response that is ignored.
+    n_bins : int
+        Number of bins of the residual histogram.
+    '''
+    def __init__(self,tv,dia,t_interp,smooth_filt_a,smooth_filt_b,tol=1e-12,n_bins=2**18):
+        self.tv                                     = tv
+        self.dia                                    = dia
+        self.t_interp                               = t_interp
+        self.smooth_filt_a                          = smooth_filt_a
+        self.smooth_filt_b                          = smooth_filt_b
+        self.is_finite                              = ValidityMask.from_mask(~np.isnan(dia))
+        pole                                        = np.max(np.abs(np.roots(smooth_filt_a))) if len(smooth_filt_a)>1 else 0
+        self.filter_support                         = 3*max(len(smooth_filt_a),len(smooth_filt_b))
+        if pole>0:
+            self.filter_support                     += int(np.ceil(np.log(tol)/np.log(pole)))
+        self.n_bins                                 = n_bins
+        self.is_usable                              = None
+
+    def full(self,is_valid):
+        '''Full recomputation, identical to deviation_calculator. Returns (dev, smooth_baseline).'''
+        self.is_usable                              = ValidityMask.coerce(is_valid) & self.is_finite
+        is_usable                                   = self.is_usable.to_mask()
+        self.uniform_baseline                       = interpolate_baseline(self.tv[is_usable],self.dia[is_usable],self.t_interp)
+        self.smooth_uniform_baseline                = filtfilt(self.smooth_filt_b,self.smooth_filt_a,self.uniform_baseline)
+        self.smooth_baseline                        = interp1d(self.t_interp,self.smooth_uniform_baseline,kind='linear',bounds_error=False)(self.tv)
+        self.dev                                    = np.abs(self.dia-self.smooth_baseline)
+        # residuals span a few decades around their median; the range leaves ample room on both sides
+        hi                                          = 10*np.nanmax(self.dev) if np.isfinite(self.dev).any() else 1.
+        self.histogram                              = StreamingHistogram(hi*1e-10,hi,self.n_bins,log=True)
+        self.histogram.add(self.dev)
+        return(self.dev,self.smooth_baseline)
+
+    def update(self,is_valid):
+        '''Recompute only around the samples whose usability changed. Returns (dev, smooth_baseline).'''
+        is_usable                                   = ValidityMask.coerce(is_valid) & self.is_finite
+        if self.is_usable is None or not is_usable.n_valid:
+            return self.full(is_valid)
+        flipped                                     = is_usable ^ self.is_usable
+        self.is_usable                              = is_usable
+        if not flipped.n_valid:
+            return(self.dev,self.smooth_baseline)
+
+        tv,t_interp,n_grid                          = self.tv,self.t_interp,len(self.t_interp)
+        # grid points between the unchanged usable samples that bracket each flipped interval
+        before                                      = is_usable.previous_valid(flipped.starts-1)
+        after                                       = is_usable.next_valid(flipped.ends)
+        g0                                          = np.where(before>=0,np.searchsorted(t_interp,tv[np.maximum(before,0)],side='left'),0)
+        g1                                          = np.where(after>=0,np.searchsorted(t_interp,tv[np.maximum(after,0)],side='right'),n_grid)
+        changed_grid                                = ValidityMask(g0,g1,n_grid)
+        support                                     = self.filter_support
+        filter_windows                              = changed_grid.dilate(2*support,2*support)
+        # when the windows cover most of the grid (e.g. after the first pass) one full pass is cheaper
+        if n_grid<=4*support or filter_windows.n_valid>n_grid//2:
+            return self.full(is_usable)
+
+        for w0,w1 in zip(changed_grid.starts,changed_grid.ends):
+            lo                                      = is_usable.previous_valid(np.searchsorted(tv,t_interp[w0],side='right')-1)
+            hi                                      = is_usable.next_valid(np.searchsorted(tv,t_interp[w1-1],side='left'))
+            lo                                      = 0 if lo<0 else int(lo)
+            hi                                      = len(tv) if hi<0 else int(hi)+1
+            local_usable                            = is_usable.to_mask(lo,hi)
+            self.uniform_baseline[w0:w1]            = interpolate_baseline(tv[lo:hi][local_usable],self.dia[lo:hi][local_usable],t_interp[w0:w1])
+
+        i0,i1                                       = filter_windows.starts,filter_windows.ends
+        o0                                          = np.where(i0>0,i0+support,0)
+        o1                                          = np.where(i1<n_grid,i1-support,n_grid)
+        # samples whose linear interpolation uses any of the rewritten grid points
+        k0,k1                                       = np.maximum(o0-1,0),np.minimum(o1+1,n_grid)
+        s0                                          = np.searchsorted(tv,t_interp[k0],side='left')
+        s1                                          = np.searchsorted(tv,t_interp[k1-1],side='right')
+        refreshed                                   = ValidityMask(s0,s1,len(tv)).indices()
+        self.histogram.remove(self.dev[refreshed])
+        for w in range(len(i0)):
+            smoothed                                = filtfilt(self.smooth_filt_b,self.smooth_filt_a,self.uniform_baseline[i0[w]:i1[w]])
+            self.smooth_uniform_baseline[o0[w]:o1[w]] = smoothed[o0[w]-i0[w]:o1[w]-i0[w]]
+            self.smooth_baseline[s0[w]:s1[w]]       = np.interp(tv[s0[w]:s1[w]],t_interp[k0[w]:k1[w]],self.smooth_uniform_baseline[k0[w]:k1[w]],left=np.nan,right=np.nan)
+            self.dev[s0[w]:s1[w]]                   = np.abs(self.dia[s0[w]:s1[w]]-self.smooth_baseline[s0[w]:s1[w]])
+        self.histogram.add(self.dev[refreshed])
+        return(self.dev,self.smooth_baseline)
+
+def span_mask(n_samples,first,last):
+    '''
+    Boolean mask of length n_samples that is True inside any of the half-open
+    index spans [first, last). Overlapping spans are merged by a running sum,
+    so the cost is linear in n_samples plus the number of spans.
+    '''
+    edges                                           = np.zeros(n_samples+1,dtype=np.int64)
+    np.add.at(edges,np.clip(first,0,n_samples),1)
+    np.add.at(edges,np.clip(last,0,n_samples),-1)
+    return np.cumsum(edges[:-1])>0
+
+class ValidityMask:
+    '''
+    Run-length encoded validity of a recording: the valid samples are the
+    union of the half-open index intervals [starts[i], ends[i]), kept sorted,
+    disjoint and non-adjacent. Set operations, dilation and length filtering
+    cost O(k) in the number of intervals k (plus a sort of the k bounds for
+    union), so the cleaning stages scale with the number of blinks rather
+    than with the number of samples. The dense boolean mask is only built
+    on demand with to_mask().
+
+    Parameters
+    ----------
+    starts : array of int
+        First sample of every valid interval.
+    ends : array of int
+        One past the last sample of every valid interval.
+    n_samples : int
+        Length of the recording.
+    '''
+    def __init__(self,starts,ends,n_samples):
+        self.n_samples                              = int(n_samples)
+        starts                                      = np.clip(np.asarray(starts,dtype=np.int64).ravel(),0,self.n_samples)
+        ends                                        = np.clip(np.asarray(ends,dtype=np.int64).ravel(),0,self.n_samples)
+        keep                                        = ends>starts
+        starts,ends                                 = starts[keep],ends[keep]
+        if len(starts)>1:
+            # sort, then merge every interval that overlaps or touches the running maximum end
+            order                                   = np.argsort(starts,kind='stable')
+            starts,ends                             = starts[order],np.maximum.accumulate(ends[order])
+            is_first                                = np.concatenate([[True],starts[1:]>ends[:-1]])
+            is_last                                 = np.concatenate([is_first[1:],[True]])
+            starts,ends                             = starts[is_first],ends[is_last]
+        self.starts                                 = starts
+        self.ends                                   = ends
+
+    @classmethod
+    def from_mask(cls,is_valid):
+        '''Run-length encode a dense boolean mask.'''
+        is_valid                                    = np.asarray(is_valid,dtype=bool)
+        edges                                       = np.diff(np.concatenate([[0],is_valid.view(np.int8),[0]]))
+        return cls(np.flatnonzero(edges==1),np.flatnonzero(edges==-1),len(is_valid))
+
+    @classmethod
+    def coerce(cls,is_valid):
+        '''Return is_valid unchanged if it already is a ValidityMask, otherwise encode it.'''
+        if isinstance(is_valid,cls):
+            return is_valid
+        return cls.from_mask(is_valid)
+
+    def to_mask(self,start=0,stop=None):
+        '''Materialise the dense boolean mask, optionally only for samples [start, stop).'''
+        stop                                        = self.n_samples if stop is None else stop
+        first                                       = np.searchsorted(self.ends,start,side='right')
+        last                                        = np.searchsorted(self.starts,stop,side='left')
+        return span_mask(stop-start,self.starts[first:last]-start,self.ends[first:last]-start)
+
+    def previous_valid(self,idx):
+        '''Last valid sample at or before each idx, -1 if there is none.'''
+        idx                                         = np.asarray(idx)
+        if not len(self.starts):
+            return np.full_like(idx,-1)
+        k                                           = np.searchsorted(self.starts,idx,side='right')-1
+        return np.where(k>=0,np.minimum(self.ends[np.maximum(k,0)]-1,idx),-1)
+
+    def next_valid(self,idx):
+        '''First valid sample at or after each idx, -1 if there is none.'''
+        idx                                         = np.asarray(idx)
+        if not len(self.starts):
+            return np.full_like(idx,-1)
+        k                                           = np.searchsorted(self.ends,idx,side='right')
+        return np.where(k<len(self.starts),np.maximum(self.starts[np.minimum(k,len(self.starts)-1)],idx),-1)
+
+    def indices(self):
+        '''Indices of the valid samples, built from the intervals in O(n_valid).'''
+        lengths                                     = self.lengths
+        return np.arange(lengths.sum())+np.repeat(self.starts-(np.cumsum(lengths)-lengths),lengths)
+
+    @property
+    def lengths(self):
+        return self.ends-self.starts
+
+    @property
+    def n_valid(self):
+        return int(self.lengths.sum())
+
+    def invert(self):
+        '''Intervals of invalid samples (the gaps, including leading and trailing ones).'''
+        return ValidityMask(np.concatenate([[0],self.ends]),np.concatenate([self.starts,[self.n_samples]]),self.n_samples)
+
+    def union(self,other):
+        other                                       = ValidityMask.coerce(other)
+        return ValidityMask(np.concatenate([self.starts,other.starts]),np.concatenate([self.ends,other.ends]),self.n_samples)
+
+    def intersection(self,other):
+        return self.invert().union(ValidityMask.coerce(other).invert()).invert()
+
+    def symmetric_difference(self,other):
+        '''Samples that are valid in exactly one of the two masks.'''
+        other                                       = ValidityMask.coerce(other)
+        return (self & ~other) | (other & ~self)
+
+    def dilate(self,before,after):
+        '''Grow every interval by `before` samples at its start and `after` samples at its end.'''
+        return ValidityMask(self.starts-np.asarray(before),self.ends+np.asarray(after),self.n_samples)
+
+    def to_table(self,sfreq):
+        '''Intervals as a dataframe: start, stop (samples, half open), onset_ms and duration_ms.'''
+        return pd.DataFrame({'start':self.starts,'stop':self.ends,'onset_ms':self.starts*1000/sfreq,
+                             'duration_ms':self.lengths*1000/sfreq})
+
+    @classmethod
+    def from_table(cls,table,n_samples):
+        return cls(table['start'].to_numpy(),table['stop'].to_numpy(),n_samples)
+
+    def drop_shorter(self,min_length):
+        '''Keep only the intervals that are at least min_length samples long.'''
+        keep                                        = self.lengths>=min_length
+        return ValidityMask(self.starts[keep],self.ends[keep],self.n_samples)
+
+    __invert__                                      = invert
+    __or__                                          = union
+    __and__                                         = intersection
+    __xor__                                         = symmetric_difference
+
+    def __eq__(self,other):
+        if not isinstance(other,ValidityMask):
+            return NotImplemented
+        return (self.n_samples==other.n_samples and np.array_equal(self.starts,other.starts)
+                and np.array_equal(self.ends,other.ends))
+
+    def __repr__(self):
+        return f'ValidityMask({len(self.starts)} intervals, {self.n_valid}/{self.n_samples} valid samples)'
+
+@timed_stage('expand_gap')
+def expand_gap(tv,is_valid,ctx):
+    ctx                                             = PreprocessingContext.coerce(ctx)
+    params                                          = ctx.params['expand_gap']
+    is_valid                                        = ValidityMask.coerce(is_valid)
+    # all widths are given in ms and converted to samples
+    ms_to_samples                                   = ctx.sfreq/1000
+    min_gap_width                                   = params['min_gap_width_ms']*ms_to_samples
+    max_gap_width                                   = params['max_gap_width_ms']*ms_to_samples
+    pad_back                                        = params['pad_back_ms']*ms_to_samples
+    pad_forward                                     = params['pad_forward_ms']*ms_to_samples
+    artifact_gap_width                              = params['artifact_gap_width_ms']*ms_to_samples
+
+    # a gap runs from the last valid sample of one interval to the first valid sample of the next
+    gap_start                                       = is_valid.ends[:-1]-1
+    gap_end                                         = is_valid.starts[1:]
+    gaps                                            = np.rint((tv[gap_end]-tv[gap_start])*ms_to_samples)
+    needs_padding                                   = (gaps>min_gap_width) & (gaps<max_gap_width)
+
+    # when the gap is super large, it's most likely a recording artifact (and not an eyeblink), so we should clean around it more
+    is_artifact                                     = gaps[needs_padding] > artifact_gap_width
+    pb                                              = np.where(is_artifact,pad_back*2,pad_back)
+    pf                                              = np.where(is_artifact,pad_forward*2,pad_forward)
+
+    # samples strictly inside (start-pb, end+pf) are removed
+    padded_gaps                                     = ValidityMask(np.floor(gap_start[needs_padding]-pb)+1,np.ceil(gap_end[needs_padding]+pf),is_valid.n_samples)
+    ctx.note(n_gaps_padded=int(needs_padding.sum()))
+    return is_valid & ~padded_gaps
+
+@timed_stage('remove_loners')
+def remove_loners(is_valid,ctx):
+    ctx                                             = PreprocessingContext.coerce(ctx)
+    et_refreshrate                                  = ctx.sfreq
+    lonely_sample_max_length                        = ctx.params['remove_loners']['lonely_sample_max_length_ms'] #in ms
+    time_separation                                 = ctx.params['remove_loners']['time_separation_ms'] #in ms
+    is_valid                                        = ValidityMask.coerce(is_valid)
+    size_valid_data_chunks                          = is_valid.lengths-1
+    is_short                                        = (size_valid_data_chunks/et_refreshrate*1000)<lonely_sample_max_length
+    # distance from the last sample of the previous chunk to the first of this one; the first chunk is never removed
+    separation                                      = is_valid.starts[1:]-(is_valid.ends[:-1]-1)
+    is_separated                                    = np.concatenate([[False],separation>(time_separation*1/et_refreshrate)])
+    to_delete                                       = is_short & is_separated
+
+    valid_out                                       = ValidityMask(is_valid.starts[~to_delete],is_valid.ends[~to_delete],is_valid.n_samples)
+    ctx.note(n_chunks_removed=int(to_delete.sum()))
+
+    return valid_out
+
+def pix_to_deg(full_size_pix,screensize_pix=(1024, 768),screenwidth_cm=42,screendistance_cm=75):
+    return ScreenGeometry(screensize_pix,screenwidth_cm,screendistance_cm).pix_to_deg(full_size_pix)
+
+def crop_trailing_zeros(raw_eyes,n_zeros=20):
     '''
     the index of 20 consecutive zeros is used as an identifier to a terminated run (when user hit "abort")
     '''
-    idx_crop = np.where((np.diff(np.convolve(np.ones(20),raw_eyes._data[2,:]==0)))==1)[0][0]
+    idx_crop = np.where((np.diff(np.convolve(np.ones(n_zeros),raw_eyes._data[2,:]==0)))==1)[0][0]
     raw_eyes.crop(0,idx_crop/raw_eyes.info['sfreq'])
 
 
 # Run preprocessing            
-def process_run(raw_fname):
+def process_run(raw_fname, return_masks=False, params=None, transform=None, metrics=None, track_memory=False):
+    '''
+    Load, clean and detrend one run. With return_masks=True also return a
+    dict with the ValidityMask after each cleaning step (isvalid1-3) and the
+    padded blink intervals found on the raw voltages ('blinks', see
+    detect_blinks; they are reported, not removed).
+    params overrides PREPROCESSING_PARAMS for this run only; no module state
+    is touched, so runs may be processed concurrently in threads.
+    A fitted GazeTransform replaces the fixed volts_to_pixels map; x/y are
+    then only detrended for drift and keep their calibrated level.
+    With params['drift']['window_s'] set, a sliding median (rolling_median_drift,
+    blinks excluded) is subtracted from x, y and pupil, and the estimated
+    drift is kept in the x_drift, y_drift and pupil_drift columns for QC.
+    metrics (a sink such as MetricsCollector or JsonLinesSink) receives one
+    record per stage call with its wall time and validity counts, and
+    track_memory adds the peak allocation (see StageTimer).
+    '''
     # load raw eye-tracking data from the MEG
+    t_load = time.perf_counter()
     raw_eyes = load_raw_data(raw_fname)
-    crop_trailing_zeros(raw_eyes)
+    ctx = PreprocessingContext(raw_eyes.info['sfreq'],params,metrics=metrics,track_memory=track_memory,run=str(raw_fname))
+    ctx.report('load_raw_data',wall_s=time.perf_counter()-t_load,n_samples=raw_eyes.n_times)
+    with ctx.stage('process_run') as run_stage:
+        with ctx.stage('crop_trailing_zeros') as stage:
+            stage.set(n_samples_in=raw_eyes.n_times)
+            crop_trailing_zeros(raw_eyes,**ctx.params['crop_trailing_zeros'])
+            stage.set(n_samples_out=raw_eyes.n_times)
 
+        # transform MNE-struct to pandas and change from volts to degrees (x,y) and area (pupil)
+        with ctx.stage('raw2df') as stage:
+            eyes = raw2df(raw_eyes,transform=transform,geometry=ctx.geometry)#_cut)
+            stage.set(n_samples=len(eyes))
+        blinks = detect_blinks(eyes['x_volts'],eyes['y_volts'],ctx)
 
-    global et_refreshrate
-    meg_refreshrate = et_refreshrate = raw_eyes.info['sfreq']
+        # sliding-median drift removal
+        if ctx.params['drift']['window_s']:
+            with ctx.stage('rolling_median_drift'):
+                for channel in ['x','y','pupil']:
+                    drift = rolling_median_drift(eyes[channel],ctx.sfreq,is_excluded=blinks,**ctx.params['drift'])
+                    if transform is not None and channel!='pupil':
+                        # calibrated positions keep their level
+                        drift = drift-np.median(drift)
+                    eyes[channel] = eyes[channel]-drift
+                    eyes[channel+'_drift'] = drift
 
-    # transform MNE-struct to pandas and change from volts to degrees (x,y) and area (pupil)
-    eyes = raw2df(raw_eyes)#_cut)
+        # Define parameters
+        tv=(eyes.index.to_numpy()*1/ctx.sfreq)*1000
+        dia = np.array(eyes['pupil'],dtype=float)
 
-    # Define parameters
-    tv=(eyes.index.to_numpy()*1/meg_refreshrate)*1000
-    dia = eyes['pupil'].copy().to_numpy()
+        # PREPROCESSING
+        isvalid1 = remove_invalid_samples(eyes,tv,ctx)
 
-    # PREPROCESSING
-    isvalid1 = remove_invalid_samples(eyes,tv,screensize_pix=screensize_pix)
-    
-    # speed dilation exclusion
-    isvalid2 = madspeedfilter(tv,dia,is_valid=isvalid1)
+        # speed dilation exclusion
+        isvalid2 = madspeedfilter(tv,dia,isvalid1,ctx)
 
-    # deviation from smooth line
-    isvalid3 = mad_deviation(tv,dia,isvalid2)
+        # deviation from smooth line
+        isvalid3_mask = mad_deviation(tv,dia,isvalid2,ctx)
+        isvalid3 = isvalid3_mask.to_mask()
 
-    # remove invalid and detrend
-    eyes_preproc_meg = eyes.copy()
-    eyes_preproc_meg['x'] = remove_invalid_detrend(eyes_preproc_meg['x'].to_numpy(),isvalid3,True)
+        # remove invalid and detrend
+        isdetrend = ctx.params['detrend']
+        eyes_preproc_meg = eyes.copy()
+        keep_mean = transform is not None
+        columns = ['x','y','pupil']
+        with ctx.stage('detrend_channels',isvalid3_mask) as stage:
+            cleaned = detrend_channels(eyes_preproc_meg[columns].to_numpy(dtype=float).T,isvalid3,isdetrend,keep_mean=[keep_mean,keep_mean,False],**ctx.params['detrend_options'])
+            stage.set(n_channels=len(columns))
+        for channel,values in zip(columns,cleaned):
+            eyes_preproc_meg[channel] = values
 
-    eyes_preproc_meg['x_deg'] = [pix_to_deg(i,screensize_pix=screensize_pix,screenwidth_cm=42,screendistance_cm=75) for i in eyes_preproc_meg['x']]
+        eyes_preproc_meg['x_deg'] = ctx.geometry.pix_to_deg(cleaned[0])
+        eyes_preproc_meg['y_deg'] = ctx.geometry.pix_to_deg(cleaned[1])
+        run_stage.valid_out(isvalid3_mask)
 
-    eyes_preproc_meg['y'] = remove_invalid_detrend(eyes_preproc_meg['y'].to_numpy(),isvalid3,True)
-    eyes_preproc_meg['y_deg'] = [pix_to_deg(i,screensize_pix=screensize_pix,screenwidth_cm=42,screendistance_cm=75) for i in eyes_preproc_meg['y']]
+    if return_masks:
+        return eyes_preproc_meg, {'isvalid1': isvalid1, 'isvalid2': isvalid2, 'isvalid3': isvalid3_mask, 'blinks': blinks}
+    return eyes_preproc_meg
 
-    eyes_preproc_meg['pupil'] = remove_invalid_detrend(eyes_preproc_meg['pupil'].to_numpy(),isvalid3,True)
 
-    return eyes_preproc_meg
+# =============================================================================
+# Chunked (bounded-memory) preprocessing
+# =============================================================================
+class StreamingHistogram:
+    '''
+    Fixed-size histogram for estimating the median and MAD of a quantity that
+    is produced chunk by chunk, so that the global Kret et al. thresholds can
+    be computed without holding the whole session in memory. Estimates are
+    accurate to within one bin width (about 1e-4 relative with log bins).
+
+    Parameters
+    ----------
+    lo, hi : float
+        Range covered by the bins. Values outside it are counted in an
+        under/overflow bin represented by the smallest/largest value seen.
+    n_bins : int
+        Number of bins.
+    log : bool
+        Use log-spaced bins (for non-negative quantities such as speeds and
+        residuals). Zeros fall into the underflow bin.
+    '''
+    def __init__(self,lo,hi,n_bins=2**18,log=False):
+        self.log                                    = log
+        self.lo,self.hi                             = (np.log10(lo),np.log10(hi)) if log else (lo,hi)
+        self.n_bins                                 = n_bins
+        self.counts                                 = np.zeros(n_bins+2,dtype=np.int64)
+        self.min,self.max                           = np.inf,-np.inf
+
+    def _to_axis(self,values):
+        if self.log:
+            with np.errstate(divide='ignore'):
+                return np.log10(values)
+        return values
+
+    def add(self,values):
+        values                                      = np.asarray(values,dtype=float)
+        values                                      = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.min,self.max                           = min(self.min,values.min()),max(self.max,values.max())
+        idx                                         = np.floor((self._to_axis(values)-self.lo)/(self.hi-self.lo)*self.n_bins).astype(np.int64)+1
+        self.counts                                 += np.bincount(np.clip(idx,0,self.n_bins+1),minlength=self.n_bins+2)
+
+    def remove(self,values):
+        '''
+        Take back values that were added before. The under/overflow bins keep
+        representing the smallest/largest value ever seen.
+        '''
+        values                                      = np.asarray(values,dtype=float)
+        values                                      = values[~np.isnan(values)]
+        if not len(values):
+            return
+        idx                                         = np.floor((self._to_axis(values)-self.lo)/(self.hi-self.lo)*self.n_bins).astype(np.int64)+1
+        self.counts                                 -= np.bincount(np.clip(idx,0,self.n_bins+1),minlength=self.n_bins+2)
+
+    def _bin_values(self):
+        centres                                     = self.lo+(np.arange(self.n_bins)+0.5)/self.n_bins*(self.hi-self.lo)
+        centres                                     = 10**centres if self.log else centres
+        return np.concatenate([[self.min],centres,[self.max]])
+
+    def median(self):
+        n                                           = self.counts.sum()
+        if not n:
+            return np.nan
+        cum                                         = np.cumsum(self.counts)
+        k                                           = np.searchsorted(cum,(n-1)/2,side='right')
+        if k==0 or k==self.n_bins+1:
+            return self._bin_values()[k]
+        # interpolate linearly within the bin
+        frac                                        = ((n-1)/2-(cum[k]-self.counts[k])+0.5)/self.counts[k]
+        left                                        = self.lo+(k-1)/self.n_bins*(self.hi-self.lo)
+        value                                       = left+frac/self.n_bins*(self.hi-self.lo)
+        return 10**value if self.log else value
+
+    def mad(self,median=None):
+        '''Median absolute deviation from `median` (default: the histogram median).'''
+        median                                      = self.median() if median is None else median
+        keep                                        = self.counts>0
+        if not keep.any():
+            return np.nan
+        deviation                                   = np.abs(self._bin_values()[keep]-median)
+        counts                                      = self.counts[keep]
+        order                                       = np.argsort(deviation)
+        cum                                         = np.cumsum(counts[order])
+        return deviation[order][np.searchsorted(cum,(cum[-1]-1)/2,side='right')]
+
+class UniformTimes:
+    '''
+    Stand-in for the tv vector (sample times in ms) of a uniformly sampled
+    run that computes the requested entries instead of storing all of them.
+    '''
+    def __init__(self,n_samples,sfreq):
+        self.n_samples                              = n_samples
+        self.sfreq                                  = sfreq
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self,idx):
+        if isinstance(idx,slice):
+            idx                                     = np.arange(*idx.indices(self.n_samples))
+        return np.asarray(idx)*1000/self.sfreq
+
+def iter_chunks(raw_eyes,n_samples,chunk_samples):
+    '''Yield (start, stop, data) for consecutive chunks of the first n_samples of raw_eyes.'''
+    for start in range(0,n_samples,chunk_samples):
+        stop                                        = min(start+chunk_samples,n_samples)
+        yield start,stop,raw_eyes.get_data(start=start,stop=stop)
+
+def find_crop_index(raw_eyes,chunk_samples,n_zeros=20):
+    '''
+    Streaming version of the crop point used by crop_trailing_zeros: the last
+    sample to keep, or the last sample of the run if the pupil channel never
+    drops to zero.
+    '''
+    window                                          = n_zeros
+    carry                                           = np.zeros(window,dtype=bool)
+    for start,stop,data in iter_chunks(raw_eyes,raw_eyes.n_times,chunk_samples):
+        is_zero                                     = np.concatenate([carry,data[2,:]==0])
+        # same condition as np.diff(np.convolve(np.ones(20),is_zero))==1: a zero enters the 20-sample window while a non-zero leaves it
+        hits                                        = np.flatnonzero(is_zero[window:] & ~is_zero[:-window])
+        if len(hits):
+            return start+hits[0]-1
+        carry                                       = is_zero[-window:]
+    return raw_eyes.n_times-1
+
+def process_run_chunked(raw_fname, out_fname, chunk_duration=60, params=None, transform=None, metrics=None):
+    '''
+    Bounded-memory variant of process_run. The recording is never loaded as a
+    whole: every stage walks the file in chunks of chunk_duration seconds and
+    carries forward only what the next chunk needs.
+
+    - validity is kept as a ValidityMask (O(number of blinks)), so
+      remove_loners and expand_gap run on the whole session at once
+    - session medians (raw2df centering) and the MAD thresholds of
+      madspeedfilter and mad_deviation come from StreamingHistogram
+    - the dilation speed carries the last valid sample across chunks
+    - the mad_deviation baseline is interpolated onto its 16 Hz grid with the
+      last usable sample carried across chunks; the grid is ~75x shorter than
+      the recording, so it is filtered in one piece
+    - the detrend fit accumulates its least-squares moments chunk by chunk
+    - output rows are written to a memory-mapped .npy file as they are made
+
+    Thresholds are histogram estimates, so samples lying within ~1e-4 of a
+    threshold can be classified differently from process_run.
+    The sliding-median drift correction (params['drift']) is only available
+    in process_run.
+
+    Parameters
+    ----------
+    raw_fname : path str
+        CTF .ds or converted *_raw.fif file.
+    out_fname : path str
+        Output .npy file. It holds a structured array with the columns of the
+        process_run dataframe.
+    chunk_duration : float
+        Chunk length in seconds; together with the histogram sizes this fixes
+        the memory budget.
+    params : dict
+        Overrides PREPROCESSING_PARAMS for this run (see PreprocessingContext).
+    transform : GazeTransform, optional
+        Fitted volts-to-pixels map, as in process_run.
+    metrics : callable, optional
+        Metrics sink, as in process_run; the whole run is reported as one
+        'process_run_chunked' record (with the speed threshold), plus the
+        remove_loners/expand_gap calls.
+    Returns
+    -------
+    numpy.memmap
+        Read-only structured array backed by out_fname.
+    '''
+    t_start                                         = time.perf_counter()
+    raw_eyes                                        = load_raw_data(raw_fname,preload=False)
+    ctx                                             = PreprocessingContext(raw_eyes.info['sfreq'],params,metrics=metrics,run=str(raw_fname))
+    sfreq,geometry                                  = ctx.sfreq,ctx.geometry
+    if ctx.params['drift']['window_s']:
+        raise ValueError("params['drift'] is not supported by process_run_chunked; use process_run")
+    if any(ctx.params['detrend_options'].values()):
+        raise ValueError("params['detrend_options'] is not supported by process_run_chunked; use process_run")
+    chunk_samples                                   = int(chunk_duration*sfreq)
+    n_samples                                       = int(find_crop_index(raw_eyes,chunk_samples,**ctx.params['crop_trailing_zeros']))+1
+    tv_all                                          = UniformTimes(n_samples,sfreq)
+    ms_per_sample                                   = 1000/sfreq
+    chunks                                          = lambda: iter_chunks(raw_eyes,n_samples,chunk_samples)
+    to_pixels                                       = geometry.volts_to_pix
+    if transform is not None:
+        to_pixels                                   = transform.apply
+
+    # session medians for the raw2df centering
+    volts_hist                                      = [StreamingHistogram(-10,10) for _ in range(3)]
+    for _,_,data in chunks():
+        for hist,channel in zip(volts_hist,data):
+            hist.add(channel)
+    median_x,median_y                               = (0,0) if transform is not None else to_pixels(volts_hist[0].median(),volts_hist[1].median())
+    median_pupil                                    = volts_hist[2].median()
+
+    def centred(data):
+        x,y                                         = to_pixels(data[0],data[1])
+        return x-median_x,y-median_y,data[2]-median_pupil
+
+    # Step 1 (remove_invalid_samples) and the dilation speeds of step 2 (madspeedfilter)
+    def dilation_speeds(start,dia,is_valid,carry):
+        idx                                         = np.flatnonzero(is_valid)
+        t                                           = np.concatenate([carry['t'],(start+idx)*ms_per_sample])
+        d                                           = np.concatenate([carry['d'],dia[idx]])
+        idx                                         = np.concatenate([carry['idx'],start+idx])
+        if not len(idx):
+            return idx,idx.astype(float)
+        dt                                          = np.diff(t)
+        speed                                       = np.diff(d)/dt
+        speed[dt>ctx.params['madspeedfilter']['max_gap_ms']] = np.nan
+        back                                        = np.concatenate([carry['speed'],speed])
+        # the last valid sample still waits for its forward speed
+        carry.update(t=t[-1:],d=d[-1:],idx=idx[-1:],speed=back[-1:])
+        return idx[:-1],np.fmax(np.abs(back[:-1]),np.abs(speed))
+
+    def new_carry():
+        return dict(t=np.empty(0),d=np.empty(0),idx=np.empty(0,dtype=np.int64),speed=np.full(1,np.nan))
+
+    isvalid1_parts,speed_hist,carry                 = [],StreamingHistogram(1e-9,1e9,log=True),new_carry()
+    for start,stop,data in chunks():
+        x,y,dia                                     = centred(data)
+        is_valid                                    = geometry.on_screen(x,y)
+        chunk_mask                                  = ValidityMask.from_mask(is_valid)
+        isvalid1_parts.append((chunk_mask.starts+start,chunk_mask.ends+start))
+        speed_hist.add(dilation_speeds(start,dia,is_valid,carry)[1])
+    speed_hist.add(np.abs(carry['speed']) if len(carry['idx']) else [])
+    isvalid1                                        = ValidityMask(np.concatenate([p[0] for p in isvalid1_parts]),np.concatenate([p[1] for p in isvalid1_parts]),n_samples)
+
+    mad                                             = speed_hist.mad()
+    threshold                                       = speed_hist.median()+ctx.params['madspeedfilter']['mad_multiplier']*(mad if mad!=0 else 1)
+    speed_threshold                                 = float(threshold)
+    too_fast,carry                                  = [],new_carry()
+    for start,stop,data in chunks():
+        idx,speed                                   = dilation_speeds(start,centred(data)[2],isvalid1.to_mask(start,stop),carry)
+        too_fast.append(idx[speed>=threshold])
+    if len(carry['idx']) and np.abs(carry['speed'][0])>=threshold:
+        too_fast.append(carry['idx'])
+    too_fast                                        = np.concatenate(too_fast)
+    isvalid2                                        = isvalid1 & ~ValidityMask(too_fast,too_fast+1,n_samples)
+    isvalid2                                        = remove_loners(isvalid2,ctx)
+    isvalid2                                        = expand_gap(tv_all,isvalid2,ctx)
+    isvalid2                                        = remove_loners(isvalid2,ctx)
+
+    # Step 3 (mad_deviation)
+    n_passes                                        = ctx.params['mad_deviation']['n_passes']
+    mad_multiplier                                  = ctx.params['mad_deviation']['mad_multiplier']
+    interp_fs                                       = ctx.params['mad_deviation']['interp_fs']
+    lowpass_cf                                      = ctx.params['mad_deviation']['lowpass_cf']
+    [smooth_filt_b,smooth_filt_a]                   = butter(1,lowpass_cf/(interp_fs/2))
+    t_interp                                        = np.arange(0,tv_all[n_samples-1],1000/lowpass_cf)
+
+    def pupil_chunks():
+        for start,stop,data in chunks():
+            dia                                     = centred(data)[2]
+            dia[~isvalid2.to_mask(start,stop)]      = np.nan
+            yield start,stop,tv_all[start:stop],dia
+
+    def smooth_baseline(is_usable):
+        uniform_baseline                            = np.full(len(t_interp),np.nan)
+        n_filled,last                               = 0,None
+        for start,stop,t,dia in pupil_chunks():
+            usable                                  = is_usable.to_mask(start,stop) & ~np.isnan(dia)
+            if not usable.any():
+                continue
+            t_valid,dia_valid                       = t[usable],dia[usable]
+            if last is None:
+                # nearest-sample extrapolation before the first usable sample
+                n_before                            = np.searchsorted(t_interp,t_valid[0],side='left')
+                uniform_baseline[:n_before]         = dia_valid[0]
+                n_filled                            = n_before
+            else:
+                t_valid,dia_valid                   = np.concatenate([[last[0]],t_valid]),np.concatenate([[last[1]],dia_valid])
+            n_upto                                  = np.searchsorted(t_interp,t_valid[-1],side='right')
+            uniform_baseline[n_filled:n_upto]       = np.interp(t_interp[n_filled:n_upto],t_valid,dia_valid)
+            n_filled,last                           = n_upto,(t_valid[-1],dia_valid[-1])
+        uniform_baseline[n_filled:]                 = last[1]
+        return filtfilt(smooth_filt_b,smooth_filt_a,uniform_baseline)
+
+    def residuals(smooth_uniform_baseline):
+        for start,stop,t,dia in pupil_chunks():
+            baseline                                = np.interp(t,t_interp,smooth_uniform_baseline,left=np.nan,right=np.nan)
+            yield start,stop,np.abs(dia-baseline)
+
+    is_valid_running                                = isvalid2
+    for pass_id in range(n_passes):
+        is_valid_start                              = is_valid_running
+        smooth_uniform_baseline                     = smooth_baseline(is_valid_running & isvalid2)
+        residual_hist                               = StreamingHistogram(1e-9,1e9,log=True)
+        for _,_,dev in residuals(smooth_uniform_baseline):
+            residual_hist.add(dev)
+        threshold                                   = residual_hist.median()+mad_multiplier*residual_hist.mad()
+        too_far                                     = []
+        for start,stop,dev in residuals(smooth_uniform_baseline):
+            too_far.append(start+np.flatnonzero(~(dev<=threshold)))
+        too_far                                     = np.concatenate(too_far)
+        is_valid_running                            = isvalid2 & ~ValidityMask(too_far,too_far+1,n_samples)
+        is_valid_running                            = remove_loners(is_valid_running,ctx)
+        is_valid_running                            = expand_gap(tv_all,is_valid_running,ctx)
+        if pass_id>0 and is_valid_start==is_valid_running:
+            break
+    isvalid3                                        = is_valid_running
+
+    # detrend: least-squares line over the valid samples of x, y and pupil, merged chunk by chunk
+    n,mean_t,mean_v,m2_t,c_tv                       = 0,0.,np.zeros(3),0.,np.zeros(3)
+    for start,stop,data in chunks():
+        is_valid                                    = isvalid3.to_mask(start,stop)
+        if not is_valid.any():
+            continue
+        t                                           = np.flatnonzero(is_valid)+start
+        v                                           = np.vstack(centred(data))[:,is_valid]
+        n_b,mean_t_b,mean_v_b                       = len(t),t.mean(),v.mean(axis=1)
+        m2_t_b                                      = np.sum((t-mean_t_b)**2)
+        c_tv_b                                      = ((v-mean_v_b[:,None])*(t-mean_t_b)).sum(axis=1)
+        delta_t,delta_v                             = mean_t_b-mean_t,mean_v_b-mean_v
+        n_ab                                        = n+n_b
+        m2_t                                        = m2_t+m2_t_b+delta_t**2*n*n_b/n_ab
+        c_tv                                        = c_tv+c_tv_b+delta_t*delta_v*n*n_b/n_ab
+        mean_t,mean_v,n                             = mean_t+delta_t*n_b/n_ab,mean_v+delta_v*n_b/n_ab,n_ab
+    slope                                           = c_tv/m2_t
+    intercept                                       = mean_v-slope*mean_t
+    if transform is not None:
+        # calibrated x/y keep their level; only the drift is removed
+        intercept[:2]                               = -slope[:2]*mean_t
+
+    columns                                         = ['x_volts','y_volts','pupil','x','y','time','x_deg','y_deg']
+    out                                             = np.lib.format.open_memmap(out_fname,mode='w+',dtype=[(c,'f8') for c in columns],shape=(n_samples,))
+    for start,stop,data in chunks():
+        is_valid                                    = isvalid3.to_mask(start,stop)
+        all_tp                                      = np.arange(start,stop)
+        block                                       = out[start:stop]
+        block['x_volts'],block['y_volts']           = data[0],data[1]
+        block['time']                               = raw_eyes.times[start:stop]
+        for i,(name,values) in enumerate(zip(['x','y','pupil'],centred(data))):
+            values[~is_valid]                       = np.nan
+            block[name]                             = values-(slope[i]*all_tp+intercept[i]) if ctx.params['detrend'] else values
+        for name in ['x','y']:
+            block[name+'_deg']                      = geometry.pix_to_deg(block[name])
+    out.flush()
+    del out
+    ctx.report('process_run_chunked',wall_s=time.perf_counter()-t_start,n_samples=n_samples,n_valid_out=int(isvalid3.n_valid),
+               n_invalidated=int(n_samples-isvalid3.n_valid),speed_threshold=speed_threshold)
+    return np.load(out_fname,mmap_mode='r')
 
 
 # command line calls
@@ -338,7 +1669,12 @@ if __name__=='__main__':
     import argparse
     parser=argparse.ArgumentParser()
     parser.add_argument('-fname',help='path to MEG file with eyetracking')
+    parser.add_argument('-out',help='write the cleaned run to this .npy file using the chunked, bounded-memory pipeline')
+    parser.add_argument('-chunk',type=float,default=60,help='chunk length in seconds for -out (default 60)')
     args = parser.parse_args()
 
     raw_fname = args.fname
-    process_run(raw_fname)
+    if args.out:
+        process_run_chunked(raw_fname,args.out,chunk_duration=args.chunk)
+    else:
+        process_run(raw_fname)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+Synthetic eye-tracking recordings with known ground truth.
+
+Only four short subjects exist and their MEG files are not in the
+repository. This module makes recordings of any length, sample rate and
+blink density that look like an exported *_raw.fif (see
+eyetracker/prep_code/Export_all_to_fif.py): UADC009/010 (x/y), UADC013
+(pupil) and the UADC016 photodiode, in volts. The stimulus schedules come
+from the stimulus code itself (eyetracker/stimulus/stimulusPositions.py):
+ - 'discrete': definePos target grids with the jittered ISIs of
+   discretePos.py. After each onset the eye makes a saccade to the target,
+   following the main sequence and a minimum-jerk profile, and then
+   fixates with slow fixational drift.
+ - 'moving': the moving_trajectory of movingPos.py, 60 Hz frames, followed
+   by smooth pursuit with a fixed lag.
+The gaze is mapped to volts with ScreenGeometry. The following are then
+added:
+ - blinks (Poisson, all three channels drop to the EyeLink floor, with
+   ramps on the pupil)
+ - a linear plus random-walk drift
+ - pupil dynamics (slow hippus plus a dilation response after each onset)
+ - white noise
+A second of zeros ends the recording, as when a run is aborted (see
+crop_trailing_zeros).
+
+Samples are generated chunk by chunk into a memory-mapped .npy, so hour-long
+recordings need little memory; the FIF file is written from that array.
+Ground truth is stored next to it:
+ - <base>_targets.csv: xPos, yPos as in eyetracker/stimulus/results
+   (one row per trial, or per frame for 'moving')
+ - <base>_events.csv: onset of every trial/condition in samples and seconds,
+   and for 'discrete' the saccade onset and offset
+ - <base>_blinks.csv: start and end sample of every blink
+ - <base>_gaze.npy: noise-free gaze in pixels (PsychoPy frame, y up), (2, n)
+
+    python eyetrackingSynthetic.py -out synth/S99_discretePositions -duration 3600 -blinks 30
+"""
+
+import os, os.path as op, importlib.util
+import numpy as np
+import pandas as pd
+from scipy.signal import butter, lfilter
+
+from eyetrackingPreprocess_template import ScreenGeometry, save_raw_chunks
+
+_spec = importlib.util.spec_from_file_location(
+    'stimulusPositions', op.join(op.dirname(op.abspath(__file__)), 'eyetracker', 'stimulus', 'stimulusPositions.py'))
+stimulusPositions = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(stimulusPositions)
+
+CHANNELS = ['UADC009-2104', 'UADC010-2104', 'UADC013-2104', 'UADC016-2104']
+
+SYNTHETIC_PARAMS = {
+    'n_trials': 121, 'stim_duration': 2, 'refreshrate': 60, 'factor': 2,   # as in discretePos.py
+    'saccade_latency_ms': (200, 40),          # mean, sd
+    'fixation_drift_pix': 4,                  # sd of the slow fixational drift
+    'pursuit_lag_ms': 100,
+    'blink_duration_ms': (100, 400),          # uniform range
+    'blink_floor_volts': -5,
+    'blink_ramp_ms': 40,                      # pupil ramp at blink edges
+    'noise_volts': 0.01,                      # white noise on x, y and pupil
+    'drift_volts_per_hour': 0.2,              # linear drift of x and y
+    'drift_walk_volts': 0.02,                 # sd of the random-walk drift per minute
+    'pupil_volts': 1.0,                       # baseline pupil level
+    'pupil_hippus_volts': 0.05,
+    'pupil_response_volts': 0.1,              # peak dilation after an onset
+    'photodiode_volts': -5,
+    'tail_s': 1,
+}
+
+
+def discrete_schedule(duration_s, geometry, params, rng):
+    '''
+    Trial onsets (s) and targets (PsychoPy pixels) of discretePos.py, with
+    definePos grids repeated until duration_s is filled.
+    '''
+    p = params
+    n_grid = int(np.ceil(np.sqrt(p['n_trials'])))**2
+    mean_trial_s = p['stim_duration']-0.5/p['refreshrate']
+    n_blocks = int(np.ceil(duration_s/(n_grid*mean_trial_s)))+1
+    targets = np.concatenate([stimulusPositions.definePos(p['n_trials'], *geometry.size_pix, p['factor'], rng)
+                              for _ in range(n_blocks)])
+    isi = rng.integers(-p['refreshrate'], p['refreshrate'], len(targets))
+    frames = p['stim_duration']*p['refreshrate']+isi
+    onsets = np.concatenate([[0], np.cumsum(frames)[:-1]])/p['refreshrate']
+    keep = onsets+frames/p['refreshrate'] <= duration_s
+    return onsets[keep], targets[keep]
+
+
+def moving_schedule(duration_s, geometry, params, rng):
+    '''
+    Frame-by-frame dot positions of movingPos.py (moving_trajectory) and the
+    onsets (s) of its conditions.
+    '''
+    p = params
+    motDirs, dotSpeeds, condTimes = stimulusPositions.moving_conditions(duration_s, p['refreshrate'])
+    condTimes = condTimes[np.cumsum(condTimes) <= duration_s]
+    trajectory = stimulusPositions.moving_trajectory(condTimes, motDirs, dotSpeeds, *geometry.size_pix, p['factor'],
+                                                     p['refreshrate'], seed=int(rng.integers(2**32)))
+    onsets = trajectory['first_frame']/p['refreshrate']
+    return onsets, trajectory['positions']
+
+
+def saccade_plan(onsets, targets, geometry, params, rng):
+    '''Start/end time (s) and start/end position of the saccade of every trial.'''
+    mean, sd = params['saccade_latency_ms']
+    start = onsets+np.clip(rng.normal(mean, sd, len(onsets)), 80, None)/1000
+    before = np.vstack([[0, 0], targets[:-1]])
+    amplitude = geometry.pix_to_deg(np.hypot(*(targets-before).T))
+    # main sequence: duration grows by ~2.2 ms per degree
+    end = start+(21+2.2*amplitude)/1000
+    return start, end, before
+
+
+def blink_intervals(n_samples, sfreq, blinks_per_min, params, rng):
+    '''Start and end sample (end excluded) of Poisson blinks; overlapping blinks are merged.'''
+    n_blinks = rng.poisson(blinks_per_min*n_samples/sfreq/60)
+    starts = np.sort(rng.integers(0, max(n_samples, 1), n_blinks))
+    lo, hi = params['blink_duration_ms']
+    ends = starts+(rng.uniform(lo, hi, n_blinks)*sfreq/1000).astype(np.int64)
+    if not n_blinks:
+        return starts, ends
+    is_new = np.concatenate([[True], starts[1:] > np.maximum.accumulate(ends)[:-1]])
+    return starts[is_new], np.minimum(np.maximum.reduceat(ends, np.flatnonzero(is_new)), n_samples)
+
+
+def _lowpass_gain(cutoff, sfreq):
+    # input sd that gives unit output sd for white noise through butter(1, cutoff)
+    return np.sqrt(sfreq/(np.pi*cutoff))
+
+
+def generate(out_base, duration_s=300, sfreq=1200, paradigm='discrete', blinks_per_min=15, seed=0,
+             fif=True, chunk_duration=60, params=None, geometry=None):
+    '''
+    Write a synthetic recording and its ground truth.
+
+    Parameters
+    ----------
+    out_base : path str
+        Output prefix; <out_base>_raw.fif (if fif), <out_base>_uadc.npy and
+        the ground-truth files are written.
+    duration_s : float
+        Length of the task part of the recording.
+    sfreq : float
+        Sample rate in Hz.
+    paradigm : 'discrete' or 'moving'
+    blinks_per_min : float
+        Mean blink rate.
+    seed : int
+        The output is a function of the seed and the arguments.
+    fif : bool
+        Also write a FIF file with the four UADC channels.
+    chunk_duration : float
+        Seconds generated at a time.
+    params : dict
+        Overrides of SYNTHETIC_PARAMS.
+    geometry : ScreenGeometry
+        Screen and voltage range (default: the MEG lab setup).
+    Returns
+    -------
+    dict
+        Paths of the written files.
+    '''
+    if paradigm not in ('discrete', 'moving'):
+        raise ValueError(f'paradigm must be discrete or moving, not {paradigm}')
+    p = {**SYNTHETIC_PARAMS, **(params or {})}
+    geometry = ScreenGeometry() if geometry is None else geometry
+    rng = np.random.default_rng(seed)
+    os.makedirs(op.dirname(op.abspath(out_base)), exist_ok=True)
+    n_task = int(duration_s*sfreq)
+    n_samples = n_task+int(p['tail_s']*sfreq)
+
+    # sparse schedule: everything that spans chunks is planned up front
+    if paradigm == 'discrete':
+        onsets, targets = discrete_schedule(duration_s, geometry, p, rng)
+        sacc_start, sacc_end, sacc_from = saccade_plan(onsets, targets, geometry, p, rng)
+        events = pd.DataFrame({'onset_sample': np.round(onsets*sfreq).astype(np.int64), 'onset_s': onsets,
+                               'saccade_onset_s': sacc_start, 'saccade_offset_s': sacc_end})
+    else:
+        onsets, targets = moving_schedule(duration_s, geometry, p, rng)
+        frame_times = (np.arange(len(targets))+1)/p['refreshrate']
+        events = pd.DataFrame({'onset_sample': np.round(onsets*sfreq).astype(np.int64), 'onset_s': onsets})
+    blink_starts, blink_ends = blink_intervals(n_task, sfreq, blinks_per_min, p, rng)
+    onset_samples = events['onset_sample'].to_numpy()
+    flash_frames = np.round(onsets*p['refreshrate']).astype(np.int64)
+
+    uadc_fname, gaze_fname = f'{out_base}_uadc.npy', f'{out_base}_gaze.npy'
+    uadc = np.lib.format.open_memmap(uadc_fname, mode='w+', dtype=np.float64, shape=(len(CHANNELS), n_samples))
+    gaze_out = np.lib.format.open_memmap(gaze_fname, mode='w+', dtype=np.float32, shape=(2, n_samples))
+    drift_b, drift_a = butter(1, 0.5/(sfreq/2))
+    hippus_b, hippus_a = butter(1, 0.3/(sfreq/2))
+    drift_zi = [np.zeros(1), np.zeros(1)]
+    hippus_zi = np.zeros(1)
+    walk = np.zeros(2)
+    ramp = max(int(p['blink_ramp_ms']*sfreq/1000), 1)
+    # pupil dilation response to an onset (Hoeks & Levelt: t^n exp(-n t/t_max))
+    t_resp = np.arange(int(3*sfreq))/sfreq
+    response = (t_resp/0.93)**10.1*np.exp(-10.1*(t_resp/0.93-1))*p['pupil_response_volts']
+
+    chunk = int(chunk_duration*sfreq)
+    for start in range(0, n_task, chunk):
+        stop = min(start+chunk, n_task)
+        t = np.arange(start, stop)/sfreq
+        chunk_rng = np.random.default_rng([seed, start])
+        n = stop-start
+
+        # noise-free gaze in PsychoPy pixels
+        if paradigm == 'discrete':
+            k = np.searchsorted(sacc_start, t, side='right')-1
+            gaze = np.where(k[:, None] >= 0, targets[np.maximum(k, 0)], 0.)
+            tau = (t-sacc_start[np.maximum(k, 0)])/(sacc_end[np.maximum(k, 0)]-sacc_start[np.maximum(k, 0)])
+            moving = (k >= 0) & (tau < 1)
+            s = tau[moving]
+            s = 10*s**3-15*s**4+6*s**5
+            gaze[moving] = sacc_from[k[moving]]+s[:, None]*(targets[k[moving]]-sacc_from[k[moving]])
+            drift_noise = chunk_rng.normal(0, p['fixation_drift_pix']*_lowpass_gain(0.5, sfreq), (2, n))
+            for axis in range(2):
+                jitter, drift_zi[axis] = lfilter(drift_b, drift_a, drift_noise[axis], zi=drift_zi[axis])
+                gaze[:, axis] += jitter
+        else:
+            lagged = t-p['pursuit_lag_ms']/1000
+            gaze = np.column_stack([np.interp(lagged, frame_times, targets[:, axis], left=0) for axis in range(2)])
+        gaze_out[:, start:stop] = gaze.T
+
+        # volts: raw2df has y pointing down
+        x_volts, y_volts = geometry.pix_to_volts(gaze[:, 0], -gaze[:, 1])
+        steps = chunk_rng.normal(0, p['drift_walk_volts']/np.sqrt(60*sfreq), (2, n))
+        walks = walk[:, None]+np.cumsum(steps, axis=1)
+        walk = walks[:, -1]
+        linear = t*p['drift_volts_per_hour']/3600
+        x_volts = x_volts+linear+walks[0]
+        y_volts = y_volts+linear+walks[1]
+
+        hippus, hippus_zi = lfilter(hippus_b, hippus_a, chunk_rng.normal(0, p['pupil_hippus_volts']*_lowpass_gain(0.3, sfreq), n), zi=hippus_zi)
+        pupil = p['pupil_volts']+hippus
+        first = np.searchsorted(onset_samples, start-len(response))
+        last = np.searchsorted(onset_samples, stop)
+        for onset in onset_samples[first:last]:
+            lo, hi = max(onset, start), min(onset+len(response), stop)
+            pupil[lo-start:hi-start] += response[lo-onset:hi-onset]
+
+        data = np.vstack([x_volts, y_volts, pupil])
+        data += chunk_rng.normal(0, p['noise_volts'], data.shape)
+        data = np.clip(data, -5, 5)
+
+        # blinks: the tracker output drops to its floor; the pupil ramps in and out
+        first = np.searchsorted(blink_ends, start-ramp)
+        last = np.searchsorted(blink_starts, stop+ramp)
+        for b_start, b_end in zip(blink_starts[first:last], blink_ends[first:last]):
+            lo, hi = max(b_start, start), min(b_end, stop)
+            data[:, lo-start:max(hi-start, 0)] = p['blink_floor_volts']
+            offsets = np.arange(ramp)
+            for idx in (b_start-1-offsets, b_end+offsets):
+                inside = (idx >= start) & (idx < stop)
+                weight = (offsets[inside]+1)/(ramp+1)
+                data[2, idx[inside]-start] = weight*data[2, idx[inside]-start]+(1-weight)*p['blink_floor_volts']
+
+        # photodiode: one white frame at every onset, negative going
+        photodiode = chunk_rng.normal(0, p['noise_volts'], n)
+        frame = np.floor(t*p['refreshrate']).astype(np.int64)
+        photodiode[np.isin(frame, flash_frames)] += p['photodiode_volts']
+
+        uadc[:3, start:stop] = data
+        uadc[3, start:stop] = photodiode
+
+    uadc[:, n_task:] = 0
+    gaze_out[:, n_task:] = np.nan
+    uadc.flush()
+    gaze_out.flush()
+    del uadc, gaze_out
+
+    paths = {'uadc': uadc_fname, 'gaze': gaze_fname,
+             'targets': f'{out_base}_targets.csv', 'events': f'{out_base}_events.csv', 'blinks': f'{out_base}_blinks.csv'}
+    pd.DataFrame(targets, columns=['xPos', 'yPos']).to_csv(paths['targets'], index=False)
+    events.to_csv(paths['events'], index=False)
+    pd.DataFrame({'start_sample': blink_starts, 'end_sample': blink_ends}).to_csv(paths['blinks'], index=False)
+    if fif:
+        paths['fif'] = write_fif(uadc_fname, f'{out_base}_raw.fif', sfreq, chunk_duration)
+    return paths
+
+
+def write_fif(uadc_fname, fif_fname, sfreq, chunk_duration=60):
+    '''
+    FIF file with the UADC channels of a generated .npy. The memory map is
+    handed to save_raw_chunks chunk_duration seconds at a time, so memory
+    stays at one chunk however long the recording is.
+    '''
+    import mne
+    data = np.load(uadc_fname, mmap_mode='r')
+    info = mne.create_info(CHANNELS, sfreq, 'misc')
+    step = int(round(chunk_duration*sfreq))
+    chunks = (np.array(data[:, start:start+step]) for start in range(0, data.shape[1], step))
+    return save_raw_chunks(fif_fname, info, chunks, buffer_size_sec=chunk_duration)
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-out',required=True,help='output prefix, e.g. synth/S99_discretePositions')
+    parser.add_argument('-duration',type=float,default=300,help='task duration in s (default 300)')
+    parser.add_argument('-sfreq',type=float,default=1200,help='sample rate in Hz (default 1200)')
+    parser.add_argument('-paradigm',default='discrete',choices=['discrete','moving'])
+    parser.add_argument('-blinks',type=float,default=15,help='blinks per minute (default 15)')
+    parser.add_argument('-seed',type=int,default=0)
+    parser.add_argument('-nofif',action='store_true',help='only write the memory-mapped .npy')
+    args = parser.parse_args()
+
+    paths = generate(args.out, duration_s=args.duration, sfreq=args.sfreq, paradigm=args.paradigm,
+                     blinks_per_min=args.blinks, seed=args.seed, fif=not args.nofif)
+    for kind, path in paths.items():
+        print(f'{kind}: {path}')
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Decoding of stimulus onsets from an analog trigger channel (UADC016).
+
+The projector photodiode pulls UADC016 from ~0 V to about -5 V while a new
+dot is shown. An onset is where the signal falls below on_threshold. It is
+only re-armed once the signal has risen back above off_threshold
+(hysteresis), so noise around a single threshold gives no extra events.
+Onsets closer than min_distance_ms to the previous accepted onset are
+rejected. Crossing times are interpolated linearly between samples.
+
+The detector keeps its state between blocks. A recording can therefore be
+decoded in one pass over fixed-size chunks, and find_trigger_onsets and
+read_events give the same events for any chunk size. When the expected
+number of events is known (one per row of the stimulus CSV), extra triggers
+at the end are dropped as in calibration_error.m. Missing triggers raise.
+
+    events = read_events('S04_discretePositions_raw.fif',
+                         expected='eyetracker/stimulus/results/S04_run1.csv')
+"""
+
+import numpy as np
+import pandas as pd
+
+from eyetrackingPreprocess_template import load_raw_data, iter_chunks
+
+
+class TriggerDetector:
+    '''
+    Streaming hysteresis detector for pulses on an analog channel.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sample rate in Hz.
+    on_threshold, off_threshold : float
+        A pulse starts when the signal crosses on_threshold and ends when it
+        crosses back over off_threshold (volts). For falling pulses
+        on_threshold < off_threshold; for rising pulses (polarity=1) the
+        other way round.
+    min_distance_ms : float
+        Minimum time between two accepted onsets.
+    polarity : -1 or 1
+        Direction of the pulse (UADC016 pulses are negative going).
+    '''
+    def __init__(self, sfreq, on_threshold=-4., off_threshold=-2., min_distance_ms=100., polarity=-1):
+        if polarity*(on_threshold-off_threshold) <= 0:
+            raise ValueError('on_threshold must lie beyond off_threshold in the direction of the pulse')
+        self.sfreq = float(sfreq)
+        # work on polarity*signal, so that a pulse always goes up
+        self.polarity = polarity
+        self.on_threshold = polarity*on_threshold
+        self.off_threshold = polarity*off_threshold
+        self.min_distance = min_distance_ms*self.sfreq/1000
+        self.reset()
+
+    def reset(self):
+        self.n_seen = 0
+        self._active = False
+        self._last_value = np.nan
+        self._last_onset = -np.inf
+        self._open_onset = None
+
+    def process(self, block):
+        '''
+        Feed the next block of samples. Return the pulses completed in it as
+        an (n, 3) array of onset sample, onset and offset in fractional
+        samples from the start of the recording. A pulse still running at the
+        end of the block is reported once it ends (or by flush()).
+        '''
+        x = self.polarity*np.asarray(block, dtype=float)
+        n = len(x)
+        start = self.n_seen
+        self.n_seen += n
+        if not n:
+            return np.empty((0, 3))
+
+        # hysteresis: the state is set by the last sample beyond either threshold
+        is_on = x > self.on_threshold
+        is_set = is_on | (x < self.off_threshold)
+        last_set = np.maximum.accumulate(np.where(is_set, np.arange(n), -1))
+        active = np.where(last_set >= 0, is_on[np.maximum(last_set, 0)], self._active)
+        previous = np.concatenate([[self._active], active[:-1]])
+        rising = np.flatnonzero(active & ~previous)
+        falling = np.flatnonzero(~active & previous)
+
+        x_before = np.concatenate([[self._last_value], x[:-1]])
+        onsets = rising+start+self._fraction(x_before[rising], x[rising], self.on_threshold)
+        offsets = falling+start+self._fraction(x_before[falling], x[falling], self.off_threshold)
+        self._active, self._last_value = bool(active[-1]), x[-1]
+
+        # pair each onset with the next offset; only onsets that respect
+        # min_distance are kept (few events, so this loop is cheap)
+        pending = [self._open_onset] if self._open_onset is not None else []
+        pending += list(zip(rising+start, onsets))
+        out = []
+        for offset in offsets:
+            onset_sample, onset = pending.pop(0)
+            if onset-self._last_onset >= self.min_distance:
+                out.append((onset_sample, onset, offset))
+                self._last_onset = onset
+        self._open_onset = pending[0] if pending else None
+        return np.array(out, dtype=float).reshape(-1, 3)
+
+    def flush(self):
+        '''Report a pulse that is still running at the end of the recording (offset NaN).'''
+        out = np.empty((0, 3))
+        if self._open_onset is not None and self._open_onset[1]-self._last_onset >= self.min_distance:
+            out = np.array([[self._open_onset[0], self._open_onset[1], np.nan]])
+            self._last_onset = self._open_onset[1]
+        self._open_onset = None
+        return out
+
+    @staticmethod
+    def _fraction(before, after, threshold):
+        # position of the threshold crossing between the previous sample (-1) and this one (0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = (threshold-before)/(after-before)-1
+        return np.where(np.isfinite(frac), np.clip(frac, -1, 0), 0)
+
+
+def events_table(pulses, sfreq):
+    '''Event table (onset_sample, onset_ms, duration_ms) from TriggerDetector output.'''
+    pulses = np.asarray(pulses, dtype=float).reshape(-1, 3)
+    return pd.DataFrame({'onset_sample': pulses[:, 0].astype(np.int64),
+                         'onset_ms': pulses[:, 1]*1000/sfreq,
+                         'duration_ms': (pulses[:, 2]-pulses[:, 1])*1000/sfreq})
+
+
+def check_event_count(events, expected):
+    '''
+    Compare the events with the expected number of stimuli (an int, or the
+    stimulus CSV with one row per stimulus). Extra trailing triggers are
+    dropped, as in calibration_error.m; missing triggers raise ValueError.
+    '''
+    if isinstance(expected, str):
+        expected = len(pd.read_csv(expected))
+    if len(events) < expected:
+        raise ValueError(f'found {len(events)} triggers, expected {expected}')
+    if len(events) > expected:
+        print(f'dropping {len(events)-expected} extra trigger(s) after the first {expected}')
+    return events.iloc[:expected].reset_index(drop=True)
+
+
+def find_trigger_onsets(stim, sfreq, expected=None, chunk_samples=None, **detector_kw):
+    '''
+    Event table of a trigger channel held in memory.
+
+    Parameters
+    ----------
+    stim : array
+        Trigger channel in volts.
+    sfreq : float
+        Sample rate in Hz.
+    expected : int or path str, optional
+        Expected number of events or stimulus CSV (see check_event_count).
+    chunk_samples : int, optional
+        Decode in blocks of this many samples (the result does not depend on it).
+    detector_kw
+        Thresholds, min_distance_ms and polarity of TriggerDetector.
+    Returns
+    -------
+    pandas.DataFrame
+        onset_sample (first sample past on_threshold), onset_ms (interpolated
+        crossing time), duration_ms.
+    '''
+    detector = TriggerDetector(sfreq, **detector_kw)
+    chunk_samples = len(stim) if chunk_samples is None else chunk_samples
+    pulses = [detector.process(stim[start:start+chunk_samples]) for start in range(0, len(stim), max(chunk_samples, 1))]
+    events = events_table(np.concatenate(pulses+[detector.flush()]), sfreq)
+    return events if expected is None else check_event_count(events, expected)
+
+
+def read_events(raw_fname, channel='UADC016', expected=None, chunk_duration=60, **detector_kw):
+    '''
+    Event table of a .ds/.fif run, decoded chunk by chunk from disk so that
+    multi-hour recordings are never held in memory.
+    '''
+    raw = load_raw_data(raw_fname, eye_channel=[channel], preload=False)
+    sfreq = raw.info['sfreq']
+    detector = TriggerDetector(sfreq, **detector_kw)
+    pulses = [detector.process(data[0]) for _, _, data in iter_chunks(raw, raw.n_times, int(chunk_duration*sfreq))]
+    events = events_table(np.concatenate(pulses+[detector.flush()]), sfreq)
+    return events if expected is None else check_event_count(events, expected)
+
+
+# command line calls
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-fname',nargs='+',required=True,help='path(s) to MEG file(s) with the trigger channel')
+    parser.add_argument('-csv',nargs='*',default=[],help='stimulus CSV per run, to check the number of events')
+    parser.add_argument('-channel',default='UADC016',help='trigger channel (default UADC016)')
+    parser.add_argument('-out',help='write the event table of all runs to this CSV')
+    args = parser.parse_args()
+
+    tables = []
+    for run, raw_fname in enumerate(args.fname):
+        expected = args.csv[run] if run < len(args.csv) else None
+        events = read_events(raw_fname, channel=args.channel, expected=expected)
+        print(f'{raw_fname}: {len(events)} events')
+        tables.append(events.assign(run=run, fname=raw_fname))
+    tables = pd.concat(tables, ignore_index=True)
+    if args.out:
+        tables.to_csv(args.out, index=False)
+    else:
+        print(tables.to_string(index=False))
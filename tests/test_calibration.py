@@ -0,0 +1,86 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import eyetrackingCalibration as calibration
+import eyetrackingSynthetic as synthetic
+from eyetrackingPreprocess_template import GazeTransform, ScreenGeometry, process_run, read_sfreq
+from eyetrackingTriggers import read_events
+
+
+@pytest.fixture(scope='module')
+def discrete_run(tmp_path_factory):
+    base = str(tmp_path_factory.mktemp('synthetic')/'discrete')
+    synthetic.generate(base, duration_s=180, paradigm='discrete', seed=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        eyes = process_run(base + '_raw.fif')
+    targets = calibration.load_targets(base + '_targets.csv')
+    onsets = read_events(base + '_raw.fif', expected=len(targets))['onset_sample'].to_numpy()
+    gaze = np.load(base + '_gaze.npy')
+    return dict(eyes=eyes, targets=targets, onsets=onsets, sfreq=read_sfreq(base + '_raw.fif'),
+                true_x=gaze[0], true_y=-gaze[1])
+
+
+def longest_fixation_samples(run):
+    x, y = run['eyes']['x'].to_numpy(), run['eyes']['y'].to_numpy()
+    fixations, samples = calibration.segment_fixations(x, y, run['onsets'], run['sfreq'], return_samples=True)
+    longest = calibration.longest_fixations(fixations)
+    n = longest['n_samples'].to_numpy()
+    start = np.repeat(longest['offset'].to_numpy() - (np.cumsum(n) - n), n)
+    return samples[start + np.arange(n.sum())], np.repeat(longest['trial'].to_numpy(), n)
+
+
+def test_saccade_mask_flags_fast_samples():
+    x = np.r_[np.zeros(10), np.full(10, 100.)]
+    is_saccade = calibration.saccade_mask(x, np.zeros(20), 1200, {'saccade_lowpass_hz': None})
+    assert np.flatnonzero(is_saccade).tolist() == [8, 9]
+
+
+def test_longest_fixations_exclude_saccades(discrete_run):
+    # the true gaze of the samples used for the error must be on the target
+    samples, trial = longest_fixation_samples(discrete_run)
+    targets = discrete_run['targets'][trial]
+    distance = np.hypot(discrete_run['true_x'][samples] - targets[:, 0], discrete_run['true_y'][samples] - targets[:, 1])
+    assert np.mean(distance > 50) < 0.01
+
+
+def test_calibration_error_of_true_gaze(discrete_run):
+    # the noise-free gaze, invalid wherever process_run rejected samples, fixates within the synthetic drift
+    x = discrete_run['eyes']['x'].to_numpy()
+    true_x, true_y = discrete_run['true_x'][:len(x)].copy(), discrete_run['true_y'][:len(x)].copy()
+    true_x[np.isnan(x)] = np.nan
+    true_y[np.isnan(x)] = np.nan
+    errors = calibration.calibration_error(true_x, true_y, discrete_run['onsets'], discrete_run['targets'],
+                                           discrete_run['sfreq'])
+    assert errors['err_pix'].notna().mean() > 0.9
+    assert errors['err_pix'].median() < 6
+    assert errors['err_pix'].quantile(0.9) < 10
+
+
+def test_fit_transform_reproduces_geometry(discrete_run):
+    eyes = discrete_run['eyes']
+    x, y = eyes['x'].to_numpy(), eyes['y'].to_numpy()
+    geometry = ScreenGeometry()
+    transform = calibration.fit_transform(eyes['x_volts'], eyes['y_volts'], x, y, discrete_run['onsets'],
+                                          discrete_run['targets'], discrete_run['sfreq'], geometry=geometry)
+    np.testing.assert_allclose(calibration.transform_gains(transform, geometry), geometry._gain, rtol=0.01)
+
+    fitted_x, fitted_y = transform.apply(eyes['x_volts'].to_numpy(), eyes['y_volts'].to_numpy())
+    fitted_x[np.isnan(x)] = np.nan
+    fitted_y[np.isnan(y)] = np.nan
+    args = discrete_run['onsets'], discrete_run['targets'], discrete_run['sfreq']
+    uncalibrated = calibration.calibration_error(x, y, *args)['err_pix'].median()
+    calibrated = calibration.calibration_error(fitted_x, fitted_y, *args)['err_pix'].median()
+    assert calibrated < uncalibrated
+
+
+def test_check_transform_refuses_shrunk_gains():
+    geometry = ScreenGeometry()
+    x_volts, y_volts = np.meshgrid(np.linspace(-2, 2, 5), np.linspace(-2, 2, 5))
+    x_pix, y_pix = geometry.volts_to_pix(x_volts.ravel(), y_volts.ravel())
+    shrunk = GazeTransform.fit(x_volts.ravel(), y_volts.ravel(), 0.7*x_pix, 0.7*y_pix)
+    with pytest.raises(ValueError, match='px/V'):
+        calibration.check_transform(shrunk, geometry)
+    calibration.check_transform(GazeTransform.fit(x_volts.ravel(), y_volts.ravel(), x_pix, y_pix), geometry)
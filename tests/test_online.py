@@ -0,0 +1,24 @@
+import numpy as np
+
+import eyetrackingOnline as online
+
+
+def blocks(data, block_size):
+    for start in range(0, data.shape[1], block_size):
+        yield data[:, start:start+block_size], None
+
+
+def test_run_online_emits_every_sample():
+    sfreq = 1200
+    rng = np.random.default_rng(0)
+    data = np.vstack([rng.normal(0, 0.05, (2, 3*sfreq)), 1+rng.normal(0, 0.001, 3*sfreq)])
+    # a blink that has not ended when the stream stops
+    data[:, -sfreq//10:] = -5
+    cleaner = online.OnlineGazeCleaner(sfreq)
+    out = list(online.run_online(blocks(data, 12), cleaner))
+
+    assert [first for first, _ in out] == list(np.cumsum([0]+[cleaned.shape[1] for _, cleaned in out[:-1]]))
+    cleaned = np.hstack([cleaned for _, cleaned in out])
+    assert cleaner.n_out == cleaner.n_in == data.shape[1] == cleaned.shape[1]
+    assert np.isnan(cleaned[:, -sfreq//10:]).all()
+    assert not np.isnan(cleaned[:, sfreq:2*sfreq]).any()
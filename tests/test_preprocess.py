@@ -0,0 +1,64 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import eyetrackingPreprocess_template as preproc
+import eyetrackingSynthetic as synthetic
+
+
+@pytest.fixture(scope='module')
+def deviation_inputs(tmp_path_factory):
+    base = str(tmp_path_factory.mktemp('synthetic')/'discrete')
+    synthetic.generate(base, duration_s=300, paradigm='discrete', blinks_per_min=20, seed=1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        raw = preproc.load_raw_data(base + '_raw.fif')
+        ctx = preproc.PreprocessingContext(raw.info['sfreq'])
+        preproc.crop_trailing_zeros(raw, **ctx.params['crop_trailing_zeros'])
+        eyes = preproc.raw2df(raw, geometry=ctx.geometry)
+    tv = eyes.index.to_numpy()/ctx.sfreq*1000
+    dia = np.array(eyes['pupil'], dtype=float)
+    is_valid = preproc.remove_invalid_samples(eyes, tv, ctx)
+    is_valid = preproc.madspeedfilter(tv, dia.copy(), is_valid, ctx)
+    return tv, dia, is_valid, ctx
+
+
+def test_streaming_histogram_remove():
+    values = np.random.default_rng(0).lognormal(0, 1, 10000)
+    histogram = preproc.StreamingHistogram(1e-6, 1e3, log=True)
+    histogram.add(values)
+    histogram.add(values[:3000]*5)
+    histogram.remove(values[:3000]*5)
+    assert histogram.median() == pytest.approx(np.median(values), rel=1e-3)
+    assert histogram.mad() == pytest.approx(np.median(np.abs(values-np.median(values))), rel=1e-3)
+
+
+def test_incremental_deviation_matches_full(deviation_inputs):
+    tv, dia, is_valid, ctx = deviation_inputs
+    metrics = preproc.MetricsCollector()
+    incremental_ctx = preproc.PreprocessingContext(ctx.sfreq, metrics=metrics)
+    full = preproc.mad_deviation(tv, dia.copy(), is_valid, ctx)
+    incremental = preproc.mad_deviation(tv, dia.copy(), is_valid, incremental_ctx, incremental=True)
+    assert np.mean(full.to_mask() != incremental.to_mask()) < 1e-4
+    record = [r for r in metrics.records if r['stage'] == 'mad_deviation'][0]
+    assert len(record['pass_s']) == record['n_passes']
+
+
+def test_incremental_deviation_update_matches_deviation_calculator(deviation_inputs):
+    tv, dia, is_valid, ctx = deviation_inputs
+    params = ctx.params['mad_deviation']
+    b, a = preproc.butter(1, params['lowpass_cf']/(params['interp_fs']/2))
+    t_interp = np.arange(tv[0], tv[-1], 1000/params['lowpass_cf'])
+    dia = dia.copy()
+    dia[~is_valid.to_mask()] = np.nan
+    deviation = preproc.IncrementalDeviation(tv, dia, t_interp, a, b)
+    deviation.full(is_valid)
+    # drop a few short stretches, as a later pass would
+    changed = is_valid & ~preproc.ValidityMask([50000, 200000], [50600, 201200], len(tv))
+    dev, baseline = deviation.update(changed)
+    expected_dev, expected_baseline = preproc.deviation_calculator(tv, dia, changed.to_mask(), t_interp, a, b)
+    np.testing.assert_allclose(baseline, expected_baseline, rtol=1e-9, atol=1e-9*np.nanmax(np.abs(expected_baseline)))
+    np.testing.assert_allclose(dev, expected_dev, atol=1e-9*np.nanmax(np.abs(expected_baseline)))
+    valid_dev = expected_dev[~np.isnan(expected_dev)]
+    assert deviation.histogram.median() == pytest.approx(np.median(valid_dev), rel=1e-3)